@@ -0,0 +1,133 @@
+"""
+GLM 熔断器
+记住 "余额不足" 和 "上游故障"(连续超时/网络错误/5xx) 状态, 冷却期内直接在本地失败,
+不再排队和上传图片; 冷却结束后每次只放行一个探测请求, 成功则恢复, 失败则继续熔断
+"""
+
+import os
+import time
+
+# ==================== 配置 ====================
+
+# 连续多少次上游故障后熔断
+GLM_BREAKER_FAILURES = int(os.getenv("GLM_BREAKER_FAILURES", "5"))
+# 上游故障熔断的冷却秒数(探测失败后翻倍, 不超过 GLM_BREAKER_MAX_COOLDOWN)
+GLM_BREAKER_COOLDOWN = float(os.getenv("GLM_BREAKER_COOLDOWN", "30"))
+GLM_BREAKER_MAX_COOLDOWN = float(os.getenv("GLM_BREAKER_MAX_COOLDOWN", "600"))
+# 余额不足熔断的冷却秒数(充值后最多这么久恢复)
+GLM_BREAKER_QUOTA_COOLDOWN = float(os.getenv("GLM_BREAKER_QUOTA_COOLDOWN", "300"))
+
+# 熔断器状态
+STATE_CLOSED = "closed"  # 正常放行
+STATE_OPEN = "open"  # 熔断中, 本地直接失败
+STATE_HALF_OPEN = "half_open"  # 冷却结束, 放行单个探测请求
+
+# 熔断原因
+REASON_QUOTA = "quota_exhausted"
+REASON_OUTAGE = "outage"
+
+
+class CircuitOpenError(Exception):
+    """熔断中, 请求未发往上游"""
+
+    def __init__(self, reason: str, retry_in: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """GLM 账户级熔断器(余额和服务状态对所有模型共用)"""
+
+    def __init__(self, failure_threshold: int = GLM_BREAKER_FAILURES, cooldown: float = GLM_BREAKER_COOLDOWN,
+                 max_cooldown: float = GLM_BREAKER_MAX_COOLDOWN, quota_cooldown: float = GLM_BREAKER_QUOTA_COOLDOWN,
+                 probe_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.quota_cooldown = quota_cooldown
+        self.probe_timeout = probe_timeout  # 探测请求最长耗时(即单次请求超时), 用于估计重试等待时间
+        self.state = STATE_CLOSED
+        self.reason = None
+        self.failures = 0
+        self.rejected = 0
+        self.trips = 0
+        self._current_cooldown = cooldown
+        self._opened_until = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+
+    def before_request(self) -> bool:
+        """发送前检查: 熔断中抛出 CircuitOpenError; 返回本次请求是否为探测请求"""
+        if self.state == STATE_CLOSED:
+            return False
+
+        now = time.monotonic()
+        if self.state == STATE_OPEN and now >= self._opened_until:
+            self.state = STATE_HALF_OPEN
+            print(f"[熔断器] 冷却结束, 发送探测请求 ({self.reason})")
+
+        if self.state == STATE_HALF_OPEN and not self._probing:
+            self._probing = True
+            self._probe_started = now
+            return True
+
+        self.rejected += 1
+        raise CircuitOpenError(self.reason, self._retry_in(now))
+
+    def _retry_in(self, now: float) -> float:
+        """被拒绝的请求建议的重试等待秒数(至少 1 秒)
+
+        冷却中为剩余冷却时间; 探测请求进行中时, 按探测请求最迟超时的时间估计
+        """
+        if self.state == STATE_HALF_OPEN:
+            remaining = self._probe_started + self.probe_timeout - now
+        else:
+            remaining = self._opened_until - now
+        return max(1.0, remaining)
+
+    def release_probe(self):
+        """探测请求未得出结果(被取消或未发出)时归还探测名额"""
+        self._probing = False
+
+    def on_success(self):
+        """上游有正常响应(包括并发限制等业务错误): 服务可用"""
+        self.failures = 0
+        if self.state != STATE_CLOSED:
+            print(f"[熔断器] ✅ 探测成功, 恢复正常 ({self.reason})")
+            self.state = STATE_CLOSED
+            self.reason = None
+            self._current_cooldown = self.cooldown
+        self._probing = False
+
+    def on_failure(self):
+        """上游故障(超时, 网络错误, 5xx)"""
+        self.failures += 1
+        if self.state == STATE_HALF_OPEN:
+            self._current_cooldown = min(self.max_cooldown, self._current_cooldown * 2)
+            self._trip(REASON_OUTAGE, self._current_cooldown)
+        elif self.state == STATE_CLOSED and self.failures >= self.failure_threshold:
+            self._trip(REASON_OUTAGE, self._current_cooldown)
+
+    def on_quota_exhausted(self):
+        """账户余额不足"""
+        self._trip(REASON_QUOTA, self.quota_cooldown)
+
+    def _trip(self, reason: str, cooldown: float):
+        if self.state != STATE_OPEN:
+            self.trips += 1
+            print(f"[熔断器] ⚠️ 熔断 {cooldown:.0f} 秒 ({reason})")
+        self.state = STATE_OPEN
+        self.reason = reason
+        self._opened_until = time.monotonic() + cooldown
+        self._probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "reason": self.reason,
+            "retry_in": round(max(0.0, self._opened_until - time.monotonic()), 1) if self.state != STATE_CLOSED else 0,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
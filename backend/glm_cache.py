@@ -0,0 +1,160 @@
+"""
+GLM 响应缓存
+两级内容寻址缓存: 进程内 LRU(带过期时间) + 磁盘缓存(多个 uvicorn worker 共享),
+以请求指纹(model + messages + 参数的 SHA-256)为键
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import Optional
+
+# ==================== 配置 ====================
+
+# 总开关
+GLM_CACHE_ENABLED = os.getenv("GLM_CACHE_ENABLED", "1") == "1"
+# 内存缓存最大条数
+GLM_CACHE_MAX_ENTRIES = int(os.getenv("GLM_CACHE_MAX_ENTRIES", "512"))
+# 缓存有效期(秒)
+GLM_CACHE_TTL = float(os.getenv("GLM_CACHE_TTL", "86400"))
+# 磁盘缓存目录(为空则只使用内存缓存)
+GLM_CACHE_DIR = os.getenv("GLM_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "glm"))
+# 磁盘缓存最多保留的文件数
+GLM_CACHE_DISK_MAX_ENTRIES = int(os.getenv("GLM_CACHE_DISK_MAX_ENTRIES", "5000"))
+# 关闭缓存的端点标签(逗号分隔), 例如 "analyze_smart,detect_mistakes"
+GLM_CACHE_DISABLED_TAGS = {tag.strip() for tag in os.getenv("GLM_CACHE_DISABLED_TAGS", "").split(",") if tag.strip()}
+
+
+class ResponseCache:
+    """两级响应缓存, 按端点标签统计命中情况"""
+
+    # 每写入多少次磁盘缓存清理一次过期/超量文件
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, max_entries: int = GLM_CACHE_MAX_ENTRIES, ttl: float = GLM_CACHE_TTL,
+                 disk_dir: Optional[str] = GLM_CACHE_DIR, disk_max_entries: int = GLM_CACHE_DISK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir or None
+        self.disk_max_entries = disk_max_entries
+        self._memory = OrderedDict()
+        self._writes = 0
+        self.counters = defaultdict(lambda: {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0})
+
+    def is_enabled(self, tag: Optional[str]) -> bool:
+        """该端点是否启用缓存(调用方未指定标签视为不缓存)"""
+        return GLM_CACHE_ENABLED and bool(tag) and tag not in GLM_CACHE_DISABLED_TAGS
+
+    async def get(self, key: str, tag: str) -> Optional[str]:
+        """查询缓存, 未命中返回 None"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, content = entry
+            if expires_at > time.time():
+                self._memory.move_to_end(key)
+                self.counters[tag]["memory_hits"] += 1
+                return content
+            del self._memory[key]
+
+        if self.disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self._remember(key, entry)
+                self.counters[tag]["disk_hits"] += 1
+                return entry[1]
+
+        self.counters[tag]["misses"] += 1
+        return None
+
+    async def set(self, key: str, content: str, tag: str):
+        """写入两级缓存"""
+        entry = (time.time() + self.ttl, content)
+        self._remember(key, entry)
+        self.counters[tag]["stores"] += 1
+
+        if self.disk_dir:
+            self._writes += 1
+            prune = self._writes % self.PRUNE_INTERVAL == 0
+            await asyncio.to_thread(self._write_disk, key, entry, prune)
+
+    def _remember(self, key: str, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    # ==================== 磁盘缓存 ====================
+
+    def _disk_path(self, key: str) -> str:
+        # 按前两位分目录, 避免单个目录文件过多
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("expires_at", 0) <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return data["expires_at"], data["content"]
+
+    def _write_disk(self, key: str, entry: tuple, prune: bool):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"expires_at": entry[0], "content": entry[1]}, f, ensure_ascii=False)
+            # 原子替换, 其他 worker 不会读到写了一半的文件
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[响应缓存] ⚠️ 写入磁盘缓存失败: {e}")
+            return
+
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """删除过期文件, 超过上限时按修改时间删除最旧的文件"""
+        files = []
+        now = time.time()
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                if now - mtime > self.ttl:
+                    self._remove_quietly(path)
+                else:
+                    files.append((mtime, path))
+
+        if len(files) > self.disk_max_entries:
+            files.sort()
+            for _, path in files[:len(files) - self.disk_max_entries]:
+                self._remove_quietly(path)
+
+    @staticmethod
+    def _remove_quietly(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "enabled": GLM_CACHE_ENABLED,
+            "memory_entries": len(self._memory),
+            "disk_dir": self.disk_dir,
+            "endpoints": dict(self.counters)
+        }
@@ -0,0 +1,542 @@
+"""
+GLM API 客户端
+基于 httpx.AsyncClient 的异步调用, 复用到 GLM_API_URL 的 keep-alive 连接池,
+上游请求期间不阻塞 uvicorn 事件循环; 支持 stream=True 逐段返回生成内容
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from glm_breaker import CircuitBreaker, CircuitOpenError, REASON_QUOTA
+from glm_cache import ResponseCache
+from glm_hedge import LatencyTracker, HedgeBudget, hedge_delay
+from glm_scheduler import GLMScheduler, mask_key, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK
+
+# ==================== 配置 ====================
+
+# 从环境变量读取API Key（如果没有则使用默认值）
+GLM_API_KEY = os.getenv("GLM_API_KEY", "5f53890e74fa465a8ad1a95409db864c.roWm4OnFKpTIIdDJ")
+GLM_API_URL = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
+# 多个 API Key(逗号分隔), 每个 Key 拥有独立的并发通道; 未配置时只使用 GLM_API_KEY
+GLM_API_KEYS = [key.strip() for key in os.getenv("GLM_API_KEYS", "").split(",") if key.strip()] or [GLM_API_KEY]
+
+# 检查API Key是否为默认值
+if GLM_API_KEY == "5f53890e74fa465a8ad1a95409db864c.roWm4OnFKpTIIdDJ":
+    print("=" * 60)
+    print("⚠️  警告: 使用默认的GLM API Key")
+    print("如需使用自己的API Key，请创建 backend/.env 文件:")
+    print("  GLM_API_KEY=your_api_key_here")
+    print("=" * 60)
+
+# 连接池配置
+GLM_MAX_CONNECTIONS = int(os.getenv("GLM_MAX_CONNECTIONS", "20"))  # 最大连接数
+GLM_MAX_KEEPALIVE = int(os.getenv("GLM_MAX_KEEPALIVE", "10"))  # 最大空闲 keep-alive 连接数
+GLM_KEEPALIVE_EXPIRY = float(os.getenv("GLM_KEEPALIVE_EXPIRY", "60"))  # 空闲连接保留秒数
+GLM_TIMEOUT = float(os.getenv("GLM_TIMEOUT", "60"))  # 单次请求超时秒数
+
+# ==================== 连接池 ====================
+_http_client: Optional[httpx.AsyncClient] = None
+
+# 请求调度器(按模型和 API Key 划分并发通道)
+scheduler = GLMScheduler(GLM_API_KEYS)
+# 响应缓存(内存 LRU + 磁盘)
+response_cache = ResponseCache()
+# 熔断器(余额不足/上游故障时本地快速失败)
+breaker = CircuitBreaker(probe_timeout=GLM_TIMEOUT)
+# 各模型调用耗时统计和各端点的对冲预算
+latency_tracker = LatencyTracker()
+hedge_budget = HedgeBudget()
+# 进行中的请求(单飞合并): 请求指纹 -> 上游调用任务
+_inflight: Dict[str, asyncio.Task] = {}
+# 客户端统计
+client_stats = {
+    "upstream_calls": 0,  # 实际发往 GLM 的调用
+    "coalesced": 0  # 与进行中的相同请求合并的调用
+}
+# 请求ID计数器
+request_counter = 0
+request_counter_lock = threading.Lock()
+
+
+def get_request_id():
+    """生成唯一的请求ID"""
+    global request_counter
+    with request_counter_lock:
+        request_counter += 1
+        return request_counter
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的 httpx 异步客户端(懒加载, 连接池在所有请求间复用)"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=GLM_MAX_CONNECTIONS,
+                max_keepalive_connections=GLM_MAX_KEEPALIVE,
+                keepalive_expiry=GLM_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(GLM_TIMEOUT, connect=10.0)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """关闭连接池(应用退出时调用)"""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+
+
+# ==================== API 调用 ====================
+
+def request_fingerprint(payload: dict) -> str:
+    """请求指纹: model/messages/参数规范化 JSON 的 SHA-256"""
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_client_stats() -> dict:
+    return {**client_stats, "inflight": len(_inflight)}
+
+
+def get_hedge_stats() -> dict:
+    return {"latency": latency_tracker.stats(), "budget": hedge_budget.stats()}
+
+
+def build_headers(api_key: str) -> dict:
+    """构建 GLM 请求头"""
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+
+
+def is_quota_exhausted(error_msg: str) -> bool:
+    """429 响应是否表示账户余额不足(而不是并发限制)"""
+    return '余额' in error_msg or '充值' in error_msg or '资源包' in error_msg
+
+
+def quota_exhausted_error() -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"⚠️ API余额不足\n\n您的GLM API账户余额已用完，请充值后再使用。\n\n📍 解决方法:\n1. 访问 https://open.bigmodel.cn/ 充值\n2. 或在 backend/.env 文件中配置其他API Key\n3. 新用户通常有免费额度，请检查控制台"
+    )
+
+
+def circuit_open_error(error: CircuitOpenError) -> HTTPException:
+    """熔断中的本地失败, 余额不足时返回与上游相同的提示"""
+    if error.reason == REASON_QUOTA:
+        return quota_exhausted_error()
+    return HTTPException(
+        status_code=503,
+        detail=f"GLM 服务暂时不可用(连续多次请求失败), 请约 {error.retry_in:.0f} 秒后重试"
+    )
+
+
+@asynccontextmanager
+async def upstream_slot(req_id: int, model: str, priority: int):
+    """熔断检查通过后占用调度通道名额; 熔断中直接抛出 HTTPException, 不排队"""
+    try:
+        probe = breaker.before_request()
+    except CircuitOpenError as e:
+        print(f"[API #{req_id}] ⛔ 熔断中, 直接返回失败 ({e.reason})")
+        raise circuit_open_error(e)
+
+    try:
+        async with scheduler.slot(model, priority) as (api_key, controller):
+            yield api_key, controller
+    finally:
+        if probe:
+            breaker.release_probe()
+
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """读取 Retry-After 响应头(秒)"""
+    try:
+        return float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
+def check_error_response(response: httpx.Response, req_id: int, controller, is_last: bool) -> Optional[float]:
+    """处理非 200 响应
+
+    余额不足, 非 429 错误, 以及最后一次尝试仍遇到 429 时抛出 HTTPException;
+    可以重试的 429 会通知限流器降速, 并返回服务端建议的 Retry-After 秒数.
+    余额不足和 5xx 会通知熔断器
+    """
+    try:
+        error_detail = response.json() if response.content else {}
+    except ValueError:
+        # 网关错误等情况返回的不是 JSON
+        error_detail = {}
+
+    # 处理 429 并发限制错误
+    if response.status_code == 429:
+        error_msg = error_detail.get('error', {}).get('message', '并发请求过多')
+
+        # 检查是否是余额不足
+        if is_quota_exhausted(error_msg):
+            print(f"[API #{req_id}] ❌ API余额不足")
+            breaker.on_quota_exhausted()
+            raise quota_exhausted_error()
+
+        breaker.on_success()
+        controller.on_throttle()
+        if is_last:
+            raise HTTPException(
+                status_code=429,
+                detail=f"GLM API 并发限制: {error_msg}. 请稍后重试. "
+            )
+        return parse_retry_after(response)
+
+    if response.status_code >= 500:
+        breaker.on_failure()
+    else:
+        breaker.on_success()
+
+    error_msg = error_detail.get('error', {}).get('message', response.text)
+    raise HTTPException(
+        status_code=response.status_code,
+        detail=f"GLM API 错误: {error_msg}"
+    )
+
+
+def extract_content(result, req_id: int) -> str:
+    """从 GLM 响应 JSON 中取出回复内容, 格式异常时抛出 HTTPException"""
+    print(f"[API #{req_id}] 响应结构: {list(result.keys()) if isinstance(result, dict) else type(result)}")
+
+    # 检查choices
+    if 'choices' not in result:
+        print(f"[API #{req_id}] ❌ 响应中没有choices")
+        print(f"[API #{req_id}] 完整响应: {json.dumps(result, ensure_ascii=False)[:500]}")
+        sys.stdout.flush()
+        raise HTTPException(
+            status_code=500,
+            detail="GLM API 返回格式异常: 缺少choices字段"
+        )
+
+    if len(result['choices']) == 0:
+        print(f"[API #{req_id}] ❌ choices为空")
+        sys.stdout.flush()
+        raise HTTPException(
+            status_code=500,
+            detail="GLM API 返回空结果"
+        )
+
+    print(f"[API #{req_id}] choices[0] keys: {list(result['choices'][0].keys())}")
+
+    if 'message' not in result['choices'][0]:
+        print(f"[API #{req_id}] ❌ choices[0]中没有message字段")
+        print(f"[API #{req_id}] choices[0]: {result['choices'][0]}")
+        sys.stdout.flush()
+        raise HTTPException(
+            status_code=500,
+            detail="GLM API 返回格式异常: 缺少message字段"
+        )
+
+    print(f"[API #{req_id}] message keys: {list(result['choices'][0]['message'].keys())}")
+    content = result['choices'][0]['message'].get('content', '')
+    print(f"[API #{req_id}] 内容类型: {type(content)}")
+    print(f"[API #{req_id}] 内容长度: {len(content) if content else 0}")
+
+    # 检查内容是否为空
+    if not content or not content.strip():
+        print(f"[API #{req_id}] ❌ API返回内容为空")
+        sys.stdout.flush()
+        raise HTTPException(
+            status_code=500,
+            detail="GLM API 返回内容为空,请重试"
+        )
+
+    print(f"[API #{req_id}] 内容repr: {repr(content[:100])}")
+    print(f"[API #{req_id}] 内容预览: {content[:200]}")
+    sys.stdout.flush()
+    return content
+
+
+async def call_glm_api(messages: list, model: str = "glm-4v", max_retries: int = 3, max_tokens: int = 2000,
+                       priority: int = PRIORITY_NORMAL, cache: Optional[str] = None, hedge: Optional[str] = None) -> str:
+    """调用 GLM API(异步, 带排队, 自适应限流和重试机制)
+
+    同时发起的相同请求(model, messages 和参数都一致)只向 GLM 发送一次,
+    所有调用方共享同一个结果或异常; 指定 cache 标签的请求还会读写响应缓存,
+    指定 hedge 标签的请求在耗时超过该模型 p95 时会发送对冲请求
+
+    Args:
+        messages: 消息列表
+        model: 模型名称
+        max_retries: 最大重试次数
+        max_tokens: 最大输出token数(用于控制响应速度)
+        priority: 排队优先级(PRIORITY_INTERACTIVE/PRIORITY_NORMAL/PRIORITY_BULK)
+        cache: 缓存标签(通常为端点名), 设置后启用响应缓存并按标签统计命中; 对话类请求不要设置
+        hedge: 对冲预算标签(通常为端点名), 设置后启用对冲请求, 同一标签共享对冲额度
+    """
+    req_id = get_request_id()
+
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": max_tokens
+    }
+
+    fingerprint = request_fingerprint(payload)
+    use_cache = response_cache.is_enabled(cache)
+    if use_cache:
+        cached = await response_cache.get(fingerprint, cache)
+        if cached is not None:
+            print(f"[API #{req_id}] 命中响应缓存 ({cache})")
+            return cached
+
+    task = _inflight.get(fingerprint)
+    if task is not None:
+        client_stats["coalesced"] += 1
+        print(f"[API #{req_id}] 与进行中的相同请求合并, 等待其结果")
+        return await asyncio.shield(task)
+
+    # 上游调用放在独立任务中, 某个调用方断开不会取消其他调用方共享的请求
+    if hedge:
+        task = asyncio.ensure_future(hedged_request(payload, req_id, max_retries, priority, hedge))
+    else:
+        task = asyncio.ensure_future(request_glm(payload, req_id, max_retries, priority))
+    _inflight[fingerprint] = task
+    task.add_done_callback(lambda done: finish_inflight(fingerprint, done))
+
+    content = await asyncio.shield(task)
+    if use_cache:
+        await response_cache.set(fingerprint, content, cache)
+    return content
+
+
+def finish_inflight(fingerprint: str, task: asyncio.Task):
+    """上游调用结束: 移出进行中列表, 并标记异常已读取(避免无人等待时的告警)"""
+    if _inflight.get(fingerprint) is task:
+        del _inflight[fingerprint]
+    if not task.cancelled():
+        task.exception()
+
+
+async def hedged_request(payload: dict, req_id: int, max_retries: int, priority: int, endpoint: str) -> str:
+    """带对冲的非流式调用
+
+    主请求发出后超过该模型 p95 耗时仍未返回, 且端点还有对冲额度, 模型通道有空闲名额时,
+    再发送一份相同请求(不重试), 取先成功的结果并取消另一份; 两份都失败时抛出主请求的异常
+    """
+    model = payload["model"]
+    hedge_budget.on_request(endpoint)
+    sent = asyncio.Event()
+    primary = asyncio.ensure_future(request_glm(payload, req_id, max_retries, priority, sent=sent))
+    backup = None
+
+    try:
+        delay = hedge_delay(latency_tracker, model)
+        if delay is None:
+            return await primary
+
+        # 从主请求实际发出时开始计时, 排队和限流等待不计入
+        sent_waiter = asyncio.ensure_future(sent.wait())
+        await asyncio.wait({primary, sent_waiter}, return_when=asyncio.FIRST_COMPLETED)
+        sent_waiter.cancel()
+        if not primary.done():
+            await asyncio.wait({primary}, timeout=delay)
+
+        if primary.done() or not scheduler.has_capacity(model) or not hedge_budget.try_spend(endpoint):
+            return await primary
+
+        print(f"[API #{req_id}] 超过 {model} p95 耗时 {delay:.1f} 秒仍未返回, 发送对冲请求 ({endpoint})")
+        backup = asyncio.ensure_future(request_glm(payload, req_id, 1, priority))
+        pending = {primary, backup}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is backup:
+                        hedge_budget.on_hedge_win(endpoint)
+                        print(f"[API #{req_id}] 对冲请求先返回")
+                    return task.result()
+        return primary.result()
+    finally:
+        for task in (primary, backup):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def request_glm(payload: dict, req_id: int, max_retries: int, priority: int, sent: Optional[asyncio.Event] = None) -> str:
+    """向 GLM 发送一次非流式调用(排队, 限流, 重试)
+
+    sent: 请求实际发出时置位(对冲调用据此计时)
+    """
+    model = payload["model"]
+    client_stats["upstream_calls"] += 1
+
+    client = get_http_client()
+
+    for attempt in range(max_retries):
+        is_last = attempt == max_retries - 1
+        retry_after = None
+        print(f"[API #{req_id}] 等待 {model} 通道名额...")
+
+        # 每次尝试单独占用通道名额, 退避等待期间不占用通道
+        async with upstream_slot(req_id, model, priority) as (api_key, controller):
+            await controller.pace()
+            print(f"[API #{req_id}] 发送请求到GLM... (Key {mask_key(api_key)}, 尝试 {attempt + 1}/{max_retries})")
+            if sent is not None:
+                sent.set()
+            started = time.monotonic()
+
+            try:
+                response = await client.post(
+                    GLM_API_URL,
+                    headers=build_headers(api_key),
+                    json=payload
+                )
+            except httpx.TimeoutException as e:
+                breaker.on_failure()
+                controller.on_throttle(timeout=True)
+                if is_last:
+                    raise HTTPException(status_code=504, detail=f"API 请求超时: {str(e)}")
+                reason = "请求超时"
+            except httpx.HTTPError as e:
+                breaker.on_failure()
+                if is_last:
+                    raise HTTPException(status_code=500, detail=f"API 调用失败: {str(e)}")
+                reason = "网络错误"
+            else:
+                if response.status_code != 200:
+                    retry_after = check_error_response(response, req_id, controller, is_last)
+                    reason = "遇到并发限制"
+                else:
+                    print(f"[API #{req_id}] ✅ 请求成功")
+                    breaker.on_success()
+                    controller.on_success()
+                    latency_tracker.record(model, time.monotonic() - started)
+                    return extract_content(response.json(), req_id)
+
+        # 指数退避加随机抖动, 避免多个请求同时重试
+        wait_time = controller.backoff(attempt, retry_after)
+        print(f"[API #{req_id}] ⚠️ {reason},等待 {wait_time:.1f} 秒后重试...")
+        await asyncio.sleep(wait_time)
+
+    raise HTTPException(status_code=500, detail="API 调用失败: 超过最大重试次数")
+
+
+async def iter_stream_deltas(response: httpx.Response):
+    """解析 GLM 流式响应(SSE), 逐段产出增量文本"""
+    async for line in response.aiter_lines():
+        line = line.strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            continue
+        choices = chunk.get("choices") or []
+        if choices:
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                yield delta
+
+
+async def stream_glm_api(messages: list, model: str = "glm-4-flash", max_retries: int = 3, max_tokens: int = 2000,
+                         priority: int = PRIORITY_NORMAL, cache: Optional[str] = None):
+    """流式调用 GLM API(stream=True), 收到增量内容后立即产出
+
+    排队, 限流和重试规则与 call_glm_api 相同; 只有在尚未产出任何内容时才会重试,
+    已开始输出后出错直接抛出 HTTPException, 避免重复内容.
+    指定 cache 标签时, 命中缓存直接一次性产出完整内容, 未命中则在流结束后写入缓存
+
+    用法:
+        async for delta in stream_glm_api(messages):
+            ...
+    """
+    req_id = get_request_id()
+
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": max_tokens,
+        "stream": True
+    }
+
+    # 缓存键与非流式调用一致, 两种调用方式可以共享缓存
+    fingerprint = request_fingerprint({key: value for key, value in payload.items() if key != "stream"})
+    use_cache = response_cache.is_enabled(cache)
+    if use_cache:
+        cached = await response_cache.get(fingerprint, cache)
+        if cached is not None:
+            print(f"[API #{req_id}] 命中响应缓存 ({cache})")
+            yield cached
+            return
+
+    client_stats["upstream_calls"] += 1
+    client = get_http_client()
+
+    for attempt in range(max_retries):
+        is_last = attempt == max_retries - 1
+        retry_after = None
+        received = []
+        print(f"[API #{req_id}] 等待 {model} 通道名额(流式)...")
+
+        async with upstream_slot(req_id, model, priority) as (api_key, controller):
+            await controller.pace()
+            print(f"[API #{req_id}] 发送流式请求到GLM... (Key {mask_key(api_key)}, 尝试 {attempt + 1}/{max_retries})")
+
+            try:
+                async with client.stream("POST", GLM_API_URL, headers=build_headers(api_key), json=payload) as response:
+                    if response.status_code != 200:
+                        await response.aread()
+                        retry_after = check_error_response(response, req_id, controller, is_last)
+                        reason = "遇到并发限制"
+                    else:
+                        breaker.on_success()
+                        async for delta in iter_stream_deltas(response):
+                            if not received:
+                                print(f"[API #{req_id}] 收到首段内容")
+                            received.append(delta)
+                            yield delta
+
+                        content = "".join(received)
+                        if not content.strip():
+                            print(f"[API #{req_id}] ❌ API返回内容为空")
+                            raise HTTPException(status_code=500, detail="GLM API 返回内容为空,请重试")
+
+                        controller.on_success()
+                        print(f"[API #{req_id}] ✅ 流式请求完成, 共 {len(content)} 字符")
+                        sys.stdout.flush()
+                        if use_cache:
+                            await response_cache.set(fingerprint, content, cache)
+                        return
+            except httpx.TimeoutException as e:
+                breaker.on_failure()
+                controller.on_throttle(timeout=True)
+                if is_last or received:
+                    raise HTTPException(status_code=504, detail=f"API 请求超时: {str(e)}")
+                reason = "请求超时"
+            except httpx.HTTPError as e:
+                breaker.on_failure()
+                if is_last or received:
+                    raise HTTPException(status_code=500, detail=f"API 调用失败: {str(e)}")
+                reason = "网络错误"
+
+        wait_time = controller.backoff(attempt, retry_after)
+        print(f"[API #{req_id}] ⚠️ {reason},等待 {wait_time:.1f} 秒后重试...")
+        await asyncio.sleep(wait_time)
+
+    raise HTTPException(status_code=500, detail="API 调用失败: 超过最大重试次数")
@@ -0,0 +1,104 @@
+"""
+GLM 对冲请求
+记录每个模型最近的调用耗时, 调用超过该模型 p95 耗时仍未返回时再发送一份相同请求,
+取先完成的结果并取消另一份; 每个端点有独立的对冲预算, 对冲请求数最多为正常请求数的
+固定比例, 负载高时不会让上游调用量翻倍
+"""
+
+import os
+from collections import defaultdict, deque
+from typing import Optional
+
+# ==================== 配置 ====================
+
+# 总开关
+GLM_HEDGE_ENABLED = os.getenv("GLM_HEDGE_ENABLED", "1") == "1"
+# 触发对冲的耗时分位数
+GLM_HEDGE_PERCENTILE = float(os.getenv("GLM_HEDGE_PERCENTILE", "95"))
+# 每个模型保留的最近耗时样本数, 以及开始对冲前至少需要的样本数
+GLM_HEDGE_WINDOW = int(os.getenv("GLM_HEDGE_WINDOW", "200"))
+GLM_HEDGE_MIN_SAMPLES = int(os.getenv("GLM_HEDGE_MIN_SAMPLES", "20"))
+# 对冲等待时间的下限(秒), 避免耗时普遍很短时过早对冲
+GLM_HEDGE_MIN_DELAY = float(os.getenv("GLM_HEDGE_MIN_DELAY", "1"))
+# 对冲预算: 每个请求为所在端点积累的额度(0.1 即对冲请求最多约为正常请求的 10%), 以及额度上限
+GLM_HEDGE_RATIO = float(os.getenv("GLM_HEDGE_RATIO", "0.1"))
+GLM_HEDGE_BURST = float(os.getenv("GLM_HEDGE_BURST", "3"))
+
+
+class LatencyTracker:
+    """按模型记录最近的成功调用耗时, 计算分位数"""
+
+    def __init__(self, window: int = GLM_HEDGE_WINDOW, min_samples: int = GLM_HEDGE_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, model: str, seconds: float):
+        self._samples[model].append(seconds)
+
+    def percentile(self, model: str, percent: float = GLM_HEDGE_PERCENTILE) -> Optional[float]:
+        """耗时分位数, 样本不足时返回 None"""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+
+    def stats(self) -> dict:
+        return {
+            model: {
+                "samples": len(samples),
+                "p50": round(self.percentile(model, 50) or 0, 2),
+                "p95": round(self.percentile(model) or 0, 2)
+            }
+            for model, samples in self._samples.items()
+        }
+
+
+class HedgeBudget:
+    """按端点计算的对冲额度(令牌桶)
+
+    每个请求为端点积累 GLM_HEDGE_RATIO 个令牌, 每次对冲消耗 1 个,
+    令牌最多积累 GLM_HEDGE_BURST 个
+    """
+
+    def __init__(self, ratio: float = GLM_HEDGE_RATIO, burst: float = GLM_HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = defaultdict(float)
+        self.counters = defaultdict(lambda: {"requests": 0, "hedged": 0, "hedge_wins": 0, "denied": 0})
+
+    def on_request(self, endpoint: str):
+        self.counters[endpoint]["requests"] += 1
+        self._tokens[endpoint] = min(self.burst, self._tokens[endpoint] + self.ratio)
+
+    def try_spend(self, endpoint: str) -> bool:
+        """尝试消耗一次对冲额度"""
+        if self._tokens[endpoint] < 1:
+            self.counters[endpoint]["denied"] += 1
+            return False
+        self._tokens[endpoint] -= 1
+        self.counters[endpoint]["hedged"] += 1
+        return True
+
+    def on_hedge_win(self, endpoint: str):
+        self.counters[endpoint]["hedge_wins"] += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": GLM_HEDGE_ENABLED,
+            "endpoints": {
+                endpoint: {**counters, "tokens": round(self._tokens[endpoint], 2)}
+                for endpoint, counters in self.counters.items()
+            }
+        }
+
+
+def hedge_delay(tracker: LatencyTracker, model: str) -> Optional[float]:
+    """发出对冲请求前的等待时间, 样本不足或未启用时返回 None(不对冲)"""
+    if not GLM_HEDGE_ENABLED:
+        return None
+    threshold = tracker.percentile(model)
+    if threshold is None:
+        return None
+    return max(GLM_HEDGE_MIN_DELAY, threshold)
@@ -0,0 +1,286 @@
+"""
+GLM 请求调度器
+按 (API Key, 模型) 划分并发通道, 每个通道有独立的并发上限和优先级等待队列,
+不同模型/不同 Key 的请求互不阻塞; 每个通道的并发和发送速率由 AIMD 控制器
+根据 GLM 的 429/超时反馈自适应调整
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+
+def parse_model_limits(raw: str) -> Dict[str, int]:
+    """解析 "glm-4v=2,glm-4-flash=5" 格式的并发配置"""
+    limits = {}
+    for item in raw.split(","):
+        if "=" not in item:
+            continue
+        model, value = item.split("=", 1)
+        try:
+            limits[model.strip()] = max(1, int(value))
+        except ValueError:
+            print(f"[调度器] ⚠️ 忽略无效的并发配置: {item}")
+    return limits
+
+
+# ==================== 配置 ====================
+
+# 每个模型的并发上限(每个 API Key 各自计算)
+GLM_MODEL_CONCURRENCY = parse_model_limits(os.getenv("GLM_MODEL_CONCURRENCY", "glm-4v=2,glm-4-flash=5"))
+# 未在上面列出的模型使用的并发上限
+GLM_DEFAULT_CONCURRENCY = int(os.getenv("GLM_DEFAULT_CONCURRENCY", "2"))
+# 单个 API Key 所有模型合计的并发上限
+GLM_KEY_CONCURRENCY = int(os.getenv("GLM_KEY_CONCURRENCY", "6"))
+
+# 自适应限流: 并发上限的增长上限(未列出的模型为初始值的2倍)
+GLM_MODEL_MAX_CONCURRENCY = parse_model_limits(os.getenv("GLM_MODEL_MAX_CONCURRENCY", "glm-4v=4,glm-4-flash=10"))
+# 自适应限流: 每个通道的发送速率(请求/秒)
+GLM_INITIAL_RATE = float(os.getenv("GLM_INITIAL_RATE", "2"))
+GLM_MIN_RATE = float(os.getenv("GLM_MIN_RATE", "0.2"))
+GLM_MAX_RATE = float(os.getenv("GLM_MAX_RATE", "10"))
+# 自适应限流: 每次成功后速率的加性增量, 以及 429/超时后的乘性减小系数
+GLM_RATE_STEP = float(os.getenv("GLM_RATE_STEP", "0.2"))
+GLM_DECREASE_FACTOR = float(os.getenv("GLM_DECREASE_FACTOR", "0.5"))
+# 重试退避: 基础等待秒数和最大等待秒数(指数增长 + 随机抖动)
+GLM_BACKOFF_BASE = float(os.getenv("GLM_BACKOFF_BASE", "1"))
+GLM_BACKOFF_MAX = float(os.getenv("GLM_BACKOFF_MAX", "20"))
+# 优先级老化: 排队每满这么多秒, 请求的优先级提升一级(防止低优先级请求饿死)
+GLM_PRIORITY_AGING = float(os.getenv("GLM_PRIORITY_AGING", "10"))
+
+# 请求优先级(数值越小越优先)
+PRIORITY_INTERACTIVE = 0  # 交互式对话/引导, 学生在等待回复
+PRIORITY_NORMAL = 1  # 普通识别/分析请求
+PRIORITY_BULK = 2  # 整卷学情报告, 逐题解答等批量任务
+
+
+def mask_key(api_key: str) -> str:
+    """隐藏 API Key 中间部分, 用于日志和状态输出"""
+    return f"{api_key[:6]}...{api_key[-4:]}" if len(api_key) > 12 else "***"
+
+
+# ==================== 并发通道 ====================
+
+class ConcurrencyLane:
+    """带独立优先级等待队列的并发通道
+
+    排队顺序按 "优先级 * GLM_PRIORITY_AGING + 入队时间" 排序: 高优先级请求插队,
+    但低优先级请求每多等 GLM_PRIORITY_AGING 秒就相当于提升一级, 不会被无限推迟
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def load(self) -> float:
+        """当前负载(运行中 + 排队中) / 并发上限"""
+        return (self.active + self.queued) / self.limit
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL):
+        """获取一个并发名额, 名额已满时按优先级排队等待"""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority * GLM_PRIORITY_AGING + time.monotonic(), next(self._sequence), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已分配但调用方被取消, 归还名额
+                self.release()
+            elif entry in self._waiters:
+                # 仍在排队时移出队列; 已被 _wake_up 弹出(取消的等待者不占名额)时无需处理
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self):
+        """归还名额并唤醒排队的请求"""
+        self.active -= 1
+        self._wake_up()
+
+    def set_limit(self, limit: int):
+        """调整并发上限(调小时运行中的请求不受影响, 只是暂不放行新请求)"""
+        self.limit = max(1, limit)
+        self._wake_up()
+
+    def _wake_up(self):
+        while self._waiters and self.active < self.limit:
+            future = heapq.heappop(self._waiters)[-1]
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued
+        }
+
+
+# ==================== 自适应限流 ====================
+
+class AIMDController:
+    """加性增/乘性减(AIMD)限流器
+
+    请求成功时逐步提高通道并发上限和发送速率, 遇到 429 或超时时减半,
+    使调用速度贴近 GLM 实际允许的上限
+    """
+
+    # 两次减速之间的最小间隔(秒), 避免同一波 429 把上限连续砍到底
+    DECREASE_COOLDOWN = 2.0
+
+    def __init__(self, lane: ConcurrencyLane, max_limit: int,
+                 rate: float = GLM_INITIAL_RATE, min_rate: float = GLM_MIN_RATE, max_rate: float = GLM_MAX_RATE):
+        self.lane = lane
+        self.min_limit = 1
+        self.max_limit = max(max_limit, lane.limit)
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.successes = 0
+        self.throttles = 0
+        self.timeouts = 0
+        self._success_streak = 0
+        self._next_send = 0.0
+        self._last_decrease = 0.0
+
+    async def pace(self):
+        """按当前速率为请求分配发送时间, 需要时等待"""
+        now = time.monotonic()
+        send_at = max(now, self._next_send)
+        self._next_send = send_at + 1.0 / self.rate
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+    def on_success(self):
+        """请求成功: 速率加性增长, 每连续成功一轮(等于当前上限次)并发上限加1"""
+        self.successes += 1
+        self._success_streak += 1
+        self.rate = min(self.max_rate, self.rate + GLM_RATE_STEP)
+        if self._success_streak >= self.lane.limit and self.lane.limit < self.max_limit:
+            self._success_streak = 0
+            self.lane.set_limit(self.lane.limit + 1)
+
+    def on_throttle(self, timeout: bool = False):
+        """遇到 429 或超时: 并发上限和速率乘性减小"""
+        if timeout:
+            self.timeouts += 1
+        else:
+            self.throttles += 1
+        self._success_streak = 0
+
+        now = time.monotonic()
+        if now - self._last_decrease < self.DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * GLM_DECREASE_FACTOR)
+        self.lane.set_limit(max(self.min_limit, int(self.lane.limit * GLM_DECREASE_FACTOR)))
+        print(f"[调度器] {self.lane.name} 降速: 并发上限 {self.lane.limit}, 速率 {self.rate:.2f}/秒")
+
+    @staticmethod
+    def backoff(attempt: int, retry_after: float = None) -> float:
+        """重试等待时间: 指数退避加随机抖动; 服务端给出 Retry-After 时以其为下限"""
+        wait = min(GLM_BACKOFF_MAX, GLM_BACKOFF_BASE * (2 ** attempt))
+        wait = random.uniform(wait / 2, wait)
+        if retry_after:
+            wait = max(wait, min(retry_after, GLM_BACKOFF_MAX))
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "max_limit": self.max_limit,
+            "rate": round(self.rate, 2),
+            "successes": self.successes,
+            "throttles": self.throttles,
+            "timeouts": self.timeouts
+        }
+
+
+# ==================== 调度器 ====================
+
+class GLMScheduler:
+    """为每个 (API Key, 模型) 分配独立通道和限流器, 并限制每个 Key 的总并发"""
+
+    def __init__(self, api_keys: List[str], model_limits: Dict[str, int] = None,
+                 default_limit: int = GLM_DEFAULT_CONCURRENCY, key_limit: int = GLM_KEY_CONCURRENCY,
+                 max_limits: Dict[str, int] = None):
+        self.api_keys = list(api_keys)
+        self.model_limits = dict(GLM_MODEL_CONCURRENCY if model_limits is None else model_limits)
+        self.max_limits = dict(GLM_MODEL_MAX_CONCURRENCY if max_limits is None else max_limits)
+        self.default_limit = default_limit
+        self.key_lanes = {key: ConcurrencyLane(mask_key(key), key_limit) for key in self.api_keys}
+        self.model_lanes = {}
+        self.controllers = {}
+
+    def model_lane(self, api_key: str, model: str) -> ConcurrencyLane:
+        lane = self.model_lanes.get((api_key, model))
+        if lane is None:
+            limit = self.model_limits.get(model, self.default_limit)
+            lane = ConcurrencyLane(f"{mask_key(api_key)}/{model}", limit)
+            self.model_lanes[(api_key, model)] = lane
+            self.controllers[(api_key, model)] = AIMDController(lane, self.max_limits.get(model, limit * 2))
+        return lane
+
+    def pick_key(self, model: str) -> str:
+        """选择该模型负载最低的 API Key"""
+        return min(
+            self.api_keys,
+            key=lambda key: (self.model_lane(key, model).load, self.key_lanes[key].load)
+        )
+
+    def has_capacity(self, model: str) -> bool:
+        """是否有 API Key 的该模型通道和 Key 通道都还有空闲名额(无需排队)"""
+        for key in self.api_keys:
+            lane = self.model_lane(key, model)
+            key_lane = self.key_lanes[key]
+            if lane.load < 1 and key_lane.load < 1:
+                return True
+        return False
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int = PRIORITY_NORMAL):
+        """按优先级占用一个模型通道名额, 返回本次调用使用的 API Key 和该通道的限流器"""
+        api_key = self.pick_key(model)
+        lane = self.model_lane(api_key, model)
+        key_lane = self.key_lanes[api_key]
+
+        # 固定先模型后 Key 的获取顺序, 避免互相等待
+        await lane.acquire(priority)
+        try:
+            await key_lane.acquire(priority)
+        except BaseException:
+            lane.release()
+            raise
+
+        try:
+            yield api_key, self.controllers[(api_key, model)]
+        finally:
+            key_lane.release()
+            lane.release()
+
+    def stats(self) -> dict:
+        return {
+            "keys": {lane.name: lane.stats() for lane in self.key_lanes.values()},
+            "models": {
+                lane.name: {**lane.stats(), **self.controllers[lane_key].stats()}
+                for lane_key, lane in self.model_lanes.items()
+            }
+        }
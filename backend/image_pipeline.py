@@ -0,0 +1,752 @@
+"""
+图片预处理
+所有视觉端点共用的一次解码流程: 先读取文件头检查尺寸, JPEG 用 draft 模式按目标尺寸直接
+降采样解码, 按 EXIF 方向旋转, 缩放后编码为发送给 GLM 的 base64 JPEG(可按字节预算自动选择质量和尺寸).
+也可以一次解码后裁出多个区域(按题裁剪)或把多个区域拼成一张带编号的图片, 整页图片先裁剪到纸张并透视校正, 或输出只保留笔迹的 3 色 PNG(纯笔迹模式).
+各类视觉调用按 IMAGE_PROFILES 中的任务规格(尺寸, 质量, 字节预算, 灰度)处理, 分类调用只发送小缩略图.
+处理结果按 (原图 SHA-256, 尺寸, 质量) 缓存, 同一张试卷在多个端点间重复上传时不再重复处理.
+解码/缩放/编码在独立的进程池中执行, 不阻塞事件循环; 排队已满时等待, 超时返回 503
+"""
+
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException, UploadFile
+from PIL import Image, ImageDraw, ImageFont, ImageOps, UnidentifiedImageError
+
+# ==================== 配置 ====================
+
+# 上传图片的最大字节数
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+# 上传图片的最大像素数(超过视为异常图片, 不解码)
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "50000000"))
+# 处理结果缓存占用的最大字节数(0 表示不缓存)
+IMAGE_RENDITION_CACHE_BYTES = int(os.getenv("IMAGE_RENDITION_CACHE_BYTES", str(64 * 1024 * 1024)))
+# 图片处理进程数(0 表示改用线程, 仍不阻塞事件循环)
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 进程池之外最多排队的任务数, 以及排队等待的最长秒数(超时返回 503)
+IMAGE_POOL_QUEUE = int(os.getenv("IMAGE_POOL_QUEUE", "16"))
+IMAGE_POOL_QUEUE_TIMEOUT = float(os.getenv("IMAGE_POOL_QUEUE_TIMEOUT", "10"))
+
+# 发送给 GLM 的编码格式(JPEG 或 WEBP; WEBP 同等清晰度下体积更小, 需上游模型支持)
+IMAGE_ENCODE_FORMAT = os.getenv("IMAGE_ENCODE_FORMAT", "JPEG").upper()
+# 按字节预算编码时的清晰度下限: 质量不低于 IMAGE_MIN_QUALITY, 长边不小于 IMAGE_MIN_SIDE
+# (达到下限仍超出预算时保留下限结果, 不再继续压缩)
+IMAGE_MIN_QUALITY = int(os.getenv("IMAGE_MIN_QUALITY", "40"))
+IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", "768"))
+# 预算不足时是否允许改为灰度图(会丢失红笔批改的颜色, 默认关闭)
+IMAGE_BUDGET_GRAYSCALE = os.getenv("IMAGE_BUDGET_GRAYSCALE", "0") == "1"
+
+# 各类请求发送给 GLM 的图片字节预算(编码后字节数, 0 表示只按固定质量编码)
+IMAGE_BUDGET_OCR = int(os.getenv("IMAGE_BUDGET_OCR", str(600 * 1024)))  # 原图分辨率识别
+IMAGE_BUDGET_PAGE = int(os.getenv("IMAGE_BUDGET_PAGE", str(300 * 1024)))  # 整页高清分析(1500px)
+IMAGE_BUDGET_PREVIEW = int(os.getenv("IMAGE_BUDGET_PREVIEW", str(160 * 1024)))  # 整页快速检测(1200px)
+IMAGE_BUDGET_CHAT = int(os.getenv("IMAGE_BUDGET_CHAT", str(100 * 1024)))  # 聊天附图
+IMAGE_BUDGET_CROP = int(os.getenv("IMAGE_BUDGET_CROP", str(80 * 1024)))  # 单题裁剪图
+
+# 纯笔迹模式: 去掉阴影, 纸张纹理和背景, 只保留黑色印刷/书写和红笔批改, 编码为 3 色 PNG
+# (请求未指定 ink_only 时的默认值; 不限尺寸的请求在该模式下长边缩小到 IMAGE_INK_MAX_SIZE)
+IMAGE_INK_ONLY = os.getenv("IMAGE_INK_ONLY", "0") == "1"
+IMAGE_INK_MAX_SIZE = int(os.getenv("IMAGE_INK_MAX_SIZE", "2000"))
+# 亮度低于背景的这个比例视为笔迹
+INK_THRESHOLD = float(os.getenv("INK_THRESHOLD", "0.75"))
+# 光照校正后红色通道比绿/蓝通道高出这个量(在笔画邻域内平均)视为红笔
+INK_RED_THRESHOLD = float(os.getenv("INK_RED_THRESHOLD", "0.035"))
+# 背景估计: 按块取最亮值后在若干块的范围内平均
+INK_BACKGROUND_BLOCK = 8
+INK_BACKGROUND_RADIUS = 4
+# 调色板: 白(纸), 黑(印刷和书写), 红(批改)
+INK_PALETTE = [255, 255, 255, 0, 0, 0, 220, 0, 0]
+
+# 拼图: 把多个裁剪区域排进一张带编号的图片, 一次视觉调用分析全部区域(减少请求次数)
+# 拼图的最大宽高(像素), 以及每张拼图最多容纳的区域数(区域过多时模型容易漏看或串号)
+IMAGE_COLLAGE_WIDTH = int(os.getenv("IMAGE_COLLAGE_WIDTH", "1600"))
+IMAGE_COLLAGE_MAX_HEIGHT = int(os.getenv("IMAGE_COLLAGE_MAX_HEIGHT", "2000"))
+IMAGE_COLLAGE_MAX_CROPS = int(os.getenv("IMAGE_COLLAGE_MAX_CROPS", "6"))
+# 区域之间的间隔, 编号文字的字号(像素); 编号写在每个区域上方单独的标签条中, 不遮挡题目
+COLLAGE_GAP = 16
+COLLAGE_LABEL_SIZE = 36
+
+# 整页图片先检测纸张边界并透视校正, 裁掉桌面等背景后再缩放(检测不到纸张时按原图处理)
+IMAGE_PAGE_CROP = os.getenv("IMAGE_PAGE_CROP", "1") == "1"
+
+# 学科判断等分类调用使用的缩略图长边像素(灰度)
+IMAGE_SUBJECT_SIZE = int(os.getenv("IMAGE_SUBJECT_SIZE", "384"))
+
+# 各类视觉调用的图片规格(prepare_task_image 的参数): 分类只需看清版面和字形, 识别题目才需要看清小字,
+# 不同任务按各自需要的分辨率上传, 不为简单的分类调用上传整页大图
+IMAGE_PROFILES = {
+    # 判断学科: 灰度缩略图
+    "subject": {"max_size": IMAGE_SUBJECT_SIZE, "quality": 75, "grayscale": True},
+    # 整页快速检测(红笔批改, 试卷内容概览)
+    "marks": {"max_size": 1200, "quality": 75, "byte_budget": IMAGE_BUDGET_PREVIEW},
+    # 整页识别题目和分析
+    "page": {"max_size": 1500, "quality": 85, "byte_budget": IMAGE_BUDGET_PAGE},
+    # 原图分辨率识别(只按字节预算压缩)
+    "ocr": {"quality": 85, "byte_budget": IMAGE_BUDGET_OCR},
+    # 聊天附图(通常是一道题的照片)
+    "chat": {"max_size": 1024, "quality": 75, "byte_budget": IMAGE_BUDGET_CHAT},
+}
+
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# 超过限制的图片交给上面的检查处理, 关闭 Pillow 自带的解压炸弹告警
+Image.MAX_IMAGE_PIXELS = None
+
+
+class PreparedImage:
+    """处理完成, 可直接发送给 GLM 的图片"""
+
+    __slots__ = ("base64", "width", "height", "original_width", "original_height", "mime", "quality", "bytes")
+
+    def __init__(self, base64_data: str, width: int, height: int, original_width: int, original_height: int,
+                 mime: str = "image/jpeg", quality: int = 0):
+        self.base64 = base64_data
+        self.width = width
+        self.height = height
+        self.original_width = original_width
+        self.original_height = original_height
+        self.mime = mime
+        self.quality = quality
+        self.bytes = len(base64_data) * 3 // 4
+
+    @property
+    def data_url(self) -> str:
+        """image_url 中使用的 data URL"""
+        return f"data:{self.mime};base64,{self.base64}"
+
+
+class RenditionCache:
+    """按原图内容哈希缓存处理结果(LRU, 按 base64 字节数限制总大小)"""
+
+    def __init__(self, max_bytes: int = IMAGE_RENDITION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[PreparedImage]:
+        prepared = self._entries.get(key)
+        if prepared is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return prepared
+
+    def set(self, key: tuple, prepared: PreparedImage):
+        if len(prepared.base64) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old.base64)
+        self._entries[key] = prepared
+        self.size += len(prepared.base64)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.base64)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# 全局处理结果缓存
+rendition_cache = RenditionCache()
+
+
+def read_image_upload(base64_str: str) -> bytes:
+    """解码 base64 图片并检查文件头(格式, 尺寸), 返回原始图片字节
+
+    只读取文件头, 不解码像素; 无法识别或尺寸异常时抛出 HTTPException(400)
+    """
+    # 移除 data:image/xxx;base64, 前缀
+    if "," in base64_str:
+        base64_str = base64_str.split(",")[1]
+
+    if len(base64_str) * 3 // 4 > IMAGE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"图片过大, 请上传小于 {IMAGE_MAX_BYTES // (1024 * 1024)}MB 的图片")
+
+    try:
+        data = base64.b64decode(base64_str)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="图片数据不是有效的 base64 编码")
+
+    check_image_header(data)
+    return data
+
+
+async def read_image_file(file: UploadFile) -> bytes:
+    """读取 multipart 上传的图片文件并检查大小和文件头, 返回原始图片字节
+
+    上传内容由 Starlette 缓存在临时文件(SpooledTemporaryFile)中, 这里最多只读取 IMAGE_MAX_BYTES
+    """
+    too_large = HTTPException(status_code=413, detail=f"图片过大, 请上传小于 {IMAGE_MAX_BYTES // (1024 * 1024)}MB 的图片")
+    if file.size is not None and file.size > IMAGE_MAX_BYTES:
+        raise too_large
+
+    data = await file.read(IMAGE_MAX_BYTES + 1)
+    if len(data) > IMAGE_MAX_BYTES:
+        raise too_large
+    if not data:
+        raise HTTPException(status_code=400, detail="上传的图片为空")
+
+    check_image_header(data)
+    return data
+
+
+def check_image_header(data: bytes) -> Tuple[int, int]:
+    """读取文件头中的宽高(不解码像素), 返回 (宽, 高)"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+    except (UnidentifiedImageError, OSError):
+        raise HTTPException(status_code=400, detail="无法识别的图片格式, 请上传 JPG 或 PNG 图片")
+
+    if width <= 0 or height <= 0 or width * height > IMAGE_MAX_PIXELS:
+        raise HTTPException(status_code=400, detail=f"图片尺寸异常 ({width}x{height})")
+    return width, height
+
+
+def display_size(data: bytes) -> Tuple[int, int]:
+    """按 EXIF 方向旋转后的宽高(只读文件头, 不解码像素); 百分比坐标按这个宽高换算"""
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        orientation = image.getexif().get(0x0112, 1)
+    return (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+
+
+def fit_size(width: int, height: int, box: Tuple[int, int]) -> Tuple[int, int]:
+    """按比例缩放到 box 以内的尺寸(不放大)"""
+    ratio = min(box[0] / width, box[1] / height, 1.0)
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+
+def load_image(data: bytes, max_size: Optional[int] = None, box: Optional[Tuple[int, int]] = None,
+               resize_over_pixels: int = 0) -> Tuple[Image.Image, Tuple[int, int]]:
+    """解码图片并缩放到目标尺寸以内, 返回 (RGB 图片, 原始宽高)
+
+    Args:
+        data: 原始图片字节
+        max_size: 长边上限
+        box: 宽高上限 (宽, 高), 与 max_size 同时给出时取 box
+        resize_over_pixels: 原图像素数超过该值时才缩放(0 表示只要超过目标尺寸就缩放)
+    """
+    image = Image.open(io.BytesIO(data))
+    original_size = image.size
+    if box is None and max_size:
+        box = (max_size, max_size)
+
+    target = None
+    if box and original_size[0] * original_size[1] > resize_over_pixels:
+        # EXIF 旋转 90 度的照片, 文件中的宽高与显示时相反
+        orientation = image.getexif().get(0x0112, 1)
+        stored_box = (box[1], box[0]) if orientation in (5, 6, 7, 8) else box
+        target = fit_size(*original_size, stored_box)
+        if target == original_size:
+            target = None
+
+    if target and image.format == "JPEG":
+        # JPEG 按 1/2, 1/4, 1/8 比例直接降采样解码, 不必先解码出完整的大图
+        image.draft("RGB", target)
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    if target:
+        new_size = fit_size(*image.size, box)
+        if new_size != image.size:
+            image = image.resize(new_size)
+    return image, original_size
+
+
+def load_page(data: bytes, max_size: Optional[int] = None, box: Optional[Tuple[int, int]] = None,
+              resize_over_pixels: int = 0) -> Tuple[Image.Image, Tuple[int, int]]:
+    """解码图片, 裁剪到纸张并透视校正后缩放到目标尺寸以内(参数同 load_image)
+
+    先在小图上检测纸张(JPEG 按 1/8 降采样解码, 很快), 检测不到时与 load_image 结果相同;
+    检测到时按纸张占画面的比例放大解码尺寸, 校正后纸张本身仍能达到目标尺寸
+    """
+    from page_detector import PAGE_ANALYSIS_SIZE, detect_page, page_size, warp_page
+
+    preview, _ = load_image(data, max_size=PAGE_ANALYSIS_SIZE)
+    corners = detect_page(preview)
+    if corners is None:
+        return load_image(data, max_size=max_size, box=box, resize_over_pixels=resize_over_pixels)
+
+    if box is None and max_size:
+        box = (max_size, max_size)
+    decode_box = None
+    if box:
+        factor = max(preview.size) / max(page_size(corners))
+        decode_box = (int(box[0] * factor) + 1, int(box[1] * factor) + 1)
+    image, original_size = load_image(data, box=decode_box, resize_over_pixels=resize_over_pixels)
+    if original_size[0] * original_size[1] <= resize_over_pixels:
+        box = None
+    scale = image.width / preview.width
+    return warp_page(image, [(x * scale, y * scale) for x, y in corners], box), original_size
+
+
+def encode_bytes(image: Image.Image, quality: int = 85, image_format: str = "JPEG") -> bytes:
+    """将图片编码为 JPEG/WEBP 字节"""
+    buffered = io.BytesIO()
+    image.save(buffered, format=image_format, quality=quality)
+    return buffered.getvalue()
+
+
+def encode_image(image: Image.Image, quality: int = 85, image_format: str = "JPEG") -> str:
+    """将图片编码为 base64 JPEG/WEBP"""
+    return base64.b64encode(encode_bytes(image, quality, image_format)).decode()
+
+
+def search_quality(image: Image.Image, byte_budget: int, max_quality: int, image_format: str):
+    """在 [IMAGE_MIN_QUALITY, max_quality] 中二分查找编码后不超过预算的最高质量(步长 5)
+
+    返回 (质量, 编码字节); 最低质量仍超出预算时返回 (None, 最低质量的编码字节)
+    """
+    qualities = list(range(min(IMAGE_MIN_QUALITY, max_quality), max_quality + 1, 5))
+    if qualities[-1] != max_quality:
+        qualities.append(max_quality)
+
+    best = None
+    smallest = None
+    low, high = 0, len(qualities) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        encoded = encode_bytes(image, qualities[middle], image_format)
+        if len(encoded) <= byte_budget:
+            best = (qualities[middle], encoded)
+            low = middle + 1
+        else:
+            if middle == 0:
+                smallest = encoded
+            high = middle - 1
+    return best if best else (None, smallest)
+
+
+def encode_to_budget(image: Image.Image, byte_budget: int, max_quality: int, image_format: str = "JPEG"):
+    """在字节预算内编码: 先降质量, 最低质量仍超出预算时按比例缩小尺寸再查找, 最后可改为灰度
+
+    清晰度下限(IMAGE_MIN_QUALITY, IMAGE_MIN_SIDE)优先于预算; 返回 (编码字节, 质量, 编码所用图片)
+    """
+    source = image
+    for attempt in range(4):
+        quality, encoded = search_quality(image, byte_budget, max_quality, image_format)
+        if quality is not None:
+            return encoded, quality, image
+
+        long_side = max(image.size)
+        if long_side <= IMAGE_MIN_SIDE or attempt == 3:
+            break
+        # 编码体积约与像素数成正比, 按面积比例缩小(略多缩一点, 减少重复查找)
+        ratio = (byte_budget / len(encoded)) ** 0.5 * 0.95
+        target = max(IMAGE_MIN_SIDE, int(long_side * ratio))
+        image = source.resize(fit_size(*source.size, (target, target)))
+
+    if IMAGE_BUDGET_GRAYSCALE and image.mode != "L":
+        quality, gray_encoded = search_quality(image.convert("L"), byte_budget, max_quality, image_format)
+        if quality is not None:
+            return gray_encoded, quality, image.convert("L")
+        if len(gray_encoded) < len(encoded):
+            return gray_encoded, IMAGE_MIN_QUALITY, image.convert("L")
+    return encoded, min(IMAGE_MIN_QUALITY, max_quality), image
+
+
+def box_mean(values: np.ndarray, radius: int) -> np.ndarray:
+    """(2 * radius + 1) 见方窗口内的均值(积分图, 边缘处按窗口内实际像素数计算)"""
+    height, width = values.shape
+    integral = np.zeros((height + 1, width + 1))
+    integral[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    y0 = np.clip(np.arange(height) - radius, 0, height)
+    y1 = np.clip(np.arange(height) + radius + 1, 0, height)
+    x0 = np.clip(np.arange(width) - radius, 0, width)
+    x1 = np.clip(np.arange(width) + radius + 1, 0, width)
+    window_sum = integral[y1][:, x1] - integral[y0][:, x1] - integral[y1][:, x0] + integral[y0][:, x0]
+    return window_sum / ((y1 - y0)[:, None] * (x1 - x0)[None, :])
+
+
+def estimate_background(channel: np.ndarray) -> np.ndarray:
+    """估计纸张背景亮度(光照不均, 阴影): 按块取最亮值, 块间平滑后插值回原尺寸"""
+    height, width = channel.shape
+    block = INK_BACKGROUND_BLOCK
+    if height < block or width < block:
+        return np.full_like(channel, channel.max())
+    trimmed = channel[:height // block * block, :width // block * block]
+    blocks = trimmed.reshape(height // block, block, width // block, block).max(axis=(1, 3))
+    smooth = box_mean(blocks, INK_BACKGROUND_RADIUS).astype(np.float32)
+    return np.asarray(Image.fromarray(smooth).resize((width, height), Image.BILINEAR), dtype=np.float64)
+
+
+def ink_only_image(image: Image.Image) -> Image.Image:
+    """光照校正 + 自适应阈值, 返回只含白/黑/红三色的调色板图片"""
+    rgb = np.asarray(image.convert("RGB"), dtype=np.float64)
+    # 各通道除以各自的背景估计: 同时校正阴影和偏色
+    normalized = np.stack([
+        np.clip(rgb[..., i] / np.maximum(estimate_background(rgb[..., i]), 1), 0, 1) for i in range(3)
+    ], axis=-1)
+    ink = normalized.mean(axis=-1) < INK_THRESHOLD
+
+    # 照片中的红笔常偏暗, 单个像素的红色偏移与黑色笔画的色边差不多, 按笔画邻域平均后再判断
+    redness = normalized[..., 0] - np.maximum(normalized[..., 1], normalized[..., 2])
+    ink_weight = ink.astype(np.float64)
+    local_redness = box_mean(redness * ink_weight, 3) / np.maximum(box_mean(ink_weight, 3), 1e-6)
+
+    palette_index = np.zeros(ink.shape, dtype=np.uint8)
+    palette_index[ink] = 1
+    palette_index[ink & (local_redness > INK_RED_THRESHOLD)] = 2
+    result = Image.fromarray(palette_index, "P")
+    result.putpalette(INK_PALETTE)
+    return result
+
+
+def encode_png(image: Image.Image) -> bytes:
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG", optimize=True, bits=2)
+    return buffered.getvalue()
+
+
+def render_image(data: bytes, max_size: Optional[int], quality: int, box: Optional[Tuple[int, int]],
+                 resize_over_pixels: int, byte_budget: int = 0, image_format: str = IMAGE_ENCODE_FORMAT,
+                 ink_only: bool = False, page_crop: bool = False, grayscale: bool = False) -> tuple:
+    """解码, 缩放, 编码(在进程池中执行), 返回 (base64, 宽, 高, 原始宽, 原始高, MIME 类型, 质量)
+
+    byte_budget > 0 时在预算内查找质量和尺寸, quality 为质量上限;
+    ink_only 时输出纯笔迹 PNG(无损, 不使用质量和字节预算);
+    page_crop 时先裁剪到纸张并透视校正; grayscale 时输出灰度图
+    """
+    load = load_page if page_crop else load_image
+    image, original_size = load(data, max_size=max_size, box=box, resize_over_pixels=resize_over_pixels)
+    if grayscale and not ink_only:
+        image = image.convert("L")
+    if ink_only:
+        image = ink_only_image(image)
+        return (base64.b64encode(encode_png(image)).decode(), image.width, image.height, *original_size,
+                IMAGE_MIME_TYPES["PNG"], 0)
+    if byte_budget > 0:
+        encoded, quality, image = encode_to_budget(image, byte_budget, quality, image_format)
+    else:
+        encoded = encode_bytes(image, quality, image_format)
+    return (base64.b64encode(encoded).decode(), image.width, image.height, *original_size,
+            IMAGE_MIME_TYPES[image_format], quality)
+
+
+def crop_box(size: Tuple[int, int], box: dict, padding: float = 0) -> Tuple[int, int, int, int]:
+    """把百分比坐标框 {"x", "y", "width", "height"} 换算为像素坐标 (x0, y0, x1, y1), 四周加 padding(百分比)"""
+    width, height = size
+    x0 = max(0.0, float(box.get("x", 0)) - padding) / 100 * width
+    y0 = max(0.0, float(box.get("y", 0)) - padding) / 100 * height
+    x1 = min(100.0, float(box.get("x", 0)) + float(box.get("width", 0)) + padding) / 100 * width
+    y1 = min(100.0, float(box.get("y", 0)) + float(box.get("height", 0)) + padding) / 100 * height
+    x0, y0 = min(int(x0), width - 1), min(int(y0), height - 1)
+    return x0, y0, max(x0 + 1, int(x1)), max(y0 + 1, int(y1))
+
+
+def render_crops(data: bytes, boxes: List[dict], max_size: int, quality: int, padding: float,
+                 byte_budget: int = 0, image_format: str = IMAGE_ENCODE_FORMAT, ink_only: bool = False) -> List[tuple]:
+    """解码一次, 按百分比坐标裁出多个区域并分别缩放, 编码(在进程池中执行)
+
+    返回与 boxes 一一对应的 render_image 格式结果; byte_budget 为每个区域的字节预算
+    """
+    image, original_size = load_image(data)
+    results = []
+    for box in boxes:
+        crop = image.crop(crop_box(image.size, box, padding))
+        new_size = fit_size(*crop.size, (max_size, max_size))
+        if new_size != crop.size:
+            crop = crop.resize(new_size)
+        crop_quality = quality
+        if ink_only:
+            crop = ink_only_image(crop)
+            results.append((base64.b64encode(encode_png(crop)).decode(), crop.width, crop.height, *original_size,
+                            IMAGE_MIME_TYPES["PNG"], 0))
+            continue
+        if byte_budget > 0:
+            encoded, crop_quality, crop = encode_to_budget(crop, byte_budget, quality, image_format)
+        else:
+            encoded = encode_bytes(crop, quality, image_format)
+        results.append((base64.b64encode(encoded).decode(), crop.width, crop.height, *original_size,
+                        IMAGE_MIME_TYPES[image_format], crop_quality))
+    return results
+
+
+def collage_label_height() -> int:
+    return COLLAGE_LABEL_SIZE + COLLAGE_GAP // 2
+
+
+def pack_collages(sizes: List[Tuple[int, int]]) -> List[List[Tuple[int, int, int, int, int]]]:
+    """把若干 (宽, 高) 的区域按货架算法排进一张或多张拼图
+
+    按高度从高到低依次放入当前一行, 放不下时另起一行, 拼图高度或区域数达到上限时另起一张.
+    Returns:
+        [[(区域序号, x, y, 宽, 高), ...], ...]  # 每张拼图中各区域(含上方标签条)的位置
+    """
+    label_height = collage_label_height()
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    collages, current = [], []
+    x, y, shelf_height = COLLAGE_GAP, COLLAGE_GAP, 0
+    for index in order:
+        # 标签条至少容纳 "[12]" 这样的编号
+        width = max(sizes[index][0], COLLAGE_LABEL_SIZE * 3)
+        height = sizes[index][1] + label_height
+        if x + width + COLLAGE_GAP > IMAGE_COLLAGE_WIDTH:
+            x, y, shelf_height = COLLAGE_GAP, y + shelf_height + COLLAGE_GAP, 0
+        if current and (len(current) >= IMAGE_COLLAGE_MAX_CROPS or y + height + COLLAGE_GAP > IMAGE_COLLAGE_MAX_HEIGHT):
+            collages.append(current)
+            current = []
+            x, y, shelf_height = COLLAGE_GAP, COLLAGE_GAP, 0
+        current.append((index, x, y, sizes[index][0], sizes[index][1]))
+        x += width + COLLAGE_GAP
+        shelf_height = max(shelf_height, height)
+    if current:
+        collages.append(current)
+    return collages
+
+
+def collage_layout(image_size: Tuple[int, int], boxes: List[dict], max_size: int,
+                   padding: float) -> List[List[Tuple[int, int, int, int, int]]]:
+    """按原图宽高计算各区域缩放后的尺寸并排版(只用文件头中的宽高, 不解码像素)"""
+    limit = (min(max_size, IMAGE_COLLAGE_WIDTH - 2 * COLLAGE_GAP),
+             min(max_size, IMAGE_COLLAGE_MAX_HEIGHT - 2 * COLLAGE_GAP - collage_label_height()))
+    sizes = []
+    for box in boxes:
+        x0, y0, x1, y1 = crop_box(image_size, box, padding)
+        sizes.append(fit_size(x1 - x0, y1 - y0, limit))
+    return pack_collages(sizes)
+
+
+def render_collages(data: bytes, boxes: List[dict], layouts: List[list], quality: int, padding: float,
+                    byte_budget: int = 0, image_format: str = IMAGE_ENCODE_FORMAT, ink_only: bool = False) -> List[tuple]:
+    """解码一次, 按 collage_layout 的排版把各区域裁剪缩放后拼成带编号的图片, 编码(在进程池中执行)
+
+    区域的编号为其在 boxes 中的序号 + 1; 返回与 layouts 一一对应的 render_image 格式结果,
+    byte_budget 为每个区域的字节预算(一张拼图的预算按其中的区域数累加)
+    """
+    image, original_size = load_image(data)
+    font = ImageFont.load_default(size=COLLAGE_LABEL_SIZE)
+    label_height = collage_label_height()
+    results = []
+    for layout in layouts:
+        width = max(x + max(w, COLLAGE_LABEL_SIZE * 3) for _, x, _, w, _ in layout) + COLLAGE_GAP
+        height = max(y + label_height + h for _, _, y, _, h in layout) + COLLAGE_GAP
+        # 纯笔迹模式直接在 3 色调色板上拼接(0 白, 1 黑), 其余为 RGB
+        if ink_only:
+            canvas = Image.new("P", (width, height), 0)
+            canvas.putpalette(INK_PALETTE)
+            text_color, border_color = 1, 1
+        else:
+            canvas = Image.new("RGB", (width, height), (255, 255, 255))
+            text_color, border_color = (0, 0, 0), (160, 160, 160)
+        draw = ImageDraw.Draw(canvas)
+        for index, x, y, w, h in layout:
+            crop = image.crop(crop_box(image.size, boxes[index], padding))
+            if crop.size != (w, h):
+                crop = crop.resize((w, h))
+            crop = ink_only_image(crop) if ink_only else crop.convert("RGB")
+            draw.text((x, y), f"[{index + 1}]", fill=text_color, font=font)
+            canvas.paste(crop, (x, y + label_height))
+            draw.rectangle((x - 1, y + label_height - 1, x + w, y + label_height + h), outline=border_color)
+
+        if ink_only:
+            results.append((base64.b64encode(encode_png(canvas)).decode(), canvas.width, canvas.height, *original_size,
+                            IMAGE_MIME_TYPES["PNG"], 0))
+            continue
+        collage_quality = quality
+        if byte_budget > 0:
+            encoded, collage_quality, canvas = encode_to_budget(canvas, byte_budget * len(layout), quality, image_format)
+        else:
+            encoded = encode_bytes(canvas, quality, image_format)
+        results.append((base64.b64encode(encoded).decode(), canvas.width, canvas.height, *original_size,
+                        IMAGE_MIME_TYPES[image_format], collage_quality))
+    return results
+
+
+# ==================== 进程池 ====================
+
+class ImageWorkerPool:
+    """图片处理进程池
+
+    同时提交的任务数限制为 进程数 + IMAGE_POOL_QUEUE, 超出的请求在这里等待(反压),
+    等待超过 IMAGE_POOL_QUEUE_TIMEOUT 秒返回 503, 避免上传高峰时无限堆积.
+    名额在任务实际结束时归还: 调用方被取消(如客户端断开)时, 已开始执行的任务仍占用名额直到完成
+    """
+
+    def __init__(self, workers: int = IMAGE_POOL_WORKERS, queue_size: int = IMAGE_POOL_QUEUE,
+                 queue_timeout: float = IMAGE_POOL_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.capacity = max(1, workers) + max(0, queue_size)
+        self.queue_timeout = queue_timeout
+        self.submitted = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._slots = None
+        self._executor = None
+
+    async def run(self, func, *args):
+        """在进程池中执行 func(*args)"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.capacity)
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="图片处理繁忙, 请稍后重试")
+        finally:
+            self.waiting -= 1
+
+        self.submitted += 1
+        self.in_flight += 1
+        loop = asyncio.get_running_loop()
+        try:
+            if self._executor is None:
+                # 进程数为 0 时在线程中执行(调试, 测试)
+                self._executor = (ProcessPoolExecutor(max_workers=self.workers) if self.workers > 0
+                                  else ThreadPoolExecutor(max_workers=self.capacity))
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._finish()
+            raise
+
+        def on_done(_):
+            try:
+                loop.call_soon_threadsafe(self._finish)
+            except RuntimeError:
+                # 事件循环已关闭
+                self._finish()
+
+        future.add_done_callback(on_done)
+        # 取消等待时会尝试取消尚未开始的任务; 已开始的任务继续执行, 结束后才归还名额
+        return await asyncio.wrap_future(future)
+
+    def _finish(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "submitted": self.submitted,
+            "rejected": self.rejected
+        }
+
+
+# 全局图片处理进程池
+image_pool = ImageWorkerPool()
+
+
+async def prepare_image(data: bytes, max_size: Optional[int] = None, quality: int = 85, box: Optional[Tuple[int, int]] = None,
+                        resize_over_pixels: int = 0, byte_budget: int = 0, ink_only: bool = False,
+                        page_crop: bool = False, grayscale: bool = False) -> PreparedImage:
+    """解码, 缩放, 编码一次完成, 返回可直接发送给 GLM 的图片
+
+    byte_budget > 0 时按字节预算编码(quality 为质量上限), 实际大小和质量见 PreparedImage.bytes/quality.
+    ink_only 时输出纯笔迹 PNG.
+    page_crop 时先裁掉纸张以外的背景(仅用于整页图片, 且提示词中没有按原图给出的位置坐标; IMAGE_PAGE_CROP 关闭时忽略).
+    grayscale 时输出灰度图(纯笔迹模式下忽略).
+    同一张图片以相同参数处理过时直接返回缓存结果, 否则交给进程池处理
+    """
+    if ink_only and not max_size and not box:
+        max_size = IMAGE_INK_MAX_SIZE
+    page_crop = page_crop and IMAGE_PAGE_CROP
+    key = (hashlib.sha256(data).hexdigest(), max_size, quality, box, resize_over_pixels, byte_budget, IMAGE_ENCODE_FORMAT,
+           ink_only, page_crop, grayscale)
+    if rendition_cache.max_bytes > 0:
+        prepared = rendition_cache.get(key)
+        if prepared is not None:
+            return prepared
+
+    prepared = PreparedImage(*await image_pool.run(
+        render_image, data, max_size, quality, box, resize_over_pixels, byte_budget, IMAGE_ENCODE_FORMAT, ink_only,
+        page_crop, grayscale
+    ))
+    if ink_only:
+        print(f"[图片处理] 纯笔迹模式: {prepared.width}x{prepared.height}, {prepared.bytes // 1024}KB")
+    elif byte_budget > 0:
+        print(f"[图片处理] 预算 {byte_budget // 1024}KB: {prepared.width}x{prepared.height}, "
+              f"质量 {prepared.quality}, {prepared.bytes // 1024}KB")
+    if rendition_cache.max_bytes > 0:
+        rendition_cache.set(key, prepared)
+    return prepared
+
+
+async def prepare_task_image(data: bytes, task: str, **overrides) -> PreparedImage:
+    """按 IMAGE_PROFILES 中该任务的规格处理图片; overrides 覆盖规格中的参数(如 ink_only, page_crop)"""
+    return await prepare_image(data, **{**IMAGE_PROFILES[task], **overrides})
+
+
+async def prepare_crops(data: bytes, boxes: List[dict], max_size: int = 800, quality: int = 85,
+                        padding: float = 0, byte_budget: int = 0, ink_only: bool = False) -> List[PreparedImage]:
+    """裁出多个区域, 返回与 boxes 一一对应的图片; 已缓存的区域直接返回, 其余在进程池中一次解码完成"""
+    digest = hashlib.sha256(data).hexdigest()
+    keys = [
+        (digest, "crop", tuple(box.get(field) for field in ("x", "y", "width", "height")), max_size, quality, padding,
+         byte_budget, IMAGE_ENCODE_FORMAT, ink_only)
+        for box in boxes
+    ]
+    results = [rendition_cache.get(key) if rendition_cache.max_bytes > 0 else None for key in keys]
+
+    missing = [i for i, prepared in enumerate(results) if prepared is None]
+    if missing:
+        rendered = await image_pool.run(
+            render_crops, data, [boxes[i] for i in missing], max_size, quality, padding, byte_budget, IMAGE_ENCODE_FORMAT,
+            ink_only
+        )
+        for i, values in zip(missing, rendered):
+            results[i] = PreparedImage(*values)
+            if rendition_cache.max_bytes > 0:
+                rendition_cache.set(keys[i], results[i])
+    return results
+
+
+async def prepare_collages(data: bytes, boxes: List[dict], max_size: int = 800, quality: int = 85, padding: float = 0,
+                           byte_budget: int = 0, ink_only: bool = False) -> List[Tuple[PreparedImage, List[int]]]:
+    """把多个区域拼成一张或多张带编号的图片(编号为区域在 boxes 中的序号 + 1)
+
+    Returns:
+        [(拼图, [其中各区域在 boxes 中的序号, ...]), ...]
+    """
+    layouts = collage_layout(display_size(data), boxes, max_size, padding)
+    digest = hashlib.sha256(data).hexdigest()
+    box_keys = tuple(tuple(box.get(field) for field in ("x", "y", "width", "height")) for box in boxes)
+    keys = [
+        (digest, "collage", box_keys, tuple(layout), quality, padding, byte_budget, IMAGE_ENCODE_FORMAT, ink_only)
+        for layout in layouts
+    ]
+    results = [rendition_cache.get(key) if rendition_cache.max_bytes > 0 else None for key in keys]
+
+    missing = [i for i, prepared in enumerate(results) if prepared is None]
+    if missing:
+        rendered = await image_pool.run(
+            render_collages, data, boxes, [layouts[i] for i in missing], quality, padding, byte_budget,
+            IMAGE_ENCODE_FORMAT, ink_only
+        )
+        for i, values in zip(missing, rendered):
+            results[i] = PreparedImage(*values)
+            if rendition_cache.max_bytes > 0:
+                rendition_cache.set(keys[i], results[i])
+    return [(prepared, [item[0] for item in layout]) for prepared, layout in zip(results, layouts)]
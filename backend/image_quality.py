@@ -0,0 +1,150 @@
+"""
+本地图片质量检查
+在调用 GLM 之前用约 0.1 秒检查拍照质量: 拉普拉斯响应判断是否失焦/抖动, 灰度直方图判断
+过暗, 过曝和反光, 文本行高判断文字在原图中的有效分辨率. 明显无法识别的照片直接提示
+学生重拍, 不再花费一次(或多次)视觉模型调用; 勉强可用的照片继续处理并给出提示
+"""
+
+import os
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_pipeline import load_image
+from page_segmenter import binarize, split_columns, text_lines
+
+# ==================== 配置 ====================
+
+# 质量检查模式: reject(严重问题拒绝请求, 轻微问题提示), warn(只提示), off(关闭)
+QUALITY_GATE = os.getenv("QUALITY_GATE", "reject").lower()
+# 检查时把图片缩小到的长边像素(清晰度按这个尺寸计算, 与原图分辨率无关)
+QUALITY_ANALYSIS_SIZE = int(os.getenv("QUALITY_ANALYSIS_SIZE", "1000"))
+# 清晰度: 边缘处拉普拉斯响应(99.5 分位)与画面对比度之比; 清晰的照片约 1.5-3,
+# 轻微失焦约 1, 低于拒绝阈值时文字已糊成一片
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", "0.25"))
+QUALITY_WARN_SHARPNESS = float(os.getenv("QUALITY_WARN_SHARPNESS", "0.6"))
+# 亮度: 灰度中位数低于该值视为偏暗; 最亮的 1% 像素也低于拒绝阈值时视为几乎全黑
+QUALITY_DARK_MEDIAN = int(os.getenv("QUALITY_DARK_MEDIAN", "60"))
+QUALITY_MIN_HIGHLIGHT = int(os.getenv("QUALITY_MIN_HIGHLIGHT", "40"))
+# 反光: 纸面不是纯白(拍摄的照片)时, 过曝像素占比超过该值视为有反光
+QUALITY_GLARE_RATIO = float(os.getenv("QUALITY_GLARE_RATIO", "0.03"))
+# 过曝: 过曝像素占比超过该值且几乎没有深色笔迹时视为文字被冲淡
+QUALITY_WASHED_RATIO = float(os.getenv("QUALITY_WASHED_RATIO", "0.6"))
+# 对比度: 1 分位与 99 分位灰度之差低于该值视为对比度过低
+QUALITY_MIN_CONTRAST = int(os.getenv("QUALITY_MIN_CONTRAST", "60"))
+# 有效分辨率: 文本行在原图中的高度(像素), 低于拒绝阈值时文字无法辨认
+QUALITY_MIN_LINE_HEIGHT = float(os.getenv("QUALITY_MIN_LINE_HEIGHT", "8"))
+QUALITY_WARN_LINE_HEIGHT = float(os.getenv("QUALITY_WARN_LINE_HEIGHT", "14"))
+
+# 过曝/全黑的灰度界限, 深色笔迹的灰度上限
+CLIPPED_HIGH = 250
+INK_LEVEL = 128
+# 几乎没有笔迹: 深色像素占比低于该值
+MIN_INK_RATIO = 0.005
+
+
+# ==================== 指标 ====================
+
+def laplacian(gray: np.ndarray) -> np.ndarray:
+    """4 邻域拉普拉斯算子(不含边缘一圈像素)"""
+    return (4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1]
+            - gray[1:-1, :-2] - gray[1:-1, 2:])
+
+
+def histogram_percentiles(values: np.ndarray, percentiles) -> np.ndarray:
+    """非负整数数组的分位数(用直方图计算, 比 np.percentile 排序快得多)"""
+    cumulative = np.cumsum(np.bincount(values.ravel()))
+    return np.searchsorted(cumulative, np.asarray(percentiles) / 100 * (cumulative[-1] - 1), side="right")
+
+
+def median_line_height(image: Image.Image) -> float:
+    """图中文本行高的中位数(像素), 找不到文本行时返回 0"""
+    ink = binarize(image)
+    heights = []
+    for col_start, col_end in split_columns(ink):
+        heights.extend(y1 - y0 for y0, y1, _, _ in text_lines(ink[:, col_start:col_end]))
+    return float(np.median(heights)) if heights else 0.0
+
+
+def measure_quality(data: bytes) -> dict:
+    """计算质量指标(在进程池中执行)"""
+    image, original_size = load_image(data, max_size=QUALITY_ANALYSIS_SIZE)
+    return measure_image_quality(image, original_size)
+
+
+def measure_image_quality(image: Image.Image, original_size: Tuple[int, int]) -> dict:
+    """在已解码的分析图(长边不超过 QUALITY_ANALYSIS_SIZE)上计算质量指标, original_size 为原图宽高"""
+    original_width, original_height = original_size
+    gray = np.asarray(image.convert("L"))
+    response = np.abs(laplacian(gray.astype(np.int16)))
+    p1, p5, p50, p95, p99 = histogram_percentiles(gray, [1, 5, 50, 95, 99])
+    # 清晰度按文字与纸面的灰度跨度归一化, 不受光线明暗影响
+    sharpness = histogram_percentiles(response, [99.5])[0] / max(p95 - p5, 1)
+    scale = max(original_width, original_height) / max(image.size)
+
+    return {
+        "width": original_width,
+        "height": original_height,
+        "laplacian_variance": round(float(response.var()), 1),
+        "sharpness": round(float(sharpness), 3),
+        "median": int(p50),
+        "highlight": int(p99),
+        "contrast": int(p99 - p1),
+        "clipped_ratio": round(float((gray >= CLIPPED_HIGH).mean()), 4),
+        "ink_ratio": round(float((gray < INK_LEVEL).mean()), 4),
+        "line_height": round(median_line_height(image) * scale, 1)
+    }
+
+
+# ==================== 检查入口 ====================
+
+def assess_quality(data: bytes) -> dict:
+    """检查试卷照片质量(在进程池中执行)
+
+    Returns:
+        {
+            "ok": 是否可以继续处理(没有严重问题),
+            "issues": ["图片模糊...", ...],  # 严重问题, 按 QUALITY_GATE 拒绝请求
+            "warnings": ["图片偏暗...", ...],  # 轻微问题, 只提示
+            "metrics": {...}
+        }
+    """
+    return judge_quality(measure_quality(data))
+
+
+def judge_quality(metrics: dict) -> dict:
+    """按质量指标给出 assess_quality 格式的检查结果"""
+    issues: List[str] = []
+    warnings: List[str] = []
+
+    washed_out = metrics["clipped_ratio"] > QUALITY_WASHED_RATIO and metrics["ink_ratio"] < MIN_INK_RATIO
+    if washed_out:
+        issues.append("图片过曝, 文字被冲淡, 请避开强光重新拍摄")
+    elif metrics["median"] < CLIPPED_HIGH and metrics["clipped_ratio"] > QUALITY_GLARE_RATIO:
+        # 纸面不是纯白说明是照片, 其中的纯白区域多为灯光反光
+        warnings.append("图片有反光, 反光处的文字可能无法识别")
+
+    if metrics["highlight"] < QUALITY_MIN_HIGHLIGHT:
+        issues.append("图片太暗, 请在光线充足的地方重新拍摄")
+    elif metrics["median"] < QUALITY_DARK_MEDIAN:
+        warnings.append("图片偏暗, 识别结果可能不准确")
+
+    # 过曝的图片没有边缘, 不再重复报告模糊
+    sharpness = metrics["sharpness"]
+    if sharpness < QUALITY_MIN_SHARPNESS and not washed_out:
+        issues.append("图片模糊, 文字无法辨认, 请对焦后保持手机稳定重新拍摄")
+    elif QUALITY_MIN_SHARPNESS <= sharpness < QUALITY_WARN_SHARPNESS:
+        warnings.append("图片有些模糊, 识别结果可能不准确")
+
+    if metrics["contrast"] < QUALITY_MIN_CONTRAST:
+        warnings.append("图片对比度过低, 识别结果可能不准确")
+
+    line_height = metrics["line_height"]
+    if line_height:
+        if line_height < QUALITY_MIN_LINE_HEIGHT:
+            issues.append("图片分辨率过低, 文字太小无法辨认, 请靠近试卷或拍摄原图")
+        elif line_height < QUALITY_WARN_LINE_HEIGHT:
+            warnings.append("图片中的文字较小, 识别结果可能不准确")
+
+    return {"ok": not issues, "issues": issues, "warnings": warnings, "metrics": metrics}
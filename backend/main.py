@@ -3,24 +3,18 @@ AI Study Companion - 后端服务
 提供 OCR 识别, 题目分析等 API
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
-import base64
-import io
 import json
 import re
-import requests
-from PIL import Image
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, PrivateAttr
+from typing import Dict, List, Optional
 import numpy as np
 import asyncio
-import threading
 import time
 import sys
-from queue import Queue
 from functools import wraps
 
 # ==================== 导入智能分析模块 ====================
@@ -37,37 +31,42 @@ from dotenv import load_dotenv
 # 加载环境变量
 load_dotenv()
 
-# 从环境变量读取API Key（如果没有则使用默认值）
-GLM_API_KEY = os.getenv("GLM_API_KEY", "5f53890e74fa465a8ad1a95409db864c.roWm4OnFKpTIIdDJ")
-GLM_API_URL = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
-
-# 检查API Key是否为默认值
-if GLM_API_KEY == "5f53890e74fa465a8ad1a95409db864c.roWm4OnFKpTIIdDJ":
-    print("=" * 60)
-    print("⚠️  警告: 使用默认的GLM API Key")
-    print("如需使用自己的API Key，请创建 backend/.env 文件:")
-    print("  GLM_API_KEY=your_api_key_here")
-    print("=" * 60)
+# GLM API 客户端(异步连接池, 需在 load_dotenv 之后导入以读取 .env 配置)
+from glm_client import (
+    call_glm_api,
+    stream_glm_api,
+    close_http_client,
+    get_client_stats,
+    get_hedge_stats,
+    response_cache,
+    scheduler,
+    breaker,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_BULK
+)
 
-# ==================== API 请求队列 ====================
-from concurrent.futures import ThreadPoolExecutor
-
-# 创建请求队列
-request_queue = Queue()
-# 请求处理线程池(处理队列中的请求)
-queue_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="glm_api_queue")
-# 请求锁(确保同时只有1个GLM API调用)
-glm_api_lock = threading.Lock()
-# 请求ID计数器
-request_counter = 0
-request_counter_lock = threading.Lock()
-
-def get_request_id():
-    """生成唯一的请求ID"""
-    global request_counter
-    with request_counter_lock:
-        request_counter += 1
-        return request_counter
+# 本地图像处理和缓存模块(同样在模块加载时读取配置, 需在 load_dotenv 之后导入)
+from question_cache import question_cache
+from mark_detector import describe_marks
+from image_quality import QUALITY_GATE
+from paper_index import paper_index
+from page_analysis import analyze_page
+from ocr_tiles import OCR_TILE_SIZE, merge_tile_questions, should_tile, tile_boxes
+from image_pipeline import (
+    read_image_upload,
+    read_image_file,
+    check_image_header,
+    prepare_task_image,
+    prepare_crops,
+    prepare_collages,
+    display_size,
+    rendition_cache,
+    image_pool,
+    IMAGE_MAX_BYTES,
+    IMAGE_BUDGET_PAGE,
+    IMAGE_BUDGET_CROP,
+    IMAGE_INK_ONLY
+)
 
 # ==================== 创建 FastAPI 应用 ====================
 app = FastAPI(
@@ -85,20 +84,68 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def shutdown_glm_client():
+    """应用退出时关闭 GLM 连接池和图片处理进程池"""
+    await close_http_client()
+    image_pool.shutdown()
+
+# multipart 上传端点: 请求体(图片 + 表单字段)超过上限时在解析前直接拒绝
+UPLOAD_FORM_OVERHEAD = 1024 * 1024
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    if request.url.path.endswith("/upload"):
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > IMAGE_MAX_BYTES + UPLOAD_FORM_OVERHEAD:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"图片过大, 请上传小于 {IMAGE_MAX_BYTES // (1024 * 1024)}MB 的图片"}
+            )
+    return await call_next(request)
+
 # ==================== 数据模型 ====================
-class OCRRequest(BaseModel):
+class ImageRequest(BaseModel):
+    """带图片的请求: JSON 中的 base64 图片, 或 multipart 上传的图片文件"""
+    user_id: Optional[str] = None  # 用户标识(可选, 用于识别同一用户重复上传的试卷)
+    ink_only: Optional[bool] = None  # 是否只发送去除背景的纯笔迹图(为空时按 IMAGE_INK_ONLY 配置)
+    tiled: Optional[bool] = None  # 试卷识别是否分块并发识别(为空时按 OCR_TILE_MODE 配置)
+    _image_bytes: Optional[bytes] = PrivateAttr(default=None)
+    _analysis: dict = PrivateAttr(default_factory=dict)  # 本地图片分析结果(见 run_page_analysis)
+    _quality_warnings: List[str] = PrivateAttr(default_factory=list)  # check_paper_quality 返回的提示
+
+    @classmethod
+    def from_upload(cls, image_bytes: Optional[bytes], **fields):
+        """由 multipart 上传的图片字节和表单字段构建请求"""
+        request = cls(image_data="", **fields)
+        request._image_bytes = image_bytes
+        return request
+
+    def has_image(self) -> bool:
+        return bool(self._image_bytes or self.image_data)
+
+    def use_ink_only(self) -> bool:
+        return IMAGE_INK_ONLY if self.ink_only is None else self.ink_only
+
+    def image_bytes(self) -> bytes:
+        """原始图片字节(base64 图片在第一次调用时解码并检查文件头)"""
+        if self._image_bytes is None:
+            self._image_bytes = read_image_upload(self.image_data)
+        return self._image_bytes
+
+class OCRRequest(ImageRequest):
     """OCR 请求模型"""
     image_data: str  # base64 编码的图片
     image_type: str = "image/jpeg"  # 图片类型
 
-class QuestionAnalyzeRequest(BaseModel):
+class QuestionAnalyzeRequest(ImageRequest):
     """题目分析请求"""
     image_data: Optional[str] = None
     image_type: Optional[str] = "image/jpeg"
     question_text: Optional[str] = None
     student_answer: Optional[str] = None
 
-class ChatRequest(BaseModel):
+class ChatRequest(ImageRequest):
     """对话请求"""
     message: str
     conversation_history: Optional[List[dict]] = []
@@ -121,7 +168,7 @@ class GuideRequest(BaseModel):
     mistake_data: Optional[dict] = None  # 错题数据 (用于交互式引导)
     round: Optional[int] = 0  # 当前引导轮数 (用于控制引导长度)
 
-class DetectMistakesRequest(BaseModel):
+class DetectMistakesRequest(ImageRequest):
     """错题检测请求"""
     image_data: str  # base64 编码的图片
     image_type: str = "image/jpeg"  # 图片类型
@@ -129,174 +176,6 @@ class DetectMistakesRequest(BaseModel):
     analysis_type: Optional[str] = None  # 分析类型: 'full'(整张试卷), 'mistakes'(错题分析), None(自动判断)
 
 # ==================== 工具函数 ====================
-def decode_base64_image(base64_str: str) -> Image.Image:
-    """解码 base64 图片"""
-    # 移除 data:image/xxx;base64, 前缀
-    if "," in base64_str:
-        base64_str = base64_str.split(",")[1]
-
-    image_data = base64.b64decode(base64_str)
-    image = Image.open(io.BytesIO(image_data))
-    return image
-
-def encode_image_to_base64(image: Image.Image, quality: int = 85) -> str:
-    """将图片编码为 base64"""
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG", quality=quality)
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return img_str
-
-def call_glm_api(messages: list, model: str = "glm-4v", max_retries: int = 3, skip_delay: bool = False, max_tokens: int = 2000) -> str:
-    """调用 GLM API(带排队和重试机制)
-
-    Args:
-        messages: 消息列表
-        model: 模型名称
-        max_retries: 最大重试次数
-        skip_delay: 是否跳过请求延迟(用于快速响应场景)
-        max_tokens: 最大输出token数(用于控制响应速度)
-    """
-    import time
-
-    req_id = get_request_id()
-    print(f"[API #{req_id}] 等待获取GLM API锁...")
-
-    # 使用上下文管理器获取锁(确保锁一定会被释放)
-    with glm_api_lock:
-        print(f"[API #{req_id}] 已获取锁,开始调用")
-
-        headers = {
-            "Authorization": f"Bearer {GLM_API_KEY}",
-            "Content-Type": "application/json"
-        }
-
-        payload = {
-            "model": model,
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": max_tokens
-        }
-
-        # 添加最小请求间隔(避免过于频繁),快速模式跳过
-        if not skip_delay:
-            time.sleep(1)
-
-        for attempt in range(max_retries):
-            try:
-                print(f"[API #{req_id}] 发送请求到GLM... (尝试 {attempt + 1}/{max_retries})")
-                response = requests.post(
-                    GLM_API_URL,
-                    headers=headers,
-                    json=payload,
-                    timeout=60
-                )
-
-                # 处理 429 并发限制错误
-                if response.status_code == 429:
-                    error_detail = response.json() if response.content else {}
-                    error_msg = error_detail.get('error', {}).get('message', '并发请求过多')
-
-                    # 检查是否是余额不足
-                    if '余额' in error_msg or '充值' in error_msg or '资源包' in error_msg:
-                        print(f"[API #{req_id}] ❌ API余额不足")
-                        raise HTTPException(
-                            status_code=429,
-                            detail=f"⚠️ API余额不足\n\n您的GLM API账户余额已用完，请充值后再使用。\n\n📍 解决方法:\n1. 访问 https://open.bigmodel.cn/ 充值\n2. 或在 backend/.env 文件中配置其他API Key\n3. 新用户通常有免费额度，请检查控制台"
-                        )
-
-                    if attempt < max_retries - 1:
-                        # 指数退避: 3秒, 6秒, 12秒
-                        wait_time = [3, 6, 12][attempt]
-                        print(f"[API #{req_id}] ⚠️ 遇到并发限制,等待 {wait_time} 秒后重试...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        raise HTTPException(
-                            status_code=429,
-                            detail=f"GLM API 并发限制: {error_msg}. 请稍后重试. "
-                        )
-
-                if response.status_code != 200:
-                    error_detail = response.json() if response.content else {}
-                    error_msg = error_detail.get('error', {}).get('message', response.text)
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"GLM API 错误: {error_msg}"
-                    )
-
-                result = response.json()
-                print(f"[API #{req_id}] ✅ 请求成功")
-                print(f"[API #{req_id}] 响应结构: {list(result.keys()) if isinstance(result, dict) else type(result)}")
-
-                # 检查choices
-                if 'choices' not in result:
-                    print(f"[API #{req_id}] ❌ 响应中没有choices")
-                    print(f"[API #{req_id}] 完整响应: {json.dumps(result, ensure_ascii=False)[:500]}")
-                    sys.stdout.flush()
-                    raise HTTPException(
-                        status_code=500,
-                        detail="GLM API 返回格式异常: 缺少choices字段"
-                    )
-
-                if len(result['choices']) == 0:
-                    print(f"[API #{req_id}] ❌ choices为空")
-                    sys.stdout.flush()
-                    raise HTTPException(
-                        status_code=500,
-                        detail="GLM API 返回空结果"
-                    )
-
-                print(f"[API #{req_id}] choices[0] keys: {list(result['choices'][0].keys())}")
-
-                if 'message' not in result['choices'][0]:
-                    print(f"[API #{req_id}] ❌ choices[0]中没有message字段")
-                    print(f"[API #{req_id}] choices[0]: {result['choices'][0]}")
-                    sys.stdout.flush()
-                    raise HTTPException(
-                        status_code=500,
-                        detail="GLM API 返回格式异常: 缺少message字段"
-                    )
-
-                print(f"[API #{req_id}] message keys: {list(result['choices'][0]['message'].keys())}")
-                content = result['choices'][0]['message'].get('content', '')
-                print(f"[API #{req_id}] 内容类型: {type(content)}")
-                print(f"[API #{req_id}] 内容长度: {len(content) if content else 0}")
-
-                # 检查内容是否为空
-                if not content or not content.strip():
-                    print(f"[API #{req_id}] ❌ API返回内容为空")
-                    sys.stdout.flush()
-                    raise HTTPException(
-                        status_code=500,
-                        detail="GLM API 返回内容为空,请重试"
-                    )
-
-                print(f"[API #{req_id}] 内容repr: {repr(content[:100])}")
-                print(f"[API #{req_id}] 内容预览: {content[:200]}")
-                sys.stdout.flush()
-                return content
-
-            except requests.exceptions.Timeout as e:
-                if attempt < max_retries - 1:
-                    wait_time = [2, 4, 6][attempt]
-                    print(f"[API #{req_id}] ⚠️ 请求超时,等待 {wait_time} 秒后重试...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    raise HTTPException(status_code=504, detail=f"API 请求超时: {str(e)}")
-
-            except requests.exceptions.RequestException as e:
-                if attempt < max_retries - 1:
-                    wait_time = [2, 4, 6][attempt]
-                    print(f"[API #{req_id}] ⚠️ 网络错误,等待 {wait_time} 秒后重试...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    raise HTTPException(status_code=500, detail=f"API 调用失败: {str(e)}")
-
-        raise HTTPException(status_code=500, detail="API 调用失败: 超过最大重试次数")
-
-
 def parse_mistakes_from_response(response_text: str) -> dict:
     """从AI响应中解析错题数据
 
@@ -358,6 +237,106 @@ def parse_mistakes_from_response(response_text: str) -> dict:
     return None
 
 
+async def run_page_analysis(request: ImageRequest, *parts: str):
+    """在进程池中一次解码完成本请求需要的本地分析(质量检查, 感知哈希, 按题分割, 红笔标记)
+
+    入口处把之后会用到的分析项一并传入, 只解码一次原图; 结果保存在请求上, 已完成的分析项不再计算.
+    质量检查关闭, 或请求不会查找重复试卷时跳过对应分析项
+    """
+    skip = set()
+    if QUALITY_GATE == "off":
+        skip.add("quality")
+    if not request.user_id or not paper_index.enabled:
+        skip.add("hash")
+    missing = tuple(part for part in dict.fromkeys(parts) if part not in request._analysis and part not in skip)
+    if missing:
+        request._analysis.update(await image_pool.run(analyze_page, request.image_bytes(), missing))
+
+
+async def page_analysis(request: ImageRequest, part: str):
+    """本地分析项的结果(未计算时单独计算); 分析出错时抛出该异常"""
+    if part not in request._analysis:
+        request._analysis.update(await image_pool.run(analyze_page, request.image_bytes(), (part,)))
+    result = request._analysis[part]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+async def scan_red_marks(request: ImageRequest, log_prefix: str) -> Optional[dict]:
+    """本地红笔批改检测结果(格式同 detect_marks); 检测失败时返回 None, 由调用方照常调用视觉模型"""
+    try:
+        mark_scan = await page_analysis(request, "marks")
+    except Exception as e:
+        # 本地预筛失败不影响正常检测
+        print(f"[{log_prefix}] 本地红笔检测失败, 跳过: {str(e)}")
+        return None
+    print(f"[{log_prefix}] 本地红笔检测: 红色占比 {mark_scan['red_ratio']}, 候选标记 {len(mark_scan['marks'])} 个")
+    return mark_scan
+
+
+async def find_reused_paper(request: ImageRequest, namespace: str):
+    """同一用户之前分析过近似相同的试卷(重新拍照的同一页)时返回保存的结果
+
+    返回 (感知哈希, 保存的结果); 请求未带 user_id, 未启用或哈希计算失败时返回 (None, None)
+    """
+    if not request.user_id or not paper_index.enabled:
+        return None, None
+    try:
+        paper_hash = await page_analysis(request, "hash")
+    except Exception as e:
+        # 计算失败时不复用也不保存, 不影响正常识别
+        print(f"[重复试卷] 感知哈希计算失败, 跳过: {str(e)}")
+        return None, None
+    reused = paper_index.lookup(request.user_id, paper_hash, namespace)
+    if reused is not None:
+        print(f"[重复试卷] 用户 {request.user_id} 重复上传试卷, 复用 {namespace} 结果")
+    return paper_hash, reused
+
+
+def remember_paper(request: ImageRequest, paper_hash: Optional[bytes], namespace: str, result: dict):
+    """保存本次试卷的分析结果, 供同一用户重复上传时复用"""
+    if paper_hash is not None:
+        paper_index.store(request.user_id, paper_hash, namespace, result)
+
+
+async def check_paper_quality(request: ImageRequest) -> List[str]:
+    """调用 GLM 之前在本地检查试卷照片质量(模糊, 过暗, 反光, 分辨率)
+
+    QUALITY_GATE=reject 时严重问题直接抛出 400 提示重拍; 返回需要提示给学生的其他问题
+    (同时保存在请求上, 由 with_quality_warnings 加入非流式端点的返回结果)
+    """
+    if QUALITY_GATE == "off":
+        return []
+    try:
+        report = await page_analysis(request, "quality")
+    except Exception as e:
+        # 检查失败不影响正常识别
+        print(f"[质量检查] 检查失败, 跳过: {str(e)}")
+        return []
+
+    if report["issues"] or report["warnings"]:
+        print(f"[质量检查] 问题: {report['issues']}, 提示: {report['warnings']}, 指标: {report['metrics']}")
+    if report["issues"] and QUALITY_GATE == "reject":
+        raise HTTPException(status_code=400, detail=report["issues"][0])
+    request._quality_warnings = report["issues"] + report["warnings"]
+    return request._quality_warnings
+
+
+def with_quality_warnings(endpoint):
+    """非流式端点的返回结果中加入 "quality_warnings": [...](拍照质量提示, 没有时为空列表)
+
+    端点中有多处返回(包括复用的结果), 统一在这里加入; 流式端点以 quality_warning 事件发送
+    """
+    @wraps(endpoint)
+    async def wrapper(request: ImageRequest):
+        result = await endpoint(request)
+        if isinstance(result, dict):
+            result = {**result, "quality_warnings": request._quality_warnings}
+        return result
+    return wrapper
+
+
 # ==================== API 路由 ====================
 
 @app.get("/")
@@ -376,7 +355,9 @@ async def root():
             "/api/diagnose/guide": "苏格拉底式引导",
             "/api/diagnose/guide/stream": "苏格拉底式引导(流式)",
             "/api/detect/mistakes": "智能找错题",
-            "/api/detect/mistakes/stream": "智能找错题(流式)"
+            "/api/detect/mistakes/stream": "智能找错题(流式)",
+            "/api/.../upload": "视觉端点的文件上传版本(multipart/form-data, 如 /api/ocr/exam/upload)",
+            "/api/glm/status": "GLM 调度状态"
         }
     }
 
@@ -385,7 +366,46 @@ async def health_check():
     """健康检查"""
     return {"status": "healthy"}
 
+@app.get("/api/glm/status")
+async def glm_status():
+    """GLM 调度状态(熔断器状态, 各通道当前并发上限, 发送速率, 运行中和排队中的请求数, 请求合并, 缓存, 对冲和重复试卷统计)"""
+    return {
+        "success": True,
+        "data": {
+            "breaker": breaker.stats(),
+            "scheduler": scheduler.stats(),
+            "client": get_client_stats(),
+            "cache": response_cache.stats(),
+            "question_cache": question_cache.stats(),
+            "hedge": get_hedge_stats(),
+            "image_cache": rendition_cache.stats(),
+            "image_pool": image_pool.stats(),
+            "paper_index": paper_index.stats()
+        }
+    }
+
+OCR_EXAM_PROMPT = """请识别这张图片中的所有题目内容. 
+
+请以JSON格式返回: 
+```json
+{
+  "questions": [
+    {
+      "question_no": "题号",
+      "question_text": "题目内容",
+      "student_answer": "学生答案"
+    }
+  ]
+}
+```"""
+
+# 分块识别时每块的提示词
+OCR_TILE_NOTE = "这张图片是试卷的一部分(与相邻部分有重叠),被图片边缘截断的题目也要识别,看不到题号时题号留空. "
+OCR_EXAM_PROMPT_TILE = OCR_TILE_NOTE + OCR_EXAM_PROMPT
+
+
 @app.post("/api/ocr/exam")
+@with_quality_warnings
 async def ocr_exam_paper(request: OCRRequest):
     """
     试卷 OCR 识别
@@ -393,34 +413,44 @@ async def ocr_exam_paper(request: OCRRequest):
     使用 GLM-4V 识别试卷中的题目和答案
     """
     try:
-        # 解码图片
-        image = decode_base64_image(request.image_data)
+        # 读取图片(只解析文件头检查尺寸)
+        image_bytes = request.image_bytes()
+        width, height = check_image_header(image_bytes)
 
         # 检查图片尺寸
-        if image.width < 100 or image.height < 100:
+        if width < 100 or height < 100:
             raise HTTPException(
                 status_code=400,
-                detail=f"图片尺寸太小 ({image.width}x{image.height}),请上传更清晰的图片"
+                detail=f"图片尺寸太小 ({width}x{height}),请上传更清晰的图片"
             )
 
+        # 本地检查拍照质量, 明显无法识别的照片不调用 GLM(与重复试卷哈希共用一次解码)
+        await run_page_analysis(request, "quality", "hash")
+        await check_paper_quality(request)
+
+        # 同一用户重复上传的试卷直接复用识别结果
+        paper_hash, reused = await find_reused_paper(request, "ocr_exam")
+        if reused is not None:
+            return reused
+
+        # 大图分块并发识别(小字更清晰, 耗时取决于最慢的一块); 不需要分块或分块识别失败时整页识别
+        questions = await ocr_tiled_questions(request, OCR_EXAM_PROMPT_TILE, cache="ocr_exam")
+        if questions is not None:
+            result = {
+                "success": True,
+                "data": {"questions": questions},
+                "raw_response": json.dumps({"questions": questions}, ensure_ascii=False),
+                "parsed": True
+            }
+            remember_paper(request, paper_hash, "ocr_exam", result)
+            return result
+
         # 压缩图片以加快传输
-        base64_image = encode_image_to_base64(image, quality=85)
+        prepared = await prepare_task_image(image_bytes, "ocr", ink_only=request.use_ink_only(), page_crop=True)
+        image_url = prepared.data_url
 
         # 构建 prompt(简化版,更容易解析)
-        prompt = """请识别这张图片中的所有题目内容. 
-
-请以JSON格式返回: 
-```json
-{
-  "questions": [
-    {
-      "question_no": "题号",
-      "question_text": "题目内容",
-      "student_answer": "学生答案"
-    }
-  ]
-}
-```"""
+        prompt = OCR_EXAM_PROMPT
 
         # 调用 GLM-4V API
         messages = [
@@ -430,7 +460,7 @@ async def ocr_exam_paper(request: OCRRequest):
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
+                            "url": image_url
                         }
                     },
                     {
@@ -441,7 +471,7 @@ async def ocr_exam_paper(request: OCRRequest):
             }
         ]
 
-        response_text = call_glm_api(messages, model="glm-4v")
+        response_text = await call_glm_api(messages, model="glm-4v", cache="ocr_exam")
 
         # 解析响应(多种方式尝试)
         data = None
@@ -475,12 +505,14 @@ async def ocr_exam_paper(request: OCRRequest):
                 "parsed": False
             }
 
-        return {
+        result = {
             "success": True,
             "data": data,
             "raw_response": response_text,
             "parsed": True
         }
+        remember_paper(request, paper_hash, "ocr_exam", result)
+        return result
 
     except HTTPException:
         raise
@@ -507,14 +539,13 @@ async def analyze_question(request: QuestionAnalyzeRequest):
         content = []
 
         # 如果有图片
-        if request.image_data:
-            image = decode_base64_image(request.image_data)
-            base64_image = encode_image_to_base64(image, quality=85)
+        if request.has_image():
+            image_url = (await prepare_task_image(request.image_bytes(), "ocr")).data_url
 
             content.append({
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64_image}"
+                    "url": image_url
                 }
             })
 
@@ -539,7 +570,7 @@ async def analyze_question(request: QuestionAnalyzeRequest):
             "content": content
         }]
 
-        response_text = call_glm_api(messages, model="glm-4v")
+        response_text = await call_glm_api(messages, model="glm-4v", cache="analyze_question")
 
         # 返回自然语言分析结果
         return {
@@ -595,20 +626,11 @@ async def chat(request: ChatRequest):
                 })
 
         # 添加当前消息
-        if request.image_data:
+        if request.has_image():
             try:
-                # 如果有图片,使用多模态
-                image = decode_base64_image(request.image_data)
-
-                # 检查图片大小
-                if image.width * image.height > 4000000:  # 限制图片大小
-                    # 缩小图片
-                    ratio = min(800 / image.width, 600 / image.height)
-                    new_width = int(image.width * ratio)
-                    new_height = int(image.height * ratio)
-                    image = image.resize((new_width, new_height))
-
-                base64_image = encode_image_to_base64(image, quality=75)
+                # 如果有图片,使用多模态(按聊天附图规格: 长边 1024, 字节预算 IMAGE_BUDGET_CHAT)
+                prepared = await prepare_task_image(request.image_bytes(), "chat")
+                image_url = prepared.data_url
 
                 # 判断是否需要启动诊断流程
                 user_message = request.message or "请帮我看看这道题"
@@ -629,7 +651,7 @@ async def chat(request: ChatRequest):
                                 {
                                     "type": "image_url",
                                     "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64_image}"
+                                        "url": image_url
                                     }
                                 },
                                 {
@@ -639,7 +661,7 @@ async def chat(request: ChatRequest):
                             ]
                         }]
 
-                        question_text = call_glm_api(messages_with_image, model="glm-4v")
+                        question_text = await call_glm_api(messages_with_image, model="glm-4v", priority=PRIORITY_INTERACTIVE)
                         print(f"[诊断] 题目提取成功: {question_text[:50]}...")
 
                         # 第二步: 诊断错误
@@ -668,7 +690,7 @@ async def chat(request: ChatRequest):
                             "content": diagnose_prompt
                         }]
 
-                        diagnosis_result = call_glm_api(messages_diagnose, model="glm-4-flash")
+                        diagnosis_result = await call_glm_api(messages_diagnose, model="glm-4-flash", priority=PRIORITY_INTERACTIVE, hedge="chat")
                         print(f"[诊断] 诊断完成")
 
                         # 解析诊断结果
@@ -695,7 +717,7 @@ async def chat(request: ChatRequest):
                                 "content": guide_prompt
                             }]
 
-                            guide_response = call_glm_api(messages_guide, model="glm-4-flash")
+                            guide_response = await call_glm_api(messages_guide, model="glm-4-flash", priority=PRIORITY_INTERACTIVE, hedge="chat")
                             print(f"[诊断] 引导问题生成完成")
 
                             # 返回诊断+引导的结果
@@ -744,7 +766,7 @@ async def chat(request: ChatRequest):
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": image_url
                             }
                         },
                         {
@@ -777,11 +799,21 @@ async def chat(request: ChatRequest):
                 "content": enhanced_text_prompt[:1000]
             })
 
+        # 没有图片和历史的首轮提问, 可以复用相同或近似问题的回复
+        reusable = not request.has_image() and len(messages) == 1
+        if reusable:
+            cached_response = question_cache.lookup("chat", request.message)
+            if cached_response is not None:
+                return {
+                    "success": True,
+                    "response": cached_response
+                }
+
         # 调用 GLM API(call_glm_api 内部已处理重试)
         # 根据是否有图片选择合适的模型
-        model = "glm-4v" if request.image_data else "glm-4-flash"
+        model = "glm-4v" if request.has_image() else "glm-4-flash"
         try:
-            response_text = call_glm_api(messages, model=model)
+            response_text = await call_glm_api(messages, model=model, priority=PRIORITY_INTERACTIVE, hedge="chat")
         except HTTPException as e:
             # 处理 HTTP 异常(包括 429 并发限制)
             return {
@@ -797,6 +829,9 @@ async def chat(request: ChatRequest):
                 "response": "抱歉,处理请求时出现错误,请稍后重试"
             }
 
+        if reusable:
+            question_cache.store("chat", request.message, response_text[:2000])
+
         return {
             "success": True,
             "response": response_text[:2000]  # 限制响应长度
@@ -856,17 +891,10 @@ async def chat_stream(request: ChatRequest):
                     })
 
             # 添加当前消息
-            if request.image_data:
+            if request.has_image():
                 try:
-                    image = decode_base64_image(request.image_data)
-
-                    if image.width * image.height > 4000000:
-                        ratio = min(800 / image.width, 600 / image.height)
-                        new_width = int(image.width * ratio)
-                        new_height = int(image.height * ratio)
-                        image = image.resize((new_width, new_height))
-
-                    base64_image = encode_image_to_base64(image, quality=75)
+                    prepared = await prepare_task_image(request.image_bytes(), "chat")
+                    image_url = prepared.data_url
 
                     user_message = request.message or "请帮我看看这道题"
                     enhanced_prompt = f"""{user_message}
@@ -879,7 +907,7 @@ async def chat_stream(request: ChatRequest):
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
+                                    "url": image_url
                                 }
                             },
                             {
@@ -900,8 +928,8 @@ async def chat_stream(request: ChatRequest):
                     "content": request.message[:500]
                 })
 
-            # 调用 GLM API 获取完整响应
-            model = "glm-4v" if request.image_data else "glm-4-flash"
+            # 调用 GLM API 流式获取响应
+            model = "glm-4v" if request.has_image() else "glm-4-flash"
 
             try:
                 print("[流式对话] 发送分析中状态...")
@@ -909,19 +937,14 @@ async def chat_stream(request: ChatRequest):
                 yield f"data: {json.dumps({'status': 'analyzing', 'message': 'AI正在分析中...'})}\n\n"
                 print(f"[流式对话] 状态消息已发送")
 
-                # 调用API获取响应
+                # 调用API, 收到一段转发一段
                 print("[流式对话] 开始调用 GLM API...")
-                response_text = call_glm_api(messages, model=model)
-                print(f"[流式对话] API响应完成，响应长度: {len(response_text)} 字符")
+                sent_length = 0
+                async for delta in stream_glm_api(messages, model=model, priority=PRIORITY_INTERACTIVE):
+                    yield f"data: {json.dumps({'content': delta, 'done': False})}\n\n"
+                    sent_length += len(delta)
 
-                # 逐字返回响应
-                print(f"[流式对话] 开始逐字发送，共 {len(response_text)} 个字符")
-                for idx, char in enumerate(response_text):
-                    yield f"data: {json.dumps({'content': char, 'done': False})}\n\n"
-                    if (idx + 1) % 100 == 0:
-                        print(f"[流式对话] 已发送 {idx + 1}/{len(response_text)} 字符")
-
-                print(f"[流式对话] 所有内容已发送")
+                print(f"[流式对话] 所有内容已发送，共 {sent_length} 个字符")
 
                 # 发送完成信号
                 yield f"data: {json.dumps({'done': True})}\n\n"
@@ -977,11 +1000,11 @@ async def diagnose_error_stream(request: DiagnoseRequest):
                 "content": diagnose_prompt
             }]
 
-            response_text = call_glm_api(messages, model="glm-4-flash")
-
-            # 逐字返回分析内容
-            for char in response_text:
-                yield f"data: {json.dumps({'content': char})}\n\n"
+            # 边生成边返回分析内容
+            response_text = ""
+            async for delta in stream_glm_api(messages, model="glm-4-flash", priority=PRIORITY_INTERACTIVE):
+                response_text += delta
+                yield f"data: {json.dumps({'content': delta})}\n\n"
 
             # 解析 JSON
             json_match = re.search(r'\{[\s\S]*\}', response_text)
@@ -1010,6 +1033,14 @@ async def diagnose_error(request: DiagnoseRequest):
     分析学生的错误答案,找出错误原因
     """
     try:
+        # 相同或近似题目(且学生答案相同)已诊断过时直接复用
+        cached_result = question_cache.lookup("diagnose", request.question, extra=request.student_answer)
+        if cached_result is not None:
+            return {
+                "success": True,
+                "data": cached_result
+            }
+
         # 构建诊断 prompt
         diagnose_prompt = f"""你是一位有20年教学经验的初中数学老师.
 学生做错了这道题: {request.question}
@@ -1036,12 +1067,13 @@ async def diagnose_error(request: DiagnoseRequest):
             "content": diagnose_prompt
         }]
 
-        response_text = call_glm_api(messages, model="glm-4-flash")
+        response_text = await call_glm_api(messages, model="glm-4-flash", priority=PRIORITY_INTERACTIVE, hedge="diagnose")
 
         # 解析 JSON
         json_match = re.search(r'\{[\s\S]*\}', response_text)
         if json_match:
             result = json.loads(json_match.group(0))
+            question_cache.store("diagnose", request.question, result, extra=request.student_answer)
             return {
                 "success": True,
                 "data": result
@@ -1119,9 +1151,9 @@ async def guide_student_stream(request: GuideRequest):
                 "content": guide_prompt
             }]
 
-            # 逐字返回引导内容
-            for char in call_glm_api(messages, model="glm-4-flash"):
-                yield f"data: {json.dumps({'content': char})}\n\n"
+            # 边生成边返回引导内容
+            async for delta in stream_glm_api(messages, model="glm-4-flash", priority=PRIORITY_INTERACTIVE):
+                yield f"data: {json.dumps({'content': delta})}\n\n"
 
             yield f"data: {json.dumps({'done': True})}\n\n"
 
@@ -1187,7 +1219,7 @@ async def guide_student(request: GuideRequest):
             "content": guide_prompt
         }]
 
-        response_text = call_glm_api(messages, model="glm-4-flash")
+        response_text = await call_glm_api(messages, model="glm-4-flash", priority=PRIORITY_INTERACTIVE, hedge="guide")
 
         return {
             "success": True,
@@ -1203,38 +1235,10 @@ async def guide_student(request: GuideRequest):
         print(f"错误堆栈:\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"引导失败: {str(e)}")
 
-@app.post("/api/detect/mistakes/smart")
-async def smart_detect_mistakes(request: DetectMistakesRequest):
-    """
-    智能多维度验证错题检测
-
-    实现流程: 
-    1. 解析卷面题目和学生答案
-    2. 识别老师批改标记
-    3. AI理解题目并给出答案
-    4. 三方比较验证
-    """
-    try:
-        import time
-        start_time = time.time()
-
-        # 解码图片
-        image = decode_base64_image(request.image_data)
-
-        # 使用高质量图片
-        max_size = 1500
-        if image.width > max_size or image.height > max_size:
-            ratio = min(max_size / image.width, max_size / image.height)
-            new_width = int(image.width * ratio)
-            new_height = int(image.height * ratio)
-            image = image.resize((new_width, new_height))
+# 智能检测按题裁剪后每个区域的长边像素
+SMART_CROP_SIZE = int(os.getenv("SMART_CROP_SIZE", "800"))
 
-        base64_image = encode_image_to_base64(image, quality=85)
-        print(f"[智能检测] 图片尺寸: {image.width}x{image.height}")
-
-        # 步骤1: OCR识别题目, 学生答案, 老师批改
-        print(f"[智能检测] 步骤1: OCR识别试卷内容...")
-        ocr_prompt = """请详细分析这张试卷,提取以下信息: 
+SMART_OCR_PROMPT = """请详细分析这张试卷,提取以下信息: 
 
 对每道题目(按顺序编号),请提供: 
 1. 题号
@@ -1260,49 +1264,280 @@ async def smart_detect_mistakes(request: DetectMistakesRequest):
 
 注意: 仔细识别每个题目的批改标记,×和√要区分清楚. """
 
-        ocr_messages = [{
+SMART_OCR_PROMPT_REGION = SMART_OCR_PROMPT.replace(
+    "请详细分析这张试卷,提取以下信息: ",
+    "这张图片是从试卷中裁出的一部分(通常是一道题),请提取以下信息: "
+).replace(
+    "注意: 仔细识别每个题目的批改标记,×和√要区分清楚. ",
+    "注意: 仔细识别每个题目的批改标记,×和√要区分清楚. 只提取图片中有题目内容的题目,没有题目时返回空列表. "
+)
+
+# 拼图模式: 区域数不少于该值时先把多个区域拼成带编号的图片, 每张拼图一次调用(0 表示关闭, 各区域单独调用)
+COLLAGE_MIN_REGIONS = int(os.getenv("COLLAGE_MIN_REGIONS", "3"))
+# 拼图调用的输出长度上限(按区域数累加, 不超过 COLLAGE_MAX_TOKENS)
+COLLAGE_MAX_TOKENS = int(os.getenv("COLLAGE_MAX_TOKENS", "4000"))
+
+COLLAGE_NOTE = "这张图片由试卷上的 {count} 个区域拼接而成,区域之间用空白隔开,每个区域上方标有编号: {labels}.\n\n"
+
+SMART_OCR_PROMPT_COLLAGE = """请逐个区域提取以下信息(每个区域通常是一道题): 
+
+对区域中的每道题目,请提供: 
+1. 题号
+2. 题目类型(选择题/填空题/判断题等)
+3. 题目内容
+4. 学生选择的答案(A/B/C/D或填空内容)
+5. 老师的批改标记(×表示错,√表示对,圈/线/点表示其他标记,无标记表示未批改)
+
+请以JSON格式返回, regions 中每个区域一项, label 为区域上方的编号: 
+```json
+{
+  "regions": [
+    {
+      "label": "区域编号",
+      "questions": [
+        {
+          "question_no": "题号",
+          "question_type": "题型",
+          "question_content": "题目内容",
+          "student_answer": "学生答案",
+          "teacher_mark": "老师标记(×/√/圈/线/点/无)"
+        }
+      ]
+    }
+  ]
+}
+```
+
+注意: 仔细识别每个题目的批改标记,×和√要区分清楚. 每道题只归入它所在的区域,不要把相邻区域的内容混在一起; 区域中没有题目时 questions 返回空列表. """
+
+
+async def analyze_collages(image_bytes: bytes, boxes: List[dict], prompt: str, cache: str, max_size: int,
+                           padding: float = 0, byte_budget: int = 0, ink_only: bool = False,
+                           tokens_per_region: int = 600) -> Dict[int, List[dict]]:
+    """把多个区域拼成带编号的图片, 每张拼图一次视觉调用, 回答按编号拆分回各区域
+
+    prompt 要求返回 {"regions": [{"label": "编号", ...}, ...]}.
+    返回 {区域在 boxes 中的序号: [该区域的回答项, ...]}; 拼图调用或解析失败, 以及回答中缺少编号的区域
+    不在结果中, 由调用方单独分析
+    """
+    collages = await prepare_collages(image_bytes, boxes, max_size=max_size, quality=85, padding=padding,
+                                      byte_budget=byte_budget, ink_only=ink_only)
+    print(f"[拼图分析] {len(boxes)} 个区域拼成 {len(collages)} 张图片: "
+          + ", ".join(f"{collage.width}x{collage.height}" for collage, _ in collages))
+
+    async def analyze_collage(collage, indices: List[int]) -> str:
+        labels = "、".join(f"[{i + 1}]" for i in sorted(indices))
+        messages = [{
             "role": "user",
             "content": [
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
+                        "url": collage.data_url
                     }
                 },
                 {
                     "type": "text",
-                    "text": ocr_prompt
+                    "text": COLLAGE_NOTE.format(count=len(indices), labels=labels) + prompt
                 }
             ]
         }]
+        max_tokens = min(COLLAGE_MAX_TOKENS, tokens_per_region * len(indices))
+        return await call_glm_api(messages, model="glm-4v", max_tokens=max_tokens, cache=cache)
 
-        ocr_response = call_glm_api(ocr_messages, model="glm-4v", skip_delay=False, max_tokens=2000)
-        print(f"[智能检测] OCR响应:\n{ocr_response[:500]}...")
+    responses = await asyncio.gather(
+        *(analyze_collage(collage, indices) for collage, indices in collages),
+        return_exceptions=True
+    )
 
-        # 解析OCR结果
-        ocr_data = None
-        json_match = re.search(r'```json\s*(\{[\s\S]*?\})\s*```', ocr_response)
+    results: Dict[int, List[dict]] = {}
+    for (_, indices), response in zip(collages, responses):
+        if isinstance(response, Exception):
+            print(f"[拼图分析] 拼图分析失败: {str(response)}")
+            continue
+        data = parse_mistakes_from_response(response)
+        regions = data.get("regions") if isinstance(data, dict) else None
+        if not isinstance(regions, list):
+            print(f"[拼图分析] 拼图解析失败: {response[:200]}")
+            continue
+        for item in regions:
+            if not isinstance(item, dict):
+                continue
+            label = re.sub(r"\D", "", str(item.pop("label", "")))
+            index = int(label) - 1 if label else -1
+            if index in indices:
+                results.setdefault(index, []).append(item)
+    missing = len(boxes) - len(results)
+    if missing:
+        print(f"[拼图分析] {missing} 个区域没有结果, 单独分析")
+    return results
+
+
+async def ocr_exam_questions(image_url: str, prompt: str, cache: str = "smart_detect") -> Optional[list]:
+    """识别图片中的题目, 学生答案和老师批改, 返回题目列表; 无法解析时返回 None"""
+    ocr_messages = [{
+        "role": "user",
+        "content": [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url
+                }
+            },
+            {
+                "type": "text",
+                "text": prompt
+            }
+        ]
+    }]
+
+    ocr_response = await call_glm_api(ocr_messages, model="glm-4v", max_tokens=2000, cache=cache)
+    print(f"[智能检测] OCR响应:\n{ocr_response[:500]}...")
+
+    # 解析OCR结果
+    ocr_data = None
+    json_match = re.search(r'```json\s*(\{[\s\S]*?\})\s*```', ocr_response)
+    if json_match:
+        try:
+            ocr_data = json.loads(json_match.group(1))
+        except:
+            pass
+
+    if not ocr_data:
+        json_match = re.search(r'\{[\s\S]*"questions"[\s\S]*\}', ocr_response)
         if json_match:
             try:
-                ocr_data = json.loads(json_match.group(1))
+                ocr_data = json.loads(json_match.group(0))
             except:
                 pass
 
-        if not ocr_data:
-            json_match = re.search(r'\{[\s\S]*"questions"[\s\S]*\}', ocr_response)
-            if json_match:
-                try:
-                    ocr_data = json.loads(json_match.group(0))
-                except:
-                    pass
+    if not ocr_data or not isinstance(ocr_data.get("questions"), list):
+        return None
+    return ocr_data["questions"]
+
+
+SMART_OCR_PROMPT_TILE = OCR_TILE_NOTE + SMART_OCR_PROMPT
 
-        if not ocr_data or "questions" not in ocr_data:
+
+async def ocr_tiled_questions(request: ImageRequest, prompt: str, cache: str) -> Optional[list]:
+    """把原图分为相互重叠的若干块, 以原图分辨率并发识别后合并各块的题目
+
+    不需要分块(图片较小或请求关闭分块), 或有块识别失败(会漏掉这一块的题目)时返回 None, 由调用方整页识别
+    """
+    image_bytes = request.image_bytes()
+    width, height = display_size(image_bytes)
+    if not should_tile(width, height, request.tiled):
+        return None
+    tiles = tile_boxes(width, height)
+    if not tiles:
+        return None
+
+    print(f"[分块识别] 图片 {width}x{height} 分为 {len(tiles)} 块并发识别")
+    crops = await prepare_crops(
+        image_bytes, tiles, max_size=OCR_TILE_SIZE, quality=85, byte_budget=IMAGE_BUDGET_PAGE,
+        ink_only=request.use_ink_only()
+    )
+    results = await asyncio.gather(
+        *(ocr_exam_questions(crop.data_url, prompt, cache=cache) for crop in crops),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"[分块识别] 分块识别失败: {str(result)}")
+    if not all(isinstance(result, list) for result in results):
+        return None
+
+    questions = merge_tile_questions(tiles, results)
+    print(f"[分块识别] 各块共 {sum(len(result) for result in results)} 道题, 合并后 {len(questions)} 道")
+    return questions or None
+
+
+@app.post("/api/detect/mistakes/smart")
+@with_quality_warnings
+async def smart_detect_mistakes(request: DetectMistakesRequest):
+    """
+    智能多维度验证错题检测
+
+    实现流程: 
+    1. 解析卷面题目和学生答案(按题分割后各题并发识别)
+    2. 识别老师批改标记
+    3. AI理解题目并给出答案
+    4. 三方比较验证
+    """
+    try:
+        import time
+        start_time = time.time()
+
+        # 解码图片
+        image_bytes = request.image_bytes()
+
+        # 质量检查, 重复试卷哈希和按题分割共用一次解码
+        await run_page_analysis(request, "quality", "hash", "segments")
+
+        # 本地检查拍照质量, 明显无法识别的照片不调用 GLM
+        await check_paper_quality(request)
+
+        # 同一用户重复上传的试卷直接复用检测结果
+        paper_hash, reused = await find_reused_paper(request, "smart_detect")
+        if reused is not None:
+            return reused
+
+        # 步骤1: OCR识别题目, 学生答案, 老师批改
+        # 先在本地按题分割试卷, 各题小图并发识别; 分割失败时大图分块识别, 否则整页识别
+        print(f"[智能检测] 步骤1: OCR识别试卷内容...")
+        questions = None
+        regions = await page_analysis(request, "segments")
+        if regions:
+            print(f"[智能检测] 分割出 {len(regions)} 个题目区域, 并发识别")
+            # 区域较多时先拼图识别(几个区域一次调用), 拼图中缺少结果的区域再单独识别
+            region_questions = {}
+            if COLLAGE_MIN_REGIONS and len(regions) >= COLLAGE_MIN_REGIONS:
+                collage_results = await analyze_collages(
+                    image_bytes, regions, SMART_OCR_PROMPT_COLLAGE, cache="smart_detect", max_size=SMART_CROP_SIZE,
+                    byte_budget=IMAGE_BUDGET_CROP, ink_only=request.use_ink_only(), tokens_per_region=500
+                )
+                for i, items in collage_results.items():
+                    items = [item for item in items if isinstance(item.get("questions"), list)]
+                    if items:
+                        region_questions[i] = [question for item in items for question in item["questions"]]
+
+            missing = [i for i in range(len(regions)) if i not in region_questions]
+            if missing:
+                crops = await prepare_crops(
+                    image_bytes, [regions[i] for i in missing], max_size=SMART_CROP_SIZE, quality=85,
+                    byte_budget=IMAGE_BUDGET_CROP, ink_only=request.use_ink_only()
+                )
+                results = await asyncio.gather(
+                    *(ocr_exam_questions(crop.data_url, SMART_OCR_PROMPT_REGION) for crop in crops),
+                    return_exceptions=True
+                )
+                for i, result in zip(missing, results):
+                    if isinstance(result, Exception):
+                        print(f"[智能检测] 区域识别失败: {str(result)}")
+                    elif isinstance(result, list):
+                        region_questions[i] = result
+            # 有区域识别失败时(会漏掉这些区域的题目)不采用分割结果, 改为分块或整页识别
+            if len(region_questions) == len(regions):
+                questions = [question for i in sorted(region_questions) for question in region_questions[i]] or None
+            else:
+                print(f"[智能检测] {len(regions) - len(region_questions)} 个区域识别失败, 改为分块/整页识别")
+
+        if questions is None:
+            # 分割失败时大图分块并发识别
+            questions = await ocr_tiled_questions(request, SMART_OCR_PROMPT_TILE, cache="smart_detect")
+
+        if questions is None:
+            # 使用高质量图片整页识别
+            prepared = await prepare_task_image(image_bytes, "page", ink_only=request.use_ink_only(), page_crop=True)
+            print(f"[智能检测] 整页识别, 图片尺寸: {prepared.width}x{prepared.height}")
+            questions = await ocr_exam_questions(prepared.data_url, SMART_OCR_PROMPT)
+
+        if questions is None:
             return {
                 "success": False,
                 "error": "OCR识别失败,请上传更清晰的试卷图片"
             }
 
-        questions = ocr_data["questions"]
         print(f"[智能检测] 识别到 {len(questions)} 道题目")
 
         # 步骤2-3: AI理解题目并给出正确答案
@@ -1342,24 +1577,32 @@ async def smart_detect_mistakes(request: DetectMistakesRequest):
             }]
 
             try:
-                solve_response = call_glm_api(solve_messages, model="glm-4-flash", skip_delay=False, max_tokens=500)
-
-                solve_data = None
-                json_match = re.search(r'```json\s*(\{[\s\S]*?\})\s*```', solve_response)
-                if json_match:
-                    try:
-                        solve_data = json.loads(json_match.group(1))
-                    except:
-                        pass
+                # 相同或近似题目(且学生答案相同)已解答过时跳过 GLM 调用
+                solve_data = question_cache.lookup("solve", q_content, extra=student_answer)
+                solve_response = ""
 
                 if not solve_data:
-                    json_match = re.search(r'\{[\s\S]*\}', solve_response)
+                    solve_response = await call_glm_api(solve_messages, model="glm-4-flash", max_tokens=500, priority=PRIORITY_BULK, cache="smart_detect")
+
+                    solve_data = None
+                    json_match = re.search(r'```json\s*(\{[\s\S]*?\})\s*```', solve_response)
                     if json_match:
                         try:
-                            solve_data = json.loads(json_match.group(0))
+                            solve_data = json.loads(json_match.group(1))
                         except:
                             pass
 
+                    if not solve_data:
+                        json_match = re.search(r'\{[\s\S]*\}', solve_response)
+                        if json_match:
+                            try:
+                                solve_data = json.loads(json_match.group(0))
+                            except:
+                                pass
+
+                    if solve_data:
+                        question_cache.store("solve", q_content, solve_data, extra=student_answer)
+
                 if solve_data:
                     correct_answer = solve_data.get("correct_answer", "")
                     ai_judgment = solve_data.get("is_correct", False)
@@ -1456,7 +1699,7 @@ async def smart_detect_mistakes(request: DetectMistakesRequest):
         print(f"[智能检测] 完成,耗时: {elapsed:.2f}秒")
         print(f"[智能检测] 错题: {len(mistakes)}, 需确认: {len(need_confirmation)}")
 
-        return {
+        result = {
             "success": True,
             "data": {
                 "mistakes": mistakes,
@@ -1466,6 +1709,8 @@ async def smart_detect_mistakes(request: DetectMistakesRequest):
             },
             "elapsed_time": f"{elapsed:.2f}s"
         }
+        remember_paper(request, paper_hash, "smart_detect", result)
+        return result
 
     except HTTPException:
         raise
@@ -1475,7 +1720,132 @@ async def smart_detect_mistakes(request: DetectMistakesRequest):
         print(f"错误堆栈:\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"智能检测失败: {str(e)}")
 
+# 用户标记模式: 按框选区域裁剪后每个区域的长边像素, 以及裁剪时四周留白(占图片宽高的百分比)
+USER_MARK_CROP_SIZE = int(os.getenv("USER_MARK_CROP_SIZE", "1000"))
+USER_MARK_PADDING = float(os.getenv("USER_MARK_PADDING", "2"))
+
+USER_MARK_REGION_PROMPT = """这张图片是用户从试卷上框选出的一道题目,请仔细分析.
+
+请按以下步骤分析:
+1. 识别题目内容和学生答案
+2. 判断答案是否正确
+3. 分析错误原因和知识点
+4. 提供改进建议
+
+必须返回JSON格式(不要使用markdown代码块,直接返回JSON):
+{
+  "question_no": "题号或位置",
+  "question": "题目内容",
+  "student_answer": "学生答案",
+  "correct_answer": "正确答案",
+  "reason": "错误原因",
+  "knowledge_point": "知识点",
+  "suggestion": "改进建议"
+}
+
+注意: 用户框选的都是需要分析的题目,请直接分析内容,不要判断是否为错题."""
+
+USER_MARK_COLLAGE_PROMPT = """每个区域是用户从试卷上框选出的一道题目,请逐个区域仔细分析.
+
+对每个区域按以下步骤分析:
+1. 识别题目内容和学生答案
+2. 判断答案是否正确
+3. 分析错误原因和知识点
+4. 提供改进建议
+
+必须返回JSON格式(不要使用markdown代码块,直接返回JSON), regions 中每个区域一项, label 为区域上方的编号:
+{
+  "regions": [
+    {
+      "label": "区域编号",
+      "question_no": "题号或位置",
+      "question": "题目内容",
+      "student_answer": "学生答案",
+      "correct_answer": "正确答案",
+      "reason": "错误原因",
+      "knowledge_point": "知识点",
+      "suggestion": "改进建议"
+    }
+  ]
+}
+
+注意: 用户框选的都是需要分析的题目,请直接分析内容,不要判断是否为错题. 不要把相邻区域的内容混在一起."""
+
+
+def has_marked_regions(user_marks: Optional[List[dict]]) -> bool:
+    """用户标记是否都带有框选大小(只有点击位置的旧版标记无法裁剪)"""
+    try:
+        return bool(user_marks) and all(
+            float(mark.get("width", 0)) > 0 and float(mark.get("height", 0)) > 0 for mark in user_marks
+        )
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+async def analyze_marked_regions(image_bytes: bytes, user_marks: List[dict], cache: str,
+                                 ink_only: bool = False) -> Optional[List[dict]]:
+    """把用户框选的区域裁剪出来发送给视觉模型逐题分析
+
+    框选区域较多时先拼图分析(几个区域一次调用), 拼图中缺少结果的区域再单独并发分析.
+    返回与框选顺序一致的题目分析列表(识别失败的区域跳过); 全部失败时返回 None
+    """
+    region_mistakes: Dict[int, List[dict]] = {}
+    if COLLAGE_MIN_REGIONS and len(user_marks) >= COLLAGE_MIN_REGIONS:
+        region_mistakes = await analyze_collages(
+            image_bytes, user_marks, USER_MARK_COLLAGE_PROMPT, cache, max_size=USER_MARK_CROP_SIZE,
+            padding=USER_MARK_PADDING, byte_budget=IMAGE_BUDGET_CROP, ink_only=ink_only
+        )
+
+    missing = [i for i in range(len(user_marks)) if i not in region_mistakes]
+    if missing:
+        crops = await prepare_crops(image_bytes, [user_marks[i] for i in missing], max_size=USER_MARK_CROP_SIZE, quality=85,
+                                    padding=USER_MARK_PADDING, byte_budget=IMAGE_BUDGET_CROP, ink_only=ink_only)
+        print(f"[错题检测] 裁剪出 {len(crops)} 个框选区域, 并发分析")
+
+        async def analyze_region(crop) -> str:
+            messages = [{
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": crop.data_url
+                        }
+                    },
+                    {
+                        "type": "text",
+                        "text": USER_MARK_REGION_PROMPT
+                    }
+                ]
+            }]
+            return await call_glm_api(messages, model="glm-4v", max_tokens=1000, cache=cache)
+
+        responses = await asyncio.gather(*(analyze_region(crop) for crop in crops), return_exceptions=True)
+
+        for i, response in zip(missing, responses):
+            if isinstance(response, Exception):
+                print(f"[错题检测] 框选区域{i+1}分析失败: {str(response)}")
+                continue
+            data = parse_mistakes_from_response(response)
+            if isinstance(data, dict) and isinstance(data.get("mistakes"), list):
+                region_mistakes[i] = [item for item in data["mistakes"] if isinstance(item, dict)]
+            elif isinstance(data, dict):
+                region_mistakes[i] = [data]
+            else:
+                print(f"[错题检测] 框选区域{i+1}解析失败: {response[:200]}")
+
+    mistakes = []
+    for i in sorted(region_mistakes):
+        for item in region_mistakes[i]:
+            if not item.get("question_no"):
+                item["question_no"] = f"框选题目{i+1}"
+            mistakes.append(item)
+
+    return mistakes or None
+
+
 @app.post("/api/detect/mistakes")
+@with_quality_warnings
 async def detect_mistakes(request: DetectMistakesRequest):
     """
     智能检测试卷中的错题(快速版)
@@ -1492,27 +1862,41 @@ async def detect_mistakes(request: DetectMistakesRequest):
         start_time = time.time()
 
         # 解码图片
-        image = decode_base64_image(request.image_data)
+        image_bytes = request.image_bytes()
+
+        # 质量检查, 以及自动检测模式下的重复试卷哈希和红笔检测共用一次解码
+        await run_page_analysis(request, *(("quality",) if request.user_marks else ("quality", "hash", "marks")))
+
+        # 本地检查拍照质量, 明显无法识别的照片不调用 GLM
+        await check_paper_quality(request)
 
         # 初始化变量
         response_text = ""
         result = None
+        paper_hash = None
 
         # 如果用户提供了标记,使用高质量图片进行详细分析
         if request.user_marks and len(request.user_marks) > 0:
             print(f"[错题检测] 用户提供了 {len(request.user_marks)} 个标记,开始识别和分析")
 
-            # 用户标记模式: 使用高质量图片以便AI能看清题目
-            max_size = 1500  # 更高分辨率
-            if image.width > max_size or image.height > max_size:
-                ratio = min(max_size / image.width, max_size / image.height)
-                new_width = int(image.width * ratio)
-                new_height = int(image.height * ratio)
-                image = image.resize((new_width, new_height))
+            # 框选区域带有大小时只发送各区域的裁剪图(并发分析), 否则整页发送
+            image_url = None
+            if has_marked_regions(request.user_marks):
+                region_mistakes = await analyze_marked_regions(
+                    image_bytes, request.user_marks, cache="detect_mistakes", ink_only=request.use_ink_only()
+                )
+                if region_mistakes:
+                    result = {"mistakes": region_mistakes}
+
+        if result:
+            elapsed = time.time() - start_time
+            print(f"[错题检测] 用户标记区域分析耗时: {elapsed:.2f}秒")
 
-            # 使用较高质量(85)
-            base64_image = encode_image_to_base64(image, quality=85)
-            print(f"[错题检测] 用户标记模式,图片尺寸: {image.width}x{image.height}")
+        elif request.user_marks and len(request.user_marks) > 0:
+            # 用户标记模式: 使用高质量图片以便AI能看清题目
+            prepared = await prepare_task_image(image_bytes, "page", ink_only=request.use_ink_only(), page_crop=True)
+            image_url = prepared.data_url
+            print(f"[错题检测] 用户标记模式,图片尺寸: {prepared.width}x{prepared.height}")
 
             # 识别用户圈选的题目并进行详细分析
             analyze_prompt = f"""用户已经框选了试卷中的 {len(request.user_marks)} 道题目需要分析. 请仔细分析这些题目. 
@@ -1547,7 +1931,7 @@ async def detect_mistakes(request: DetectMistakesRequest):
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
+                            "url": image_url
                         }
                     },
                     {
@@ -1558,7 +1942,7 @@ async def detect_mistakes(request: DetectMistakesRequest):
             }]
 
             # 调用 API 进行详细分析(正常模式,需要详细输出)
-            response_text = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=2000)
+            response_text = await call_glm_api(messages, model="glm-4v", max_tokens=2000, cache="detect_mistakes")
 
             elapsed = time.time() - start_time
             print(f"[错题检测] 用户标记分析耗时: {elapsed:.2f}秒")
@@ -1566,17 +1950,29 @@ async def detect_mistakes(request: DetectMistakesRequest):
 
         else:
             # 没有用户标记,执行自动检测
+            # 同一用户重复上传的试卷直接复用检测结果
+            paper_hash, reused = await find_reused_paper(request, "detect_mistakes")
+            if reused is not None:
+                return reused
+
+            # 先在本地检测红笔批改痕迹, 没有红笔痕迹的试卷不调用视觉模型
+            mark_scan = await scan_red_marks(request, "错题检测")
+            if mark_scan is not None and not mark_scan["has_red_ink"]:
+                elapsed = time.time() - start_time
+                return {
+                    "success": True,
+                    "data": {
+                        "mistakes": [],
+                        "summary": "未发现红笔批改痕迹"
+                    },
+                    "elapsed_time": f"{elapsed:.2f}s"
+                }
+
             # 自动检测模式: 使用中等质量图片以提升准确度
-            max_size = 1200  # 提高分辨率以便AI能看清细节
-            if image.width > max_size or image.height > max_size:
-                ratio = min(max_size / image.width, max_size / image.height)
-                new_width = int(image.width * ratio)
-                new_height = int(image.height * ratio)
-                image = image.resize((new_width, new_height))
-
-            # 使用中等质量(75)来平衡速度和清晰度
-            base64_image = encode_image_to_base64(image, quality=75)
-            print(f"[错题检测] 自动检测模式,图片尺寸: {image.width}x{image.height}")
+            # 1200px + 中等质量(75)来平衡速度和清晰度
+            prepared = await prepare_task_image(image_bytes, "marks", ink_only=request.use_ink_only())
+            image_url = prepared.data_url
+            print(f"[错题检测] 自动检测模式,图片尺寸: {prepared.width}x{prepared.height}")
             # 优化的 prompt - 专注于红叉/红圈标记识别
             detect_prompt = """找出试卷上的错题. 错题必须有清晰的红色×标记在答案上.
 
@@ -1607,13 +2003,17 @@ async def detect_mistakes(request: DetectMistakesRequest):
 
 没有错题: {"mistakes": [], "summary": "未发现错题"}"""
 
+            mark_hint = describe_marks(mark_scan["marks"]) if mark_scan else ""
+            if mark_hint:
+                detect_prompt += f"\n\n本地图像分析在以下位置发现疑似红色批改标记(以图片宽高的百分比表示, 仅供参考, 以图片为准):\n{mark_hint}"
+
             messages = [{
                 "role": "user",
                 "content": [
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
+                            "url": image_url
                         }
                     },
                     {
@@ -1624,7 +2024,7 @@ async def detect_mistakes(request: DetectMistakesRequest):
             }]
 
             # 调用 API(快速模式: 跳过延迟, 减少max_tokens)
-            response_text = call_glm_api(messages, model="glm-4v", skip_delay=True, max_tokens=500)
+            response_text = await call_glm_api(messages, model="glm-4v", max_tokens=500, cache="detect_mistakes")
 
             elapsed = time.time() - start_time
             print(f"[错题检测] 耗时: {elapsed:.2f}秒")
@@ -1632,7 +2032,7 @@ async def detect_mistakes(request: DetectMistakesRequest):
 
         # 方式1: 尝试提取 JSON 代码块(```json ... ```)
         json_match = re.search(r'```json\s*(\{[\s\S]*?\})\s*```', response_text)
-        if json_match:
+        if json_match and not result:
             print(f"[错题检测] 匹配到 JSON 代码块")
             try:
                 result = json.loads(json_match.group(1))
@@ -1698,8 +2098,14 @@ async def detect_mistakes(request: DetectMistakesRequest):
                 print(f"[错题检测] 找到 {len(mistakes_list)} 道错题,开始生成详细学情分析...")
 
                 try:
-                    # 第一步: 识别试卷内容
-                    ocr_prompt = """请识别这张试卷的内容,包括:
+                    # 第一步: 识别试卷内容(框选区域模式下各题内容已识别, 不再发送整页)
+                    if image_url is None:
+                        paper_content = "\n".join(
+                            f"{m.get('question_no', '')}: {m.get('question', '')} 学生答案: {m.get('student_answer', '')}"
+                            for m in mistakes_list
+                        )
+                    else:
+                        ocr_prompt = """请识别这张试卷的内容,包括:
 1. 学科和年级
 2. 题目内容(特别是错题)
 3. 学生答案(如果有)
@@ -1707,24 +2113,24 @@ async def detect_mistakes(request: DetectMistakesRequest):
 
 请用简洁的语言描述. """
 
-                    ocr_messages = [{
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
+                        ocr_messages = [{
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": image_url
+                                    }
+                                },
+                                {
+                                    "type": "text",
+                                    "text": ocr_prompt
                                 }
-                            },
-                            {
-                                "type": "text",
-                                "text": ocr_prompt
-                            }
-                        ]
-                    }]
+                            ]
+                        }]
 
-                    paper_content = call_glm_api(ocr_messages, model="glm-4v", skip_delay=False, max_tokens=1000)
-                    print(f"[错题检测] 试卷内容识别完成,长度: {len(paper_content)} 字符")
+                        paper_content = await call_glm_api(ocr_messages, model="glm-4v", max_tokens=1000, cache="detect_mistakes")
+                        print(f"[错题检测] 试卷内容识别完成,长度: {len(paper_content)} 字符")
 
                     # 第二步: 基于试卷内容生成学情分析
                     mistakes_str = ", ".join([m["question_no"] for m in mistakes_list])
@@ -1751,13 +2157,13 @@ async def detect_mistakes(request: DetectMistakesRequest):
                     }]
 
                     # 使用文本模型生成更详细的分析
-                    analysis_text = call_glm_api(analysis_messages, model="glm-4-flash", skip_delay=False, max_tokens=2500)
+                    analysis_text = await call_glm_api(analysis_messages, model="glm-4-flash", max_tokens=2500, priority=PRIORITY_BULK, cache="detect_mistakes")
 
                     # 打印学情分析内容
                     print(f"[错题检测] 学情分析生成完成,长度: {len(analysis_text)} 字符")
 
                     # 返回结果,包含简要信息和详细分析
-                    return {
+                    detect_result = {
                         "success": True,
                         "data": {
                             "mistakes": mistakes_list,
@@ -1767,6 +2173,8 @@ async def detect_mistakes(request: DetectMistakesRequest):
                         },
                         "elapsed_time": f"{elapsed:.2f}s"
                     }
+                    remember_paper(request, paper_hash, "detect_mistakes", detect_result)
+                    return detect_result
 
                 except Exception as e:
                     print(f"[错题检测] 学情分析生成失败: {str(e)}")
@@ -1782,11 +2190,13 @@ async def detect_mistakes(request: DetectMistakesRequest):
                         "elapsed_time": f"{elapsed:.2f}s"
                     }
 
-            return {
+            detect_result = {
                 "success": True,
                 "data": result,
                 "elapsed_time": f"{elapsed:.2f}s"
             }
+            remember_paper(request, paper_hash, "detect_mistakes", detect_result)
+            return detect_result
 
         # 解析失败,尝试使用降级方案(仅用户标记模式)
         print(f"[错题检测] 开始检查降级处理, user_marks={len(request.user_marks) if request.user_marks else 0}, result={result}")
@@ -1846,7 +2256,7 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
     async def generate_stream():
         import sys
         try:
-            if not request.image_data:
+            if not request.has_image():
                 yield f"data: {json.dumps({'error': '请提供图片数据'})}\n\n"
                 return
 
@@ -1867,8 +2277,9 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
             try:
                 print(f"[错题检测流式] 开始解码图片...")
                 sys.stdout.flush()
-                image = decode_base64_image(request.image_data)
-                print(f"[错题检测流式] 图片解码成功, 尺寸: {image.width}x{image.height}")
+                image_bytes = request.image_bytes()
+                width, height = check_image_header(image_bytes)
+                print(f"[错题检测流式] 图片解码成功, 尺寸: {width}x{height}")
                 sys.stdout.flush()
             except Exception as e:
                 print(f"[错题检测流式] 图片解码失败: {str(e)}")
@@ -1876,27 +2287,39 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
                 yield f"data: {json.dumps({'error': f'图片解码失败: {str(e)}'})}\n\n"
                 return
 
+            # 本地检查拍照质量, 明显无法识别的照片不调用 GLM(自动检测模式下与红笔检测共用一次解码)
+            try:
+                await run_page_analysis(request, *(("quality",) if request.user_marks else ("quality", "marks")))
+                quality_warnings = await check_paper_quality(request)
+            except HTTPException as e:
+                yield f"data: {json.dumps({'error': e.detail})}\n\n"
+                return
+            if quality_warnings:
+                yield f"data: {json.dumps({'status': 'quality_warning', 'message': '; '.join(quality_warnings)})}\n\n"
+
             # 根据是否有用户标记选择处理模式
             if request.user_marks and len(request.user_marks) > 0:
                 # 用户标记模式
                 yield f"data: {json.dumps({'status': 'processing', 'message': '📋 分析用户标记的题目...'})}\n\n"
 
-                max_size = 1500
-                if image.width > max_size or image.height > max_size:
-                    ratio = min(max_size / image.width, max_size / image.height)
-                    new_width = int(image.width * ratio)
-                    new_height = int(image.height * ratio)
-                    image = image.resize((new_width, new_height))
+                # 框选区域带有大小时只发送各区域的裁剪图(并发分析), 否则整页发送
+                mistakes_list = None
+                if has_marked_regions(request.user_marks):
+                    mistakes_list = await analyze_marked_regions(
+                        image_bytes, request.user_marks, cache="detect_mistakes_stream", ink_only=request.use_ink_only()
+                    )
 
-                base64_image = encode_image_to_base64(image, quality=85)
+                if mistakes_list is None:
+                    prepared = await prepare_task_image(image_bytes, "page", ink_only=request.use_ink_only())
+                    image_url = prepared.data_url
 
-                # 构建分析提示
-                marks_desc = "\n".join([
-                    f"框选{i+1}: 位置{mark.get('x', 0)}%,{mark.get('y', 0)}%, 大小{mark.get('width', 0)}%x{mark.get('height', 0)}%"
-                    for i, mark in enumerate(request.user_marks)
-                ])
+                    # 构建分析提示
+                    marks_desc = "\n".join([
+                        f"框选{i+1}: 位置{mark.get('x', 0)}%,{mark.get('y', 0)}%, 大小{mark.get('width', 0)}%x{mark.get('height', 0)}%"
+                        for i, mark in enumerate(request.user_marks)
+                    ])
 
-                analyze_prompt = f"""用户标记了试卷上的{len(request.user_marks)}个区域,需要你分析:
+                    analyze_prompt = f"""用户标记了试卷上的{len(request.user_marks)}个区域,需要你分析:
 {marks_desc}
 
 请按以下步骤分析:
@@ -1923,36 +2346,36 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
 
 注意: 用户框选的都是需要分析的题目,请直接分析内容,不要判断是否为错题."""
 
-                messages = [{
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                    messages = [{
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": image_url
+                                }
+                            },
+                            {
+                                "type": "text",
+                                "text": analyze_prompt
                             }
-                        },
-                        {
-                            "type": "text",
-                            "text": analyze_prompt
-                        }
-                    ]
-                }]
+                        ]
+                    }]
 
-                # 调用 GLM-4V 视觉模型进行分析
-                response_text = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=2000)
+                    # 调用 GLM-4V 视觉模型进行分析
+                    response_text = await call_glm_api(messages, model="glm-4v", max_tokens=2000, cache="detect_mistakes_stream")
 
-                print(f"[错题检测流式] 用户标记模式 API响应:\n{response_text}\n")
+                    print(f"[错题检测流式] 用户标记模式 API响应:\n{response_text}\n")
 
-                # 解析响应
-                result = parse_mistakes_from_response(response_text)
+                    # 解析响应
+                    result = parse_mistakes_from_response(response_text)
 
-                if result is None:
-                    print(f"[错题检测流式] 用户标记模式解析失败")
-                    yield f"data: {json.dumps({'error': f'无法解析AI响应。请重试。'})}\n\n"
-                    return
+                    if result is None:
+                        print(f"[错题检测流式] 用户标记模式解析失败")
+                        yield f"data: {json.dumps({'error': f'无法解析AI响应。请重试。'})}\n\n"
+                        return
 
-                mistakes_list = result.get("mistakes", [])
+                    mistakes_list = result.get("mistakes", [])
 
                 if mistakes_list:
                     # 逐步发送结果
@@ -1981,11 +2404,8 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
                     }]
 
                     # 使用流式返回分析文本
-                    analysis_text = call_glm_api(analysis_messages, model="glm-4-flash", skip_delay=False, max_tokens=2500)
-
-                    # 逐字返回学情分析
-                    for char in analysis_text:
-                        yield f"data: {json.dumps({'content': char})}\n\n"
+                    async for delta in stream_glm_api(analysis_messages, model="glm-4-flash", max_tokens=2500, priority=PRIORITY_BULK, cache="detect_mistakes_stream"):
+                        yield f"data: {json.dumps({'content': delta})}\n\n"
 
                     # 发送完成数据和结果
                     yield f"data: {json.dumps({'done': True, 'data': {'mistakes': mistakes_list, 'need_confirmation': True}})}\n\n"
@@ -1993,17 +2413,18 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
                     yield f"data: {json.dumps({'error': '未能识别到标记的题目，请重试'})}\n\n"
 
             else:
-                # 自动检测模式 - 使用GLM-4V识别试卷上的红叉
-                yield f"data: {json.dumps({'status': 'processing', 'message': '🔍 使用AI视觉模型识别错题标记...'})}\n\n"
+                # 自动检测模式 - 先在本地检测红笔批改痕迹, 没有红笔痕迹的试卷不调用视觉模型
+                mark_scan = await scan_red_marks(request, "错题检测流式")
+                if mark_scan is not None and not mark_scan["has_red_ink"]:
+                    yield f"data: {json.dumps({'status': 'no_mistakes', 'message': '✅ 未发现红笔批改痕迹'})}\n\n"
+                    yield f"data: {json.dumps({'done': True, 'data': {'mistakes': [], 'need_confirmation': False}})}\n\n"
+                    return
 
-                max_size = 1200
-                if image.width > max_size or image.height > max_size:
-                    ratio = min(max_size / image.width, max_size / image.height)
-                    new_width = int(image.width * ratio)
-                    new_height = int(image.height * ratio)
-                    image = image.resize((new_width, new_height))
+                # 使用GLM-4V识别试卷上的红叉
+                yield f"data: {json.dumps({'status': 'processing', 'message': '🔍 使用AI视觉模型识别错题标记...'})}\n\n"
 
-                base64_image = encode_image_to_base64(image, quality=75)
+                prepared = await prepare_task_image(image_bytes, "marks", ink_only=request.use_ink_only())
+                image_url = prepared.data_url
 
                 detect_prompt = """请分析这张试卷，找出所有有错误的题目。
 
@@ -2027,13 +2448,17 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
 
 开始识别："""
 
+                mark_hint = describe_marks(mark_scan["marks"]) if mark_scan else ""
+                if mark_hint:
+                    detect_prompt = f"本地图像分析在以下位置发现疑似红色批改标记(以图片宽高的百分比表示, 仅供参考, 以图片为准):\n{mark_hint}\n\n{detect_prompt}"
+
                 messages = [{
                     "role": "user",
                     "content": [
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": image_url
                             }
                         },
                         {
@@ -2049,7 +2474,7 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
                 print(f"[错题检测流式] content长度: {len(messages[0]['content'])}")
                 sys.stdout.flush()
 
-                response_text = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=1500)
+                response_text = await call_glm_api(messages, model="glm-4v", max_tokens=1500, cache="detect_mistakes_stream")
 
                 print(f"[错题检测流式] API调用完成")
                 print(f"[错题检测流式] API响应类型: {type(response_text)}")
@@ -2130,11 +2555,9 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
                         "content": analysis_prompt
                     }]
 
-                    analysis_text = call_glm_api(analysis_messages, model="glm-4-flash", skip_delay=False, max_tokens=2500)
-
-                    # 逐字返回学情分析
-                    for char in analysis_text:
-                        yield f"data: {json.dumps({'content': char})}\n\n"
+                    # 边生成边返回学情分析
+                    async for delta in stream_glm_api(analysis_messages, model="glm-4-flash", max_tokens=2500, priority=PRIORITY_BULK, cache="detect_mistakes_stream"):
+                        yield f"data: {json.dumps({'content': delta})}\n\n"
 
                     # 发送完成数据
                     yield f"data: {json.dumps({'done': True, 'data': {'mistakes': mistakes_list, 'need_confirmation': True}})}\n\n"
@@ -2156,6 +2579,7 @@ async def detect_mistakes_stream(request: DetectMistakesRequest):
 # ==================== 智能分析API ====================
 
 @app.post("/api/analyze/smart")
+@with_quality_warnings
 async def smart_analyze(request: DetectMistakesRequest):
     """
     智能分析API - 自动判断内容类型并执行相应分析
@@ -2169,7 +2593,10 @@ async def smart_analyze(request: DetectMistakesRequest):
         start_time = time.time()
 
         # 解码图片
-        image = decode_base64_image(request.image_data)
+        image_bytes = request.image_bytes()
+
+        # 本地检查拍照质量, 明显无法识别的照片不调用 GLM
+        await check_paper_quality(request)
 
         # 判断用户标记数量
         user_marks_count = len(request.user_marks) if request.user_marks else 0
@@ -2185,14 +2612,8 @@ async def smart_analyze(request: DetectMistakesRequest):
         # 如果用户有标记，使用标记模式；否则自动检测
         if user_marks_count > 0:
             # 用户标记模式
-            max_size = 1500
-            if image.width > max_size or image.height > max_size:
-                ratio = min(max_size / image.width, max_size / image.height)
-                new_width = int(image.width * ratio)
-                new_height = int(image.height * ratio)
-                image = image.resize((new_width, new_height))
-
-            base64_image = encode_image_to_base64(image, quality=85)
+            prepared = await prepare_task_image(image_bytes, "page", page_crop=True)
+            image_url = prepared.data_url
 
             analyze_prompt = f"""用户标记了试卷上的{user_marks_count}个区域需要分析。
 
@@ -2219,12 +2640,12 @@ async def smart_analyze(request: DetectMistakesRequest):
             messages = [{
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                    {"type": "image_url", "image_url": {"url": image_url}},
                     {"type": "text", "text": analyze_prompt}
                 ]
             }]
 
-            response_text = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=2000)
+            response_text = await call_glm_api(messages, model="glm-4v", max_tokens=2000, cache="analyze_smart")
 
             # 解析响应
             mistakes = []
@@ -2248,22 +2669,18 @@ async def smart_analyze(request: DetectMistakesRequest):
 
 如果没有错题，返回: {"mistakes": []}"""
 
-            max_size = 1200
-            if image.width > max_size or image.height > max_size:
-                ratio = min(max_size / image.width, max_size / image.height)
-                image = image.resize((int(image.width * ratio), int(image.height * ratio)))
-
-            base64_image = encode_image_to_base64(image, quality=75)
+            prepared = await prepare_task_image(image_bytes, "marks", page_crop=True)
+            image_url = prepared.data_url
 
             messages = [{
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                    {"type": "image_url", "image_url": {"url": image_url}},
                     {"type": "text", "text": detect_prompt}
                 ]
             }]
 
-            response_text = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=1500)
+            response_text = await call_glm_api(messages, model="glm-4v", max_tokens=1500, cache="analyze_smart")
 
             # 解析响应
             mistakes = []
@@ -2296,16 +2713,18 @@ async def smart_analyze(request: DetectMistakesRequest):
 
 请只返回学科名称（如：英语、数学、语文等），不要其他内容。如果无法确定，返回"未知"。"""
 
+        # 判断学科只需看清版面和字形, 发送灰度缩略图
+        subject_image = await prepare_task_image(image_bytes, "subject", page_crop=True)
         subject_messages = [{
             "role": "user",
             "content": [
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                {"type": "image_url", "image_url": {"url": subject_image.data_url}},
                 {"type": "text", "text": subject_prompt}
             ]
         }]
 
         try:
-            subject = call_glm_api(subject_messages, model="glm-4v", skip_delay=True, max_tokens=50)
+            subject = await call_glm_api(subject_messages, model="glm-4v", max_tokens=50, cache="analyze_smart")
             # 清理结果，提取学科名称
             subject = subject.strip()
             print(f"[智能分析] 模型原始返回: '{subject}'")  # 添加调试日志
@@ -2363,7 +2782,7 @@ async def smart_analyze(request: DetectMistakesRequest):
                 "content": analysis_prompt
             }]
 
-            analysis_response = call_glm_api(analysis_messages, model="glm-4-flash", skip_delay=False, max_tokens=3000)
+            analysis_response = await call_glm_api(analysis_messages, model="glm-4-flash", max_tokens=3000, priority=PRIORITY_BULK, cache="analyze_smart")
 
             elapsed = time.time() - start_time
 
@@ -2395,7 +2814,7 @@ async def smart_analyze(request: DetectMistakesRequest):
                     "content": guide_prompt
                 }]
 
-                guide_response = call_glm_api(guide_messages, model="glm-4-flash", skip_delay=False, max_tokens=2000)
+                guide_response = await call_glm_api(guide_messages, model="glm-4-flash", max_tokens=2000, cache="analyze_smart")
 
                 elapsed = time.time() - start_time
 
@@ -2446,9 +2865,18 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
             yield f"data: {json.dumps({'status': 'start', 'message': '开始智能分析...'})}\n\n"
 
             # 解码图片
-            image = decode_base64_image(request.image_data)
+            image_bytes = request.image_bytes()
             user_marks_count = len(request.user_marks) if request.user_marks else 0
 
+            # 本地检查拍照质量, 明显无法识别的照片不调用 GLM
+            try:
+                quality_warnings = await check_paper_quality(request)
+            except HTTPException as e:
+                yield f"data: {json.dumps({'error': e.detail})}\n\n"
+                return
+            if quality_warnings:
+                yield f"data: {json.dumps({'status': 'quality_warning', 'message': '; '.join(quality_warnings)})}\n\n"
+
             print(f"[智能分析流式] 用户标记: {user_marks_count}, analysis_type: {request.analysis_type}")
             sys.stdout.flush()
 
@@ -2458,14 +2886,8 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
                 yield f"data: {json.dumps({'status': 'analyzing', 'message': '正在分析试卷内容...'})}\n\n"
 
                 # 识别试卷学科和内容
-                max_size = 1200
-                if image.width > max_size or image.height > max_size:
-                    ratio = min(max_size / image.width, max_size / image.height)
-                    new_width = int(image.width * ratio)
-                    new_height = int(image.height * ratio)
-                    image = image.resize((new_width, new_height))
-
-                base64_image = encode_image_to_base64(image, quality=75)
+                prepared = await prepare_task_image(image_bytes, "marks", page_crop=True)
+                image_url = prepared.data_url
 
                 # 识别试卷内容
                 content_prompt = """请仔细观察这张试卷，提供以下信息：
@@ -2480,12 +2902,12 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
                 messages = [{
                     "role": "user",
                     "content": [
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                        {"type": "image_url", "image_url": {"url": image_url}},
                         {"type": "text", "text": content_prompt}
                     ]
                 }]
 
-                paper_content = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=1000)
+                paper_content = await call_glm_api(messages, model="glm-4v", max_tokens=1000, cache="analyze_smart_stream")
                 print(f"[智能分析流式] 试卷内容识别完成")
 
                 # 识别学科类型
@@ -2493,16 +2915,18 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
 
 请只返回学科名称（如：英语、数学、语文等），不要其他内容。如果无法确定，返回"未知"。"""
 
+                # 判断学科只需看清版面和字形, 发送灰度缩略图
+                subject_image = await prepare_task_image(image_bytes, "subject", page_crop=True)
                 subject_messages = [{
                     "role": "user",
                     "content": [
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                        {"type": "image_url", "image_url": {"url": subject_image.data_url}},
                         {"type": "text", "text": subject_prompt}
                     ]
                 }]
 
                 try:
-                    subject = call_glm_api(subject_messages, model="glm-4v", skip_delay=True, max_tokens=50)
+                    subject = await call_glm_api(subject_messages, model="glm-4v", max_tokens=50, cache="analyze_smart_stream")
                     subject = subject.strip()
 
                     # 匹配学科
@@ -2539,10 +2963,8 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
                 }]
 
                 # 使用流式输出学情分析
-                analysis_response = call_glm_api(analysis_messages, model="glm-4-flash", skip_delay=False, max_tokens=3000)
-
-                for char in analysis_response:
-                    yield f"data: {json.dumps({'content': char})}\n\n"
+                async for delta in stream_glm_api(analysis_messages, model="glm-4-flash", max_tokens=3000, priority=PRIORITY_BULK, cache="analyze_smart_stream"):
+                    yield f"data: {json.dumps({'content': delta})}\n\n"
 
                 # 完成
                 yield f"data: {json.dumps({'done': True, 'data': {'mistakes': [], 'need_confirmation': False}})}\n\n"
@@ -2556,14 +2978,8 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
 
                 if user_marks_count > 0:
                     # 用户标记模式
-                    max_size = 1500
-                    if image.width > max_size or image.height > max_size:
-                        ratio = min(max_size / image.width, max_size / image.height)
-                        new_width = int(image.width * ratio)
-                        new_height = int(image.height * ratio)
-                        image = image.resize((new_width, new_height))
-
-                    base64_image = encode_image_to_base64(image, quality=85)
+                    prepared = await prepare_task_image(image_bytes, "page", page_crop=True)
+                    image_url = prepared.data_url
 
                     analyze_prompt = f"""用户标记了试卷上的{user_marks_count}个区域需要分析。
 
@@ -2590,12 +3006,12 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
                     messages = [{
                         "role": "user",
                         "content": [
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                            {"type": "image_url", "image_url": {"url": image_url}},
                             {"type": "text", "text": analyze_prompt}
                         ]
                     }]
 
-                    response_text = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=2000)
+                    response_text = await call_glm_api(messages, model="glm-4v", max_tokens=2000, cache="analyze_smart_stream")
 
                     # 解析响应
                     json_match = re.search(r'\{[\s\S]*"mistakes"[\s\S]*\}', response_text)
@@ -2618,22 +3034,18 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
 
 如果没有错题，返回: {"mistakes": []}"""
 
-                    max_size = 1200
-                    if image.width > max_size or image.height > max_size:
-                        ratio = min(max_size / image.width, max_size / image.height)
-                        image = image.resize((int(image.width * ratio), int(image.height * ratio)))
-
-                    base64_image = encode_image_to_base64(image, quality=75)
+                    prepared = await prepare_task_image(image_bytes, "marks", page_crop=True)
+                    image_url = prepared.data_url
 
                     messages = [{
                         "role": "user",
                         "content": [
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                            {"type": "image_url", "image_url": {"url": image_url}},
                             {"type": "text", "text": detect_prompt}
                         ]
                     }]
 
-                    response_text = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=1500)
+                    response_text = await call_glm_api(messages, model="glm-4v", max_tokens=1500, cache="analyze_smart_stream")
 
                     # 解析响应
                     json_match = re.search(r'\{[\s\S]*"mistakes"[\s\S]*\}', response_text)
@@ -2654,16 +3066,18 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
 
 请只返回学科名称（如：英语、数学、语文等），不要其他内容。如果无法确定，返回"未知"。"""
 
+                # 判断学科只需看清版面和字形, 发送灰度缩略图
+                subject_image = await prepare_task_image(image_bytes, "subject", page_crop=True)
                 subject_messages = [{
                     "role": "user",
                     "content": [
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                        {"type": "image_url", "image_url": {"url": subject_image.data_url}},
                         {"type": "text", "text": subject_prompt}
                     ]
                 }]
 
                 try:
-                    subject = call_glm_api(subject_messages, model="glm-4v", skip_delay=True, max_tokens=50)
+                    subject = await call_glm_api(subject_messages, model="glm-4v", max_tokens=50, cache="analyze_smart_stream")
                     subject = subject.strip()
 
                     # 匹配学科
@@ -2709,10 +3123,8 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
                     }]
 
                     # 使用流式输出
-                    analysis_response = call_glm_api(analysis_messages, model="glm-4-flash", skip_delay=False, max_tokens=3000)
-
-                    for char in analysis_response:
-                        yield f"data: {json.dumps({'content': char})}\n\n"
+                    async for delta in stream_glm_api(analysis_messages, model="glm-4-flash", max_tokens=3000, priority=PRIORITY_BULK, cache="analyze_smart_stream"):
+                        yield f"data: {json.dumps({'content': delta})}\n\n"
 
                     # 完成
                     yield f"data: {json.dumps({'done': True, 'data': {'mistakes': mistakes, 'need_confirmation': True}})}\n\n"
@@ -2731,7 +3143,7 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
                             "content": guide_prompt
                         }]
 
-                        guide_response = call_glm_api(guide_messages, model="glm-4-flash", skip_delay=False, max_tokens=1500)
+                        guide_response = await call_glm_api(guide_messages, model="glm-4-flash", max_tokens=1500, cache="analyze_smart_stream")
 
                         # 解析JSON格式的问题选项
                         questions_data = None
@@ -2749,9 +3161,8 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
                             yield f"data: {json.dumps({'type': 'guide_questions', 'data': questions_data})}\n\n"
                             yield f"data: {json.dumps({'done': True, 'data': {'mistake': first_mistake, 'total_mistakes': mistakes, 'guide_mode': True}})}\n\n"
                         else:
-                            # 如果解析失败，返回原始文本
-                            for char in guide_response:
-                                yield f"data: {json.dumps({'content': char})}\n\n"
+                            # 如果解析失败，返回原始文本(需先拿到完整回复才能判断格式, 一次性发送)
+                            yield f"data: {json.dumps({'content': guide_response})}\n\n"
                             yield f"data: {json.dumps({'done': True, 'data': {'mistake': first_mistake, 'total_mistakes': mistakes}})}\n\n"
                     else:
                         yield f"data: {json.dumps({'error': '未检测到错题', 'done': True})}\n\n"
@@ -2768,6 +3179,7 @@ async def smart_analyze_stream(request: DetectMistakesRequest):
 
 
 @app.post("/api/detect/questions")
+@with_quality_warnings
 async def detect_questions(request: OCRRequest):
     """
     检测试卷中的所有题目，返回题目列表供用户选择
@@ -2779,18 +3191,21 @@ async def detect_questions(request: OCRRequest):
         start_time = time.time()
 
         # 解码图片
-        image = decode_base64_image(request.image_data)
+        image_bytes = request.image_bytes()
 
-        # 使用较高分辨率以便AI能看清题目
-        max_size = 1500
-        if image.width > max_size or image.height > max_size:
-            ratio = min(max_size / image.width, max_size / image.height)
-            new_width = int(image.width * ratio)
-            new_height = int(image.height * ratio)
-            image = image.resize((new_width, new_height))
+        # 本地检查拍照质量, 明显无法识别的照片不调用 GLM(与重复试卷哈希共用一次解码)
+        await run_page_analysis(request, "quality", "hash")
+        await check_paper_quality(request)
+
+        # 同一用户重复上传的试卷直接复用题目列表
+        paper_hash, reused = await find_reused_paper(request, "detect_questions")
+        if reused is not None:
+            return reused
 
-        base64_image = encode_image_to_base64(image, quality=85)
-        print(f"[题目检测] 图片尺寸: {image.width}x{image.height}")
+        # 使用较高分辨率以便AI能看清题目
+        prepared = await prepare_task_image(image_bytes, "page", ink_only=request.use_ink_only(), page_crop=True)
+        image_url = prepared.data_url
+        print(f"[题目检测] 图片尺寸: {prepared.width}x{prepared.height}")
 
         # 构建识别题目列表的 prompt
         detect_prompt = """请识别这张试卷中的所有题目。
@@ -2822,7 +3237,7 @@ async def detect_questions(request: OCRRequest):
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
+                        "url": image_url
                     }
                 },
                 {
@@ -2832,7 +3247,7 @@ async def detect_questions(request: OCRRequest):
             ]
         }]
 
-        response_text = call_glm_api(messages, model="glm-4v", skip_delay=False, max_tokens=2000)
+        response_text = await call_glm_api(messages, model="glm-4v", max_tokens=2000, cache="detect_questions")
 
         # 解析响应
         questions = []
@@ -2856,12 +3271,15 @@ async def detect_questions(request: OCRRequest):
         elapsed = time.time() - start_time
         print(f"[题目检测] 完成，检测到 {len(questions)} 道题目，耗时: {elapsed:.2f}秒")
 
-        return {
+        result = {
             "success": True,
             "questions": questions,
             "count": len(questions),
             "elapsed_time": f"{elapsed:.2f}s"
         }
+        if questions:
+            remember_paper(request, paper_hash, "detect_questions", result)
+        return result
 
     except HTTPException:
         raise
@@ -2979,7 +3397,7 @@ async def continue_guidance(request: GuideRequest):
             "content": continue_prompt
         }]
 
-        response_text = call_glm_api(messages, model="glm-4-flash", skip_delay=False, max_tokens=1500)
+        response_text = await call_glm_api(messages, model="glm-4-flash", max_tokens=1500, priority=PRIORITY_INTERACTIVE, hedge="guide_continue")
 
         # 解析JSON响应
         import json
@@ -3026,7 +3444,7 @@ async def generate_guide_questions(request: dict):
             "content": prompt
         }]
 
-        response_text = call_glm_api(messages, model="glm-4-flash", skip_delay=False, max_tokens=1500)
+        response_text = await call_glm_api(messages, model="glm-4-flash", max_tokens=1500, cache="generate_guide_questions")
 
         # 解析JSON格式的响应
         import re
@@ -3049,6 +3467,168 @@ async def generate_guide_questions(request: dict):
         raise HTTPException(status_code=500, detail=f"生成引导问题失败: {str(e)}")
 
 
+# ==================== 文件上传(multipart)端点 ====================
+# 与上面的 JSON 端点功能相同, 图片以 multipart/form-data 文件上传, 省去 base64 的 33% 体积;
+# 列表类字段(user_marks, conversation_history)以 JSON 字符串放在表单中
+
+def parse_json_form(value: Optional[str], field: str, default):
+    """解析表单中的 JSON 字段"""
+    if not value:
+        return default
+    try:
+        return json.loads(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"表单字段 {field} 不是有效的 JSON")
+
+
+async def read_optional_image(file: Optional[UploadFile]) -> Optional[bytes]:
+    return await read_image_file(file) if file is not None and file.filename else None
+
+
+def detect_request_from_form(image_bytes: bytes, user_marks: Optional[str], analysis_type: Optional[str],
+                             user_id: Optional[str] = None, ink_only: Optional[bool] = None,
+                             tiled: Optional[bool] = None) -> DetectMistakesRequest:
+    return DetectMistakesRequest.from_upload(
+        image_bytes,
+        user_marks=parse_json_form(user_marks, "user_marks", []),
+        analysis_type=analysis_type or None,
+        user_id=user_id or None,
+        ink_only=ink_only,
+        tiled=tiled
+    )
+
+
+@app.post("/api/ocr/exam/upload")
+async def ocr_exam_paper_upload(
+    file: UploadFile = File(...),
+    user_id: Optional[str] = Form(None),
+    ink_only: Optional[bool] = Form(None),
+    tiled: Optional[bool] = Form(None)
+):
+    """试卷 OCR 识别(上传图片文件)"""
+    return await ocr_exam_paper(OCRRequest.from_upload(
+        await read_image_file(file), user_id=user_id or None, ink_only=ink_only, tiled=tiled
+    ))
+
+
+@app.post("/api/analyze/question/upload")
+async def analyze_question_upload(
+    file: Optional[UploadFile] = File(None),
+    question_text: Optional[str] = Form(None),
+    student_answer: Optional[str] = Form(None)
+):
+    """分析单道题目(上传图片文件)"""
+    request = QuestionAnalyzeRequest.from_upload(
+        await read_optional_image(file),
+        question_text=question_text,
+        student_answer=student_answer
+    )
+    return await analyze_question(request)
+
+
+@app.post("/api/chat/upload")
+async def chat_upload(
+    message: str = Form(...),
+    conversation_history: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None)
+):
+    """AI 对话(上传图片文件)"""
+    request = ChatRequest.from_upload(
+        await read_optional_image(file),
+        message=message,
+        conversation_history=parse_json_form(conversation_history, "conversation_history", [])
+    )
+    return await chat(request)
+
+
+@app.post("/api/chat/stream/upload")
+async def chat_stream_upload(
+    message: str = Form(...),
+    conversation_history: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None)
+):
+    """流式 AI 对话(上传图片文件)"""
+    request = ChatRequest.from_upload(
+        await read_optional_image(file),
+        message=message,
+        conversation_history=parse_json_form(conversation_history, "conversation_history", [])
+    )
+    return await chat_stream(request)
+
+
+@app.post("/api/detect/mistakes/smart/upload")
+async def smart_detect_mistakes_upload(
+    file: UploadFile = File(...),
+    user_marks: Optional[str] = Form(None),
+    analysis_type: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None),
+    ink_only: Optional[bool] = Form(None),
+    tiled: Optional[bool] = Form(None)
+):
+    """智能错题检测(上传图片文件)"""
+    return await smart_detect_mistakes(detect_request_from_form(
+        await read_image_file(file), user_marks, analysis_type, user_id, ink_only, tiled
+    ))
+
+
+@app.post("/api/detect/mistakes/upload")
+async def detect_mistakes_upload(
+    file: UploadFile = File(...),
+    user_marks: Optional[str] = Form(None),
+    analysis_type: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None),
+    ink_only: Optional[bool] = Form(None)
+):
+    """错题检测(上传图片文件)"""
+    return await detect_mistakes(detect_request_from_form(await read_image_file(file), user_marks, analysis_type, user_id, ink_only))
+
+
+@app.post("/api/detect/mistakes/stream/upload")
+async def detect_mistakes_stream_upload(
+    file: UploadFile = File(...),
+    user_marks: Optional[str] = Form(None),
+    analysis_type: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None),
+    ink_only: Optional[bool] = Form(None)
+):
+    """流式错题检测(上传图片文件)"""
+    return await detect_mistakes_stream(detect_request_from_form(await read_image_file(file), user_marks, analysis_type, user_id, ink_only))
+
+
+@app.post("/api/analyze/smart/upload")
+async def smart_analyze_upload(
+    file: UploadFile = File(...),
+    user_marks: Optional[str] = Form(None),
+    analysis_type: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None),
+    ink_only: Optional[bool] = Form(None)
+):
+    """智能分析(上传图片文件)"""
+    return await smart_analyze(detect_request_from_form(await read_image_file(file), user_marks, analysis_type, user_id, ink_only))
+
+
+@app.post("/api/analyze/smart/stream/upload")
+async def smart_analyze_stream_upload(
+    file: UploadFile = File(...),
+    user_marks: Optional[str] = Form(None),
+    analysis_type: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None),
+    ink_only: Optional[bool] = Form(None)
+):
+    """流式智能分析(上传图片文件)"""
+    return await smart_analyze_stream(detect_request_from_form(await read_image_file(file), user_marks, analysis_type, user_id, ink_only))
+
+
+@app.post("/api/detect/questions/upload")
+async def detect_questions_upload(
+    file: UploadFile = File(...),
+    user_id: Optional[str] = Form(None),
+    ink_only: Optional[bool] = Form(None)
+):
+    """检测试卷题目(上传图片文件)"""
+    return await detect_questions(OCRRequest.from_upload(await read_image_file(file), user_id=user_id or None, ink_only=ink_only))
+
+
 # ==================== 启动服务器 ====================
 if __name__ == "__main__":
     print("=" * 60)
@@ -0,0 +1,248 @@
+"""
+本地红笔批改标记检测
+在 HSV 空间提取红色笔迹, 用行程(run)并查集求连通域, 再按形状把每个连通域分为
+×(cross), √(check), ○(circle); 全部用 NumPy 向量化计算, 不依赖 OpenCV.
+用于在调用 glm-4v 之前预筛试卷: 没有红笔痕迹的试卷直接跳过视觉模型调用,
+有红笔痕迹的试卷把候选位置作为提示发给模型
+"""
+
+import os
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+from image_pipeline import load_image
+
+# ==================== 配置 ====================
+
+# 检测时把图片缩小到的长边像素(标记检测不需要高分辨率)
+MARK_ANALYSIS_SIZE = int(os.getenv("MARK_ANALYSIS_SIZE", "1200"))
+# 红色判定(Pillow HSV, 各分量范围 0-255): 色相在 [0, HUE_MAX] 或 [HUE_MIN, 255] 之间,
+# 照片中的红笔笔迹常偏暗偏紫红, 饱和度和亮度下限不宜过高
+MARK_RED_HUE_MAX = int(os.getenv("MARK_RED_HUE_MAX", "12"))
+MARK_RED_HUE_MIN = int(os.getenv("MARK_RED_HUE_MIN", "225"))
+MARK_RED_MIN_SATURATION = int(os.getenv("MARK_RED_MIN_SATURATION", "35"))
+MARK_RED_MIN_VALUE = int(os.getenv("MARK_RED_MIN_VALUE", "50"))
+# 红色像素占比低于该值视为没有红笔批改
+MARK_MIN_RED_RATIO = float(os.getenv("MARK_MIN_RED_RATIO", "0.0003"))
+# 保留的候选标记最低置信度
+MARK_MIN_CONFIDENCE = float(os.getenv("MARK_MIN_CONFIDENCE", "0.5"))
+
+# 标记尺寸范围(相对图片长边), 过小为噪点, 过大为红色标题/分数等
+MARK_MIN_SIZE_RATIO = 0.015
+MARK_MAX_SIZE_RATIO = 0.15
+# 求连通域前按该倍数合并像素块并膨胀, 把细而断续的笔迹连成整体
+MARK_POOL_FACTOR = 3
+MARK_DILATE_RADIUS = 2
+# 3x3 格中笔迹像素占比达到该值视为该格笔迹强度为 1
+MARK_CELL_FULL = 0.08
+
+# 标记类型
+MARK_CROSS = "cross"  # ×, 错误
+MARK_CHECK = "check"  # √, 正确
+MARK_CIRCLE = "circle"  # ○, 圈出的错误或重点
+
+
+# ==================== 红色笔迹提取 ====================
+
+def red_ink_mask(image: Image.Image) -> np.ndarray:
+    """红色笔迹掩码(HSV 阈值)"""
+    hsv = np.asarray(image.convert("RGB").convert("HSV"))
+    hue, saturation, value = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    is_red_hue = (hue <= MARK_RED_HUE_MAX) | (hue >= MARK_RED_HUE_MIN)
+    return is_red_hue & (saturation >= MARK_RED_MIN_SATURATION) & (value >= MARK_RED_MIN_VALUE)
+
+
+def block_pool(mask: np.ndarray, factor: int) -> np.ndarray:
+    """按 factor x factor 像素块合并(块内有任一前景像素即为前景)"""
+    height, width = mask.shape[0] // factor * factor, mask.shape[1] // factor * factor
+    return mask[:height, :width].reshape(height // factor, factor, width // factor, factor).any(axis=(1, 3))
+
+
+def dilate(mask: np.ndarray, radius: int = 1) -> np.ndarray:
+    """二值膨胀(连接笔迹中的细小断点)"""
+    height, width = mask.shape
+    padded = np.pad(mask, radius)
+    result = np.zeros_like(mask)
+    for dy in range(2 * radius + 1):
+        for dx in range(2 * radius + 1):
+            result |= padded[dy:dy + height, dx:dx + width]
+    return result
+
+
+# ==================== 连通域 ====================
+
+def find_runs(mask: np.ndarray):
+    """逐行提取前景行程, 返回 (行号, 起始列, 结束列(不含)) 三个数组, 按行排序"""
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    diff = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(diff == 1)
+    _, ends = np.nonzero(diff == -1)
+    return rows, starts, ends
+
+
+def connected_components(mask: np.ndarray) -> List[dict]:
+    """8 连通域: 相邻两行中列范围重叠(含对角相邻)的行程属于同一连通域
+
+    返回每个连通域的外接框 (x0, y0, x1, y1) (不含右/下边界) 和像素数
+    """
+    rows, starts, ends = find_runs(mask)
+    count = len(rows)
+    if count == 0:
+        return []
+
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # 每行行程在数组中的范围
+    row_bounds = np.searchsorted(rows, np.arange(mask.shape[0] + 1))
+    for row in range(1, mask.shape[0]):
+        prev_begin, prev_end = row_bounds[row - 1], row_bounds[row]
+        cur_begin, cur_end = row_bounds[row], row_bounds[row + 1]
+        i, j = prev_begin, cur_begin
+        while i < prev_end and j < cur_end:
+            if starts[i] <= ends[j] and starts[j] <= ends[i]:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[root_j] = root_i
+            # 先结束的行程不会再与后面的行程相交
+            if ends[i] < ends[j]:
+                i += 1
+            else:
+                j += 1
+
+    roots = np.array([find(i) for i in range(count)])
+    components = []
+    for root in np.unique(roots):
+        members = np.nonzero(roots == root)[0]
+        components.append({
+            "box": (int(starts[members].min()), int(rows[members].min()),
+                    int(ends[members].max()), int(rows[members].max()) + 1),
+            "pixels": int((ends[members] - starts[members]).sum())
+        })
+    return components
+
+
+# ==================== 形状分类 ====================
+
+def trim_mask(mask: np.ndarray):
+    """裁掉四周没有笔迹的行列, 返回 (裁剪后的掩码, (x0, y0, x1, y1)); 没有笔迹时返回 (None, None)"""
+    rows = np.nonzero(mask.any(axis=1))[0]
+    cols = np.nonzero(mask.any(axis=0))[0]
+    if not len(rows):
+        return None, None
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    return mask[y0:y1, x0:x1], (int(x0), int(y0), int(x1), int(y1))
+
+
+def cell_strength(mask: np.ndarray) -> np.ndarray:
+    """把外接框等分为 3x3 格, 返回每格的笔迹强度(0-1)"""
+    height, width = mask.shape
+    rows = np.linspace(0, height, 4).astype(int)
+    cols = np.linspace(0, width, 4).astype(int)
+    strength = np.zeros((3, 3))
+    for i in range(3):
+        for j in range(3):
+            cell = mask[rows[i]:max(rows[i + 1], rows[i] + 1), cols[j]:max(cols[j + 1], cols[j] + 1)]
+            strength[i, j] = min(1.0, cell.mean() / MARK_CELL_FULL) if cell.size else 0.0
+    return strength
+
+
+def classify_mark(mask: np.ndarray):
+    """按 3x3 格的笔迹分布判断标记类型, 返回 (类型, 置信度); 无法判断时类型为 None
+
+    ×: 四角和中心有笔迹, 四边中点没有(两条对角线只经过这 5 格)
+    ○: 四边中点有笔迹, 中心没有
+    √: 右上角和下方有笔迹, 左上角和右下角没有
+    """
+    height, width = mask.shape
+    if not 0.3 <= width / height <= 3.0:
+        return None, 0.0
+
+    cells = cell_strength(mask)
+    corners = np.array([cells[0, 0], cells[0, 2], cells[2, 0], cells[2, 2]])
+    edges = np.array([cells[0, 1], cells[1, 0], cells[1, 2], cells[2, 1]])
+    center = cells[1, 1]
+
+    scores = {
+        MARK_CROSS: float(np.append(corners, center).mean() * (1 - edges.mean())),
+        MARK_CIRCLE: float(edges.mean() * (1 - center)),
+        MARK_CHECK: float(min(cells[0, 2], max(cells[2, 0], cells[2, 1])) * (1 - cells[0, 0]) * (1 - cells[2, 2]))
+    }
+    mark_type = max(scores, key=scores.get)
+    return mark_type, scores[mark_type]
+
+
+# ==================== 检测入口 ====================
+
+def detect_marks(data: bytes) -> dict:
+    """检测试卷上的红笔批改标记(在进程池中执行)
+
+    Returns:
+        {
+            "red_ratio": 红色像素占比,
+            "has_red_ink": 是否有红笔批改,
+            "marks": [{"type": "cross", "x": 50.0, "y": 30.0, "width": 3.0, "height": 2.5, "confidence": 0.9}, ...]
+        }
+        坐标为占图片宽高的百分比(与前端 user_marks 的格式一致), 按从上到下, 从左到右排序
+    """
+    image, _ = load_image(data, max_size=MARK_ANALYSIS_SIZE)
+    return detect_image_marks(image)
+
+
+def detect_image_marks(image: Image.Image) -> dict:
+    """在已解码的分析图(长边不超过 MARK_ANALYSIS_SIZE)上检测红笔批改标记, 返回格式同 detect_marks"""
+    mask = red_ink_mask(image)
+    red_ratio = float(mask.mean())
+    result = {"red_ratio": round(red_ratio, 5), "has_red_ink": red_ratio >= MARK_MIN_RED_RATIO, "marks": []}
+    if not result["has_red_ink"]:
+        return result
+
+    height, width = mask.shape
+    long_side = max(width, height)
+    factor = MARK_POOL_FACTOR
+    marks = []
+    for component in connected_components(dilate(block_pool(mask, factor), MARK_DILATE_RADIUS)):
+        # 在原分辨率掩码上按连通域外接框取出笔迹再分类
+        px0, py0, px1, py1 = component["box"]
+        ink, box = trim_mask(mask[py0 * factor:py1 * factor, px0 * factor:px1 * factor])
+        if ink is None:
+            continue
+        x0, y0, x1, y1 = box[0] + px0 * factor, box[1] + py0 * factor, box[2] + px0 * factor, box[3] + py0 * factor
+        size = max(x1 - x0, y1 - y0)
+        if not MARK_MIN_SIZE_RATIO * long_side <= size <= MARK_MAX_SIZE_RATIO * long_side:
+            continue
+
+        mark_type, confidence = classify_mark(ink)
+        if mark_type is None or confidence < MARK_MIN_CONFIDENCE:
+            continue
+        marks.append({
+            "type": mark_type,
+            "x": round(x0 / width * 100, 1),
+            "y": round(y0 / height * 100, 1),
+            "width": round((x1 - x0) / width * 100, 1),
+            "height": round((y1 - y0) / height * 100, 1),
+            "confidence": round(confidence, 2)
+        })
+
+    marks.sort(key=lambda mark: (round(mark["y"] / 3), mark["x"]))
+    result["marks"] = marks
+    return result
+
+
+def describe_marks(marks: List[dict]) -> str:
+    """把候选 ×/○ 标记整理为给视觉模型的位置提示"""
+    names = {MARK_CROSS: "红色×", MARK_CIRCLE: "红色圈"}
+    lines = [
+        f"- {names[mark['type']]}: 距左 {mark['x']}%, 距上 {mark['y']}%, 大小 {mark['width']}%x{mark['height']}%"
+        for mark in marks if mark["type"] in names
+    ]
+    return "\n".join(lines)
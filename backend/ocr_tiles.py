@@ -0,0 +1,168 @@
+"""
+分块并发 OCR
+题目密集的试卷整页缩小到 1500px 左右后小字无法辨认, 而且整页识别是一次很长的串行调用.
+分块模式把原图分为上下重叠的若干条(横向跨页的大图再分左右两栏), 各块以原图分辨率裁剪后
+并发识别, 总耗时取决于最慢的一块; 各块返回的题目按题号和重叠内容去重合并
+"""
+
+import math
+import os
+import re
+from difflib import SequenceMatcher
+from typing import List, Optional
+
+# ==================== 配置 ====================
+
+# 分块模式: auto(原图长边不小于 OCR_TILE_MIN_SIDE 时分块), on(总是分块), off(关闭); 请求中的 tiled 字段优先
+OCR_TILE_MODE = os.getenv("OCR_TILE_MODE", "auto").lower()
+OCR_TILE_MIN_SIDE = int(os.getenv("OCR_TILE_MIN_SIDE", "2400"))
+# 每块发送给 GLM 的长边像素
+OCR_TILE_SIZE = int(os.getenv("OCR_TILE_SIZE", "2000"))
+# 每块的高宽比(条带越矮, 同样的长边像素下文字越大), 以及最多分几行
+OCR_TILE_ASPECT = float(os.getenv("OCR_TILE_ASPECT", "0.6"))
+OCR_TILE_MAX_ROWS = int(os.getenv("OCR_TILE_MAX_ROWS", "4"))
+# 相邻块的重叠(相对页面高/宽), 至少容纳一两行文字, 被切开的行在其中一块中是完整的
+OCR_TILE_OVERLAP = float(os.getenv("OCR_TILE_OVERLAP", "0.08"))
+
+# 宽高比超过该值(横拍的双栏试卷)时分为左右两栏
+TWO_COLUMN_ASPECT = 1.2
+# 两道题判定为重叠区域中的同一题: 最长公共片段占较短正文的比例, 或首尾相接的公共片段至少这么多字
+MERGE_MIN_COMMON_CHARS = 8
+MERGE_MIN_COMMON_RATIO = 0.5
+
+# 题目正文可能使用的字段名(OCR 端点和智能检测的提示词不同)
+TEXT_FIELDS = ("question_text", "question_content")
+
+
+# ==================== 分块 ====================
+
+def should_tile(width: int, height: int, requested: Optional[bool] = None) -> bool:
+    """是否对这张图片分块识别(requested 为请求中的 tiled 字段)"""
+    if requested is not None:
+        return requested
+    if OCR_TILE_MODE == "on":
+        return True
+    return OCR_TILE_MODE == "auto" and max(width, height) >= OCR_TILE_MIN_SIDE
+
+
+def spans(count: int, overlap: float) -> List[tuple]:
+    """把 [0, 100] 分为 count 段相互重叠 overlap(百分比)的区间"""
+    if count <= 1:
+        return [(0.0, 100.0)]
+    length = (100 + overlap * (count - 1)) / count
+    return [(i * (length - overlap), i * (length - overlap) + length) for i in range(count)]
+
+
+def tile_boxes(width: int, height: int) -> List[dict]:
+    """分块的裁剪框(百分比坐标, 与 user_marks 格式一致), 按阅读顺序(先左栏后右栏, 从上到下)排列
+
+    只有一块时返回空列表(不必分块)
+    """
+    columns = 2 if width > height * TWO_COLUMN_ASPECT else 1
+    tile_width = width / columns
+    rows = min(OCR_TILE_MAX_ROWS, max(1, math.ceil(height / (tile_width * OCR_TILE_ASPECT))))
+    if rows * columns <= 1:
+        return []
+
+    overlap = OCR_TILE_OVERLAP * 100
+    boxes = []
+    for x0, x1 in spans(columns, overlap):
+        for y0, y1 in spans(rows, overlap):
+            boxes.append({
+                "x": round(x0, 2),
+                "y": round(y0, 2),
+                "width": round(x1 - x0, 2),
+                "height": round(y1 - y0, 2)
+            })
+    return boxes
+
+
+# ==================== 合并 ====================
+
+def normalize_number(question_no) -> str:
+    """题号归一化: "第1题", "1.", "（1）" 都视为 "1" """
+    return re.sub(r"[\s.．、:：()（）第题]", "", str(question_no or ""))
+
+
+def question_text(question: dict) -> str:
+    for field in TEXT_FIELDS:
+        if question.get(field):
+            return str(question[field])
+    return ""
+
+
+def stitch(first: str, second: str) -> Optional[str]:
+    """同一道题在相邻两块中的正文合并为一段, 不是同一道题时返回 None
+
+    同一道题: 较短的一段大部分出现在另一段中(两块都看到了完整或大部分题目), 或 first 的结尾
+    与 second 的开头相同(题目被块边界切开, 重叠区域中的文字两块都有); 任一段为空时无法判断, 返回 None
+    """
+    if not first or not second:
+        return None
+    shorter = min(len(first), len(second))
+    match = SequenceMatcher(None, first, second, autojunk=False).find_longest_match(0, len(first), 0, len(second))
+    if MERGE_MIN_COMMON_CHARS <= match.size < shorter:
+        if match.a + match.size == len(first) and match.b == 0:
+            return first + second[match.size:]
+        if match.b + match.size == len(second) and match.a == 0:
+            return second + first[match.size:]
+    if match.size >= shorter * MERGE_MIN_COMMON_RATIO:
+        return first if len(first) >= len(second) else second
+    return None
+
+
+def merge_question(kept: dict, other: dict, text: str):
+    """把同一道题在另一块中的识别结果并入 kept: 正文取合并结果, 其余字段取非空的一方"""
+    for key, value in other.items():
+        if value and not kept.get(key):
+            kept[key] = value
+    for field in TEXT_FIELDS:
+        if kept.get(field):
+            kept[field] = text
+            break
+
+
+def is_adjacent(first: dict, second: dict) -> bool:
+    """两块是否有重叠区域"""
+    return (first is not second
+            and first["x"] < second["x"] + second["width"] and second["x"] < first["x"] + first["width"]
+            and first["y"] < second["y"] + second["height"] and second["y"] < first["y"] + first["height"])
+
+
+def merge_tile_questions(tiles: List[dict], results: List[Optional[list]]) -> List[dict]:
+    """合并各块识别出的题目
+
+    同一道题出现在相邻两块的重叠区域时只保留一份: 需要题号相同(或其中一块看不到题号), 两块有重叠区域,
+    且正文有共同片段(不同大题的小题题号会重复, 只比较题号会误合并); 其中一块没有正文时需要题号相同
+    """
+    merged = []  # [(块序号, 题目)]
+    for index, questions in enumerate(results):
+        for question in questions or []:
+            if not isinstance(question, dict):
+                continue
+            question = dict(question)
+            number = normalize_number(question.get("question_no"))
+            text = question_text(question)
+            duplicate = False
+            for kept_index, kept in merged:
+                if not is_adjacent(tiles[kept_index], tiles[index]):
+                    continue
+                # 下一块中被截断的后半道题常看不到题号
+                kept_number = normalize_number(kept.get("question_no"))
+                if number and kept_number and kept_number != number:
+                    continue
+                kept_text = question_text(kept)
+                if kept_text and text:
+                    stitched = stitch(kept_text, text)
+                elif number and number == kept_number:
+                    # 其中一块没有识别出正文: 只有题号相同时才视为同一道题
+                    stitched = kept_text or text
+                else:
+                    stitched = None
+                if stitched is not None:
+                    merge_question(kept, question, stitched)
+                    duplicate = True
+                    break
+            if not duplicate:
+                merged.append((index, question))
+    return [question for _, question in merged]
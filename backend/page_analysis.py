@@ -0,0 +1,49 @@
+"""
+本地图片分析(一次解码)
+质量检查, 重复试卷的感知哈希, 按题分割和红笔标记检测都只需要长边 1000-1200 的小图.
+同一请求需要的几项分析合并为一个进程池任务: 原图只解码一次(JPEG 按 draft 模式降采样),
+各项分析使用由这张图缩小得到的分析图, 不再各自传输和解码原图
+"""
+
+from typing import Dict, Iterable
+
+from PIL import Image
+
+from image_pipeline import fit_size, load_image
+from image_quality import QUALITY_ANALYSIS_SIZE, judge_quality, measure_image_quality
+from mark_detector import MARK_ANALYSIS_SIZE, detect_image_marks
+from page_segmenter import SEGMENT_ANALYSIS_SIZE, segment_image
+from paper_index import HASH_IMAGE_SIZE, image_hash
+
+# 分析项: (分析图长边, 分析函数(分析图, 原图宽高))
+ANALYSES = {
+    "quality": (QUALITY_ANALYSIS_SIZE, lambda image, size: judge_quality(measure_image_quality(image, size))),
+    "hash": (HASH_IMAGE_SIZE * 8, lambda image, size: image_hash(image)),
+    "segments": (SEGMENT_ANALYSIS_SIZE, lambda image, size: segment_image(image)),
+    "marks": (MARK_ANALYSIS_SIZE, lambda image, size: detect_image_marks(image)),
+}
+
+
+def shrink(image: Image.Image, max_size: int) -> Image.Image:
+    """缩小到长边不超过 max_size(不放大)"""
+    new_size = fit_size(*image.size, (max_size, max_size))
+    return image if new_size == image.size else image.resize(new_size)
+
+
+def analyze_page(data: bytes, parts: Iterable[str]) -> Dict[str, object]:
+    """解码一次, 完成 parts 中的各项分析(在进程池中执行)
+
+    Returns:
+        {分析项: 结果}  # 结果格式同 assess_quality / perceptual_hash / segment_questions / detect_marks;
+                        # 单项分析出错时结果为该异常, 不影响其他分析项
+    """
+    parts = list(parts)
+    image, original_size = load_image(data, max_size=max(ANALYSES[part][0] for part in parts))
+    results = {}
+    for part in parts:
+        max_size, analyze = ANALYSES[part]
+        try:
+            results[part] = analyze(shrink(image, max_size), original_size)
+        except Exception as e:
+            results[part] = e
+    return results
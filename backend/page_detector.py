@@ -0,0 +1,241 @@
+"""
+试卷纸张边界检测与透视校正
+手机拍摄的试卷照片常带有桌面, 手和书本, 整张照片缩小到 1200-1500px 后纸张本身只剩一半左右
+的分辨率. 在缩放之前先找出纸张: 平滑后的亮度图按 Otsu 阈值分出纸张(明亮区域), 逐行/逐列
+取纸张区域的边界点, 对四条边分别做剔除离群点的直线拟合, 求交点得到四边形, 再透视变换为矩形.
+这样发送给 GLM 的每个像素都在纸上, 同样的尺寸和字节数下文字更清晰.
+全部用 NumPy 计算, 不依赖 OpenCV; 检测结果不可靠时返回 None, 调用方按原图处理
+"""
+
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_pipeline import box_mean, fit_size
+from mark_detector import find_runs
+
+# ==================== 配置 ====================
+
+# 检测时把图片缩小到的长边像素
+PAGE_ANALYSIS_SIZE = int(os.getenv("PAGE_ANALYSIS_SIZE", "600"))
+# 纸张面积占画面的比例范围: 过小多为误检, 过大说明纸张已占满画面, 不必裁剪
+PAGE_MIN_AREA = float(os.getenv("PAGE_MIN_AREA", "0.1"))
+PAGE_MAX_AREA = float(os.getenv("PAGE_MAX_AREA", "0.85"))
+
+# 闭运算半径(相对分析图长边): 大于笔画宽度, 把文字(包括密集的手写)抹成纸色, 只留纸张与背景的明暗差异
+PAGE_CLOSING_RATIO = 0.01
+# 边界点距画面边缘不超过这个比例时, 认为纸张在这一侧超出画面, 以画面边缘为边
+PAGE_BORDER_RATIO = 0.01
+# 每条边的直线拟合: 离群阈值(相对分析图长边), 拟合成功所需的内点比例
+PAGE_LINE_TOLERANCE = 0.01
+PAGE_MIN_INLIERS = 0.6
+# 四边形内纸张像素的最低占比
+PAGE_MIN_FILL = 0.85
+
+
+# ==================== 纸张区域 ====================
+
+def otsu_threshold(gray: np.ndarray) -> float:
+    """Otsu 阈值: 使两类灰度的类间方差最大"""
+    histogram = np.bincount(gray.astype(np.uint8).ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    mean = np.cumsum(histogram * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (mean[-1] * weight - mean * total) ** 2 / (weight * (total - weight))
+    if np.isnan(variance).all():
+        # 只有一种灰度(纯色图片): 无法分为两类, 全部归为暗类
+        return float(gray.max())
+    return float(np.nanargmax(variance))
+
+
+def rank_filter(values: np.ndarray, radius: int, reduce) -> np.ndarray:
+    """(2 * radius + 1) 见方窗口内的最大/最小值(reduce 为 np.maximum 或 np.minimum), 按行列分离计算"""
+    for axis in (0, 1):
+        padded = np.pad(values, [(radius, radius) if i == axis else (0, 0) for i in range(2)], mode="edge")
+        length = values.shape[axis]
+        result = padded.take(range(0, length), axis=axis)
+        for offset in range(1, 2 * radius + 1):
+            result = reduce(result, padded.take(range(offset, offset + length), axis=axis))
+        values = result
+    return values
+
+
+def paper_mask(image: Image.Image) -> np.ndarray:
+    """纸张掩码: 灰度闭运算(先取局部最大再取局部最小)抹掉笔画后, 亮度高于 Otsu 阈值的区域"""
+    gray = np.asarray(image.convert("L"))
+    radius = max(1, int(max(gray.shape) * PAGE_CLOSING_RATIO))
+    closed = rank_filter(rank_filter(gray, radius, np.maximum), radius, np.minimum).astype(np.float64)
+    smooth = box_mean(closed, 2)
+    return smooth > otsu_threshold(smooth)
+
+
+def longest_runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """每行最长的前景行程, 返回 (行号, 起始列, 结束列(不含)); 纸张外零散的亮斑不参与边界"""
+    rows, starts, ends = find_runs(mask)
+    if not len(rows):
+        return rows, starts, ends
+    order = np.lexsort((ends - starts, rows))
+    last = np.nonzero(np.diff(np.append(rows[order], -1)))[0]
+    keep = order[last]
+    return rows[keep], starts[keep], ends[keep]
+
+
+# ==================== 四边拟合 ====================
+
+def fit_line(t: np.ndarray, values: np.ndarray, tolerance: float) -> Optional[Tuple[float, float, float]]:
+    """剔除离群点的直线拟合 value = slope * t + intercept, 返回 (slope, intercept, 内点比例)"""
+    if len(t) < 10:
+        return None
+    keep = np.ones(len(t), dtype=bool)
+    for _ in range(4):
+        slope, intercept = np.polyfit(t[keep], values[keep], 1)
+        residual = np.abs(values - (slope * t + intercept))
+        spread = max(tolerance, 2.5 * float(np.median(residual[keep])))
+        keep = residual <= spread
+        if keep.sum() < 10:
+            return None
+    return float(slope), float(intercept), float((residual <= tolerance).mean())
+
+
+def fit_side(t: np.ndarray, values: np.ndarray, edge: float, tolerance: float, border: float):
+    """拟合一条边; 边界点大多贴着画面边缘(纸张超出画面)时以画面边缘为边
+
+    返回 (slope, intercept), 拟合失败时返回 None
+    """
+    if len(values) and np.median(np.abs(values - edge)) <= border:
+        return 0.0, float(edge)
+    fitted = fit_line(t, values, tolerance)
+    if fitted is None or fitted[2] < PAGE_MIN_INLIERS:
+        return None
+    return fitted[0], fitted[1]
+
+
+def intersect(vertical: Tuple[float, float], horizontal: Tuple[float, float]) -> Tuple[float, float]:
+    """竖直边 x = a * y + b 与水平边 y = c * x + d 的交点"""
+    a, b = vertical
+    c, d = horizontal
+    y = (c * b + d) / (1 - a * c)
+    return a * y + b, y
+
+
+def signed_area(corners: np.ndarray) -> float:
+    """多边形有向面积(鞋带公式)"""
+    x, y = corners[:, 0], corners[:, 1]
+    return float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def is_convex(corners: np.ndarray) -> bool:
+    edges = np.roll(corners, -1, axis=0) - corners
+    cross = edges[:, 0] * np.roll(edges[:, 1], -1) - edges[:, 1] * np.roll(edges[:, 0], -1)
+    return bool(np.all(cross > 0) or np.all(cross < 0))
+
+
+def quad_mask(corners: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """凸四边形内部的像素掩码"""
+    height, width = shape
+    ys, xs = np.mgrid[0:height, 0:width]
+    inside = np.ones(shape, dtype=bool)
+    orientation = np.sign(signed_area(corners))
+    for (x0, y0), (x1, y1) in zip(corners, np.roll(corners, -1, axis=0)):
+        inside &= ((x1 - x0) * (ys - y0) - (y1 - y0) * (xs - x0)) * orientation >= 0
+    return inside
+
+
+# ==================== 检测入口 ====================
+
+def detect_page(image: Image.Image) -> Optional[List[Tuple[float, float]]]:
+    """检测照片中的纸张四边形
+
+    Returns:
+        纸张四角在 image 中的像素坐标 [左上, 右上, 右下, 左下];
+        检测不到纸张, 或纸张已占满画面时返回 None
+    """
+    small = image.copy()
+    small.thumbnail((PAGE_ANALYSIS_SIZE, PAGE_ANALYSIS_SIZE))
+    mask = paper_mask(small)
+    height, width = mask.shape
+    long_side = max(width, height)
+    tolerance = long_side * PAGE_LINE_TOLERANCE
+    border = long_side * PAGE_BORDER_RATIO
+
+    rows, row_starts, row_ends = longest_runs(mask)
+    cols, col_starts, col_ends = longest_runs(mask.T)
+    if not len(rows) or not len(cols):
+        return None
+    # 只用纸张主体的行/列(行程长度不小于最长行程的一半), 排除角上和背景中的零散亮区
+    row_keep = row_ends - row_starts >= (row_ends - row_starts).max() / 2
+    col_keep = col_ends - col_starts >= (col_ends - col_starts).max() / 2
+    rows, row_starts, row_ends = rows[row_keep], row_starts[row_keep], row_ends[row_keep]
+    cols, col_starts, col_ends = cols[col_keep], col_starts[col_keep], col_ends[col_keep]
+
+    left = fit_side(rows, row_starts.astype(np.float64), 0, tolerance, border)
+    right = fit_side(rows, row_ends.astype(np.float64), width, tolerance, border)
+    top = fit_side(cols, col_starts.astype(np.float64), 0, tolerance, border)
+    bottom = fit_side(cols, col_ends.astype(np.float64), height, tolerance, border)
+    if None in (left, right, top, bottom):
+        return None
+
+    corners = np.array([intersect(left, top), intersect(right, top), intersect(right, bottom), intersect(left, bottom)])
+    margin = long_side * 0.05
+    if (corners[:, 0].min() < -margin or corners[:, 0].max() > width + margin
+            or corners[:, 1].min() < -margin or corners[:, 1].max() > height + margin):
+        return None
+    corners[:, 0] = corners[:, 0].clip(0, width)
+    corners[:, 1] = corners[:, 1].clip(0, height)
+    if not is_convex(corners):
+        return None
+
+    area = abs(signed_area(corners)) / (width * height)
+    if not PAGE_MIN_AREA <= area <= PAGE_MAX_AREA:
+        return None
+    inside = quad_mask(corners, mask.shape)
+    if mask[inside].mean() < PAGE_MIN_FILL:
+        return None
+
+    scale = image.width / width
+    return [(float(x * scale), float(y * scale)) for x, y in corners]
+
+
+# ==================== 透视校正 ====================
+
+def perspective_coefficients(source: List[Tuple[float, float]], size: Tuple[int, int]) -> List[float]:
+    """Image.transform(PERSPECTIVE) 的 8 个系数: 把输出矩形的四角映射到原图中的 source 四角"""
+    width, height = size
+    target = [(0, 0), (width, 0), (width, height), (0, height)]
+    matrix, vector = [], []
+    for (x, y), (u, v) in zip(target, source):
+        matrix.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        matrix.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        vector.extend([u, v])
+    return np.linalg.solve(np.array(matrix, dtype=np.float64), np.array(vector, dtype=np.float64)).tolist()
+
+
+def page_size(corners: List[Tuple[float, float]]) -> Tuple[float, float]:
+    """纸张四边形校正后的宽高(取对边中较长的一条)"""
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = corners
+    width = max(np.hypot(x1 - x0, y1 - y0), np.hypot(x2 - x3, y2 - y3))
+    height = max(np.hypot(x3 - x0, y3 - y0), np.hypot(x2 - x1, y2 - y1))
+    return width, height
+
+
+def warp_page(image: Image.Image, corners: List[Tuple[float, float]],
+              box: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """把 detect_page 得到的纸张四边形透视校正为矩形, 缩放到 box (宽, 高) 以内
+
+    透视变换逐点采样, 缩小时会产生锯齿; 需要缩小时先整体缩放到纸张接近目标尺寸, 再做透视变换
+    """
+    width, height = page_size(corners)
+    size = (max(1, int(round(width))), max(1, int(round(height))))
+    if box:
+        size = fit_size(*size, box)
+    ratio = size[0] / width
+    if ratio < 0.9:
+        resized = image.resize((max(1, int(image.width * ratio)), max(1, int(image.height * ratio))), Image.LANCZOS)
+        scale_x, scale_y = resized.width / image.width, resized.height / image.height
+        corners = [(x * scale_x, y * scale_y) for x, y in corners]
+        image = resized
+    return image.transform(size, Image.PERSPECTIVE, perspective_coefficients(corners, size), Image.BICUBIC)
@@ -0,0 +1,222 @@
+"""
+试卷题目区域分割
+对二值化后的试卷做行/列投影: 列投影找分栏, 行投影切出文本行, 再以向左突出的
+行(题号, 大题标题所在行)为锚点把文本行归并为题目区域, 返回每道题的裁剪框.
+下游可以把各题的小图并发发给视觉模型, 而不是整页发送一张 1500px 的大图
+"""
+
+import os
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_pipeline import box_mean, load_image
+from mark_detector import red_ink_mask
+
+# ==================== 配置 ====================
+
+# 分割时把图片缩小到的长边像素
+SEGMENT_ANALYSIS_SIZE = int(os.getenv("SEGMENT_ANALYSIS_SIZE", "1200"))
+# 最多返回的题目区域数(超过说明版面不适合按题分割)
+SEGMENT_MAX_REGIONS = int(os.getenv("SEGMENT_MAX_REGIONS", "30"))
+
+# 局部阈值的窗口大小(像素)和灵敏度: 比周围平均亮度暗 15% 以上视为笔迹
+BINARIZE_WINDOW = 31
+BINARIZE_RATIO = 0.85
+# 文本行: 行投影至少达到栏宽的 LINE_MIN_INK_RATIO 和投影 95 分位的 LINE_PEAK_RATIO
+# (照片中行间常有浅色噪点, 用相对阈值切开), 行间距小于行高的 LINE_MERGE_GAP_RATIO 时合并
+LINE_MIN_INK_RATIO = 0.004
+LINE_PEAK_RATIO = 0.1
+LINE_MERGE_GAP_RATIO = 0.25
+# 锚点行: 行首比版面左边界(按倾斜拟合)向左突出超过栏宽的这个比例
+ANCHOR_INDENT_RATIO = 0.015
+# 页边杂物: 在四周这么宽(相对页宽/页高)的范围内找空白列/行, 裁掉其外侧拍进来的桌面, 书脊等
+PAGE_BORDER_RATIO = 0.08
+# 投影中笔迹像素不超过这个比例的行/列视为空白
+BLANK_RATIO = 0.005
+# 分栏: 中部至少连续这么宽(相对页宽)的空白列才视为栏间空白
+COLUMN_GUTTER_RATIO = 0.03
+# 裁剪框四周留白(相对页面长边)
+REGION_PADDING_RATIO = 0.008
+
+
+# ==================== 二值化 ====================
+
+def binarize(image: Image.Image) -> np.ndarray:
+    """局部均值阈值二值化(用积分图计算窗口均值, 适应照片中不均匀的光照), 笔迹为 True"""
+    gray = np.asarray(image.convert("L"), dtype=np.float64)
+    return gray < box_mean(gray, BINARIZE_WINDOW // 2) * BINARIZE_RATIO
+
+
+# ==================== 投影分析 ====================
+
+def find_bands(profile: np.ndarray, threshold: float, merge_gap: int = 0) -> List[Tuple[int, int]]:
+    """投影中连续超过阈值的区间 [start, end), 间隔不超过 merge_gap 的区间合并"""
+    active = np.concatenate(([False], profile > threshold, [False]))
+    edges = np.nonzero(np.diff(active.astype(np.int8)))[0]
+    bands = []
+    for start, end in zip(edges[0::2], edges[1::2]):
+        if bands and start - bands[-1][1] <= merge_gap:
+            bands[-1] = (bands[-1][0], int(end))
+        else:
+            bands.append((int(start), int(end)))
+    return bands
+
+
+def content_range(profile: np.ndarray, length: int) -> Tuple[int, int]:
+    """裁掉页边杂物后的内容范围 [start, end): 两侧边缘带内最靠里的空白行/列之外视为页外"""
+    size = len(profile)
+    border = int(size * PAGE_BORDER_RATIO)
+    blank = profile <= length * BLANK_RATIO
+    head = np.nonzero(blank[:border])[0]
+    tail = np.nonzero(blank[size - border:])[0]
+    start = int(head[-1]) if len(head) else 0
+    end = size - border + int(tail[0]) + 1 if len(tail) else size
+    return start, end
+
+
+def split_columns(ink: np.ndarray) -> List[Tuple[int, int]]:
+    """按页面中部的竖直空白把页面分为左右两栏(没有明显空白时整页为一栏)"""
+    height, width = ink.shape
+    profile = ink.sum(axis=0)
+    start, end = int(width * 0.35), int(width * 0.65)
+    blank = np.concatenate(([False], profile[start:end] <= height * BLANK_RATIO, [False]))
+    edges = np.nonzero(np.diff(blank.astype(np.int8)))[0]
+    gaps = [(end_ - start_, start + start_, start + end_) for start_, end_ in zip(edges[0::2], edges[1::2])]
+    if gaps:
+        size, gap_start, gap_end = max(gaps)
+        if size >= width * COLUMN_GUTTER_RATIO:
+            return [(0, gap_start), (gap_end, width)]
+    return [(0, width)]
+
+
+def text_lines(ink: np.ndarray) -> List[Tuple[int, int, int, int]]:
+    """一栏中的文本行, 返回 [(y0, y1, 行首 x, 行尾 x), ...]"""
+    height, width = ink.shape
+    profile = ink.sum(axis=1)
+    threshold = max(1, width * LINE_MIN_INK_RATIO, np.percentile(profile, 95) * LINE_PEAK_RATIO)
+    bands = find_bands(profile, threshold)
+    if not bands:
+        return []
+
+    median_height = np.median([end - start for start, end in bands])
+    merged = find_bands(profile, threshold, int(median_height * LINE_MERGE_GAP_RATIO))
+
+    lines = []
+    for y0, y1 in merged:
+        if y1 - y0 < 3:
+            continue
+        cols = np.nonzero(ink[y0:y1].sum(axis=0) >= 2)[0]
+        if len(cols):
+            lines.append((y0, y1, int(cols[0]), int(cols[-1]) + 1))
+    return lines
+
+
+def anchor_lines(lines: List[Tuple[int, int, int, int]], column_width: int) -> np.ndarray:
+    """判断每行是否为题目起始行: 行首相对版面左边界向左突出
+
+    照片常有倾斜, 左边界用行首 x 对行中心 y 的直线拟合; 迭代拟合, 每轮去掉向左突出的行和
+    缩进很深的行(居中的图形, 表格等)
+    """
+    left = np.array([line[2] for line in lines], dtype=np.float64)
+    center = np.array([(line[0] + line[1]) / 2 for line in lines])
+    tolerance = max(4.0, column_width * ANCHOR_INDENT_RATIO)
+    if len(lines) < 3:
+        return np.zeros(len(lines), dtype=bool)
+
+    keep = np.ones(len(lines), dtype=bool)
+    for _ in range(3):
+        slope, intercept = np.polyfit(center[keep], left[keep], 1)
+        residual = left - (slope * center + intercept)
+        keep = (residual > -tolerance) & (residual < tolerance * 3)
+        if keep.sum() < 2:
+            break
+    return residual <= -tolerance
+
+
+def group_lines(lines: List[Tuple[int, int, int, int]], anchors: np.ndarray) -> List[List[Tuple[int, int, int, int]]]:
+    """按锚点把文本行归并为题目; 锚点过少或过多(版面没有悬挂缩进)时按较大的行间距分组"""
+    useful_anchors = 2 <= anchors.sum() <= len(lines) * 0.6
+    if not useful_anchors:
+        gaps = np.array([lines[i][0] - lines[i - 1][1] for i in range(1, len(lines))])
+        threshold = np.median(gaps) * 1.8 if len(gaps) else 0
+        anchors = np.array([True] + [gap > threshold for gap in gaps])
+
+    groups = []
+    for line, is_anchor in zip(lines, anchors):
+        if is_anchor or not groups:
+            groups.append([line])
+        else:
+            groups[-1].append(line)
+
+    # 只有一行的组(大题标题, 如 "三、计算题") 并入下一组
+    merged = []
+    for group in groups:
+        if merged and len(merged[-1]) == 1 and len(groups) > 1:
+            merged[-1].extend(group)
+        else:
+            merged.append(group)
+    return merged
+
+
+# ==================== 分割入口 ====================
+
+def segment_questions(data: bytes) -> List[dict]:
+    """把试卷照片分割为题目区域(在进程池中执行)
+
+    Returns:
+        [{"x": 5.0, "y": 12.5, "width": 90.0, "height": 8.0}, ...]
+        坐标为占图片宽高的百分比(与 user_marks 格式一致), 按阅读顺序(先左栏后右栏, 从上到下)排列;
+        无法分割时返回空列表
+    """
+    image, _ = load_image(data, max_size=SEGMENT_ANALYSIS_SIZE)
+    return segment_image(image)
+
+
+def segment_image(image: Image.Image) -> List[dict]:
+    """在已解码的分析图(长边不超过 SEGMENT_ANALYSIS_SIZE)上分割题目区域, 返回格式同 segment_questions"""
+    # 老师的红笔批改常跨越多行, 不参与版面分析
+    ink = binarize(image) & ~red_ink_mask(image)
+    height, width = ink.shape
+    left, right = content_range(ink.sum(axis=0), height)
+    top, bottom = content_range(ink[:, left:right].sum(axis=1), right - left)
+    ink[:top] = False
+    ink[bottom:] = False
+    ink[:, :left] = False
+    ink[:, right:] = False
+    padding = int(max(width, height) * REGION_PADDING_RATIO)
+
+    regions = []
+    for col_start, col_end in split_columns(ink):
+        column = ink[:, col_start:col_end]
+        lines = text_lines(column)
+        if not lines:
+            continue
+
+        for group in group_lines(lines, anchor_lines(lines, col_end - col_start)):
+            y0, y1 = group[0][0], group[-1][1]
+            x0 = min(line[2] for line in group) + col_start
+            x1 = max(line[3] for line in group) + col_start
+            # 过矮的区域(页眉页脚, 单独的噪点行)并入上一个区域
+            if y1 - y0 < height * 0.012 and regions and regions[-1]["column"] == col_start:
+                last = regions[-1]
+                last["box"] = (min(last["box"][0], x0), last["box"][1], max(last["box"][2], x1), y1)
+                continue
+            regions.append({"column": col_start, "box": (x0, y0, x1, y1)})
+
+    if not 2 <= len(regions) <= SEGMENT_MAX_REGIONS:
+        return []
+
+    boxes = []
+    for region in regions:
+        x0, y0, x1, y1 = region["box"]
+        x0, y0 = max(0, x0 - padding), max(0, y0 - padding)
+        x1, y1 = min(width, x1 + padding), min(height, y1 + padding)
+        boxes.append({
+            "x": round(x0 / width * 100, 1),
+            "y": round(y0 / height * 100, 1),
+            "width": round((x1 - x0) / width * 100, 1),
+            "height": round((y1 - y0) / height * 100, 1)
+        })
+    return boxes
@@ -0,0 +1,123 @@
+"""
+重复上传试卷识别
+学生常把同一张试卷(往往是重新拍的照片)反复上传尝试不同模式. 对每张试卷计算感知哈希
+(缩小后灰度图 DCT 低频系数与中位数比较, 对亮度, 压缩, 轻微倾斜和平移不敏感),
+按用户保存最近分析过的试卷和结果; 汉明距离在阈值内的上传直接复用结果, 不再调用 GLM
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from image_pipeline import load_image
+
+# ==================== 配置 ====================
+
+# 判定为同一张试卷的最大汉明距离(哈希共 255 位, 0 关闭). 同一张试卷: 重新压缩/缩放 0-20,
+# 平移 2% 约 25-45, 倾斜 3 度约 40-70; 不同试卷通常 100 以上
+PAPER_DEDUP_DISTANCE = int(os.getenv("PAPER_DEDUP_DISTANCE", "80"))
+# 结果保留秒数
+PAPER_DEDUP_TTL = float(os.getenv("PAPER_DEDUP_TTL", "3600"))
+# 每个用户保留的试卷数, 以及最多保留的用户数
+PAPER_DEDUP_MAX_PER_USER = int(os.getenv("PAPER_DEDUP_MAX_PER_USER", "20"))
+PAPER_DEDUP_MAX_USERS = int(os.getenv("PAPER_DEDUP_MAX_USERS", "1000"))
+
+# 计算哈希时的缩略图边长和保留的低频系数边长
+HASH_IMAGE_SIZE = 32
+HASH_LOW_FREQUENCY = 16
+
+# DCT-II 变换矩阵
+_n = np.arange(HASH_IMAGE_SIZE)
+_DCT = np.cos(np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * HASH_IMAGE_SIZE))
+
+
+def perceptual_hash(data: bytes) -> bytes:
+    """试卷图片的感知哈希(在进程池中执行), 返回打包后的位串"""
+    image, _ = load_image(data, max_size=HASH_IMAGE_SIZE * 8)
+    return image_hash(image)
+
+
+def image_hash(image: Image.Image) -> bytes:
+    """已解码图片的感知哈希"""
+    gray = ImageOps.autocontrast(image.convert("L")).resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.float64)
+    # 只取低频系数, 去掉直流分量(整体亮度)
+    coefficients = (_DCT @ pixels @ _DCT.T)[:HASH_LOW_FREQUENCY, :HASH_LOW_FREQUENCY].ravel()[1:]
+    return np.packbits(coefficients > np.median(coefficients)).tobytes()
+
+
+def hamming_distance(a: bytes, b: bytes) -> int:
+    return int(np.unpackbits(np.frombuffer(a, dtype=np.uint8) ^ np.frombuffer(b, dtype=np.uint8)).sum())
+
+
+class PaperIndex:
+    """按用户保存最近分析过的试卷(感知哈希 -> 各端点的结果)"""
+
+    def __init__(self, max_distance: int = PAPER_DEDUP_DISTANCE, ttl: float = PAPER_DEDUP_TTL,
+                 max_per_user: int = PAPER_DEDUP_MAX_PER_USER, max_users: int = PAPER_DEDUP_MAX_USERS):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_per_user = max_per_user
+        self.max_users = max_users
+        self.hits = 0
+        self.misses = 0
+        # user_id -> [{"hash", "time", "results": {namespace: result}}, ...](最近使用的在后)
+        self._users = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_distance > 0
+
+    def _find(self, user_id: str, paper_hash: bytes) -> Optional[dict]:
+        """该用户最相近且未过期的试卷"""
+        papers = self._users.get(user_id)
+        if not papers:
+            return None
+        now = time.time()
+        papers[:] = [paper for paper in papers if now - paper["time"] < self.ttl]
+
+        best, best_distance = None, self.max_distance + 1
+        for paper in papers:
+            distance = hamming_distance(paper["hash"], paper_hash)
+            if distance < best_distance:
+                best, best_distance = paper, distance
+        return best
+
+    def lookup(self, user_id: str, paper_hash: bytes, namespace: str) -> Optional[Any]:
+        """查找同一用户近似相同试卷在该端点的结果"""
+        paper = self._find(user_id, paper_hash)
+        if paper is None or namespace not in paper["results"]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._users.move_to_end(user_id)
+        return paper["results"][namespace]
+
+    def store(self, user_id: str, paper_hash: bytes, namespace: str, result: Any):
+        paper = self._find(user_id, paper_hash)
+        if paper is None:
+            papers = self._users.setdefault(user_id, [])
+            paper = {"hash": paper_hash, "time": time.time(), "results": {}}
+            papers.append(paper)
+            del papers[:-self.max_per_user]
+        paper["results"][namespace] = result
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "users": len(self._users),
+            "papers": sum(len(papers) for papers in self._users.values()),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# 全局试卷索引
+paper_index = PaperIndex()
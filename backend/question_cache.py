@@ -0,0 +1,193 @@
+"""
+近似重复题目缓存
+对 OCR/输入的题目文本做规范化, 以字符 shingle 的 MinHash 签名建立 LSH 索引,
+空白, 标点或个别识别错字不同的同一道题可以复用已有的解答, 跳过 GLM 调用;
+数字和运算符必须完全一致(只改了常数的题目答案不同)
+"""
+
+import os
+import re
+import unicodedata
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Any, Optional
+
+import numpy as np
+
+# ==================== 配置 ====================
+
+# 字符 shingle 长度
+QUESTION_SHINGLE_SIZE = int(os.getenv("QUESTION_SHINGLE_SIZE", "3"))
+# LSH 分段数和每段行数(签名长度 = 两者乘积)
+QUESTION_LSH_BANDS = int(os.getenv("QUESTION_LSH_BANDS", "16"))
+QUESTION_LSH_ROWS = int(os.getenv("QUESTION_LSH_ROWS", "4"))
+# 判定为同一道题的最小 Jaccard 相似度
+QUESTION_SIMILARITY_THRESHOLD = float(os.getenv("QUESTION_SIMILARITY_THRESHOLD", "0.85"))
+# 规范化后短于此长度的题目只做精确匹配(太短的文本近似匹配容易误判)
+QUESTION_MIN_FUZZY_LENGTH = int(os.getenv("QUESTION_MIN_FUZZY_LENGTH", "12"))
+# 最多缓存的题目数
+QUESTION_CACHE_MAX_ENTRIES = int(os.getenv("QUESTION_CACHE_MAX_ENTRIES", "2000"))
+
+# MinHash 使用的素数(大于 2^32), 以及固定种子生成的哈希参数(保证多进程签名一致)
+_PRIME = np.uint64(4294967311)
+_rng = np.random.default_rng(20240601)
+_HASH_A = _rng.integers(1, 4294967311, size=QUESTION_LSH_BANDS * QUESTION_LSH_ROWS, dtype=np.uint64)
+_HASH_B = _rng.integers(0, 4294967311, size=QUESTION_LSH_BANDS * QUESTION_LSH_ROWS, dtype=np.uint64)
+
+# 题目中的数字和运算符(只差一个常数或符号的两道题, 字符 shingle 仍高度相似, 但答案不同)
+_MATH_TOKEN = re.compile(r"\d+(?:\.\d+)?|[+\-−×÷*/=<>≤≥≠^√%]")
+
+
+def normalize_question(text: str) -> str:
+    """规范化题目文本: 全角转半角, 小写, 去掉空白, 标点和控制字符(保留 +, =, × 等数学符号)"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in "PZC")
+
+
+def math_tokens(text: str) -> str:
+    """题目中数字和运算符的序列(在去掉标点之前提取, 负号属于标点类字符); 近似匹配要求这部分完全一致"""
+    if not text:
+        return ""
+    return " ".join(_MATH_TOKEN.findall(unicodedata.normalize("NFKC", text)))
+
+
+def shingles(text: str, size: int = QUESTION_SHINGLE_SIZE) -> set:
+    """字符 shingle 集合"""
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def minhash_signature(shingle_set: set) -> np.ndarray:
+    """计算 MinHash 签名(向量化: 所有 shingle x 所有哈希函数一次算完)"""
+    values = np.fromiter(
+        (zlib.crc32(item.encode("utf-8")) for item in shingle_set),
+        dtype=np.uint64,
+        count=len(shingle_set)
+    )
+    hashed = (values[:, None] * _HASH_A[None, :] + _HASH_B[None, :]) % _PRIME
+    return hashed.min(axis=0)
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class NearDuplicateCache:
+    """按命名空间区分的近似重复题目缓存
+
+    namespace 区分不同用途(诊断, 解题, 对话), extra 为必须精确一致的附加条件
+    (例如学生答案: 题目相同但答案不同时诊断结果不能复用); 题目中的数字和运算符序列同样必须精确一致,
+    近似匹配只容忍文字部分的空白, 标点和识别错字
+    """
+
+    def __init__(self, threshold: float = QUESTION_SIMILARITY_THRESHOLD, max_entries: int = QUESTION_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._exact = {}
+        self._buckets = defaultdict(set)
+        self._next_id = 0
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _band_keys(scope: tuple, signature: np.ndarray) -> list:
+        rows = signature.reshape(QUESTION_LSH_BANDS, QUESTION_LSH_ROWS)
+        return [(scope, band, row.tobytes()) for band, row in enumerate(rows)]
+
+    @staticmethod
+    def _scope(namespace: str, question: str, extra: str) -> tuple:
+        # 附加条件同样保留符号(学生答案 "(-1,-4)" 与 "(1,4)" 去掉标点后相同)
+        return namespace, normalize_question(extra), math_tokens(extra), math_tokens(question)
+
+    def lookup(self, namespace: str, question: str, extra: str = "") -> Optional[Any]:
+        """查找相同或近似相同题目的缓存结果, 未命中返回 None"""
+        text = normalize_question(question)
+        if not text:
+            return None
+        scope = self._scope(namespace, question, extra)
+
+        entry_id = self._exact.get((scope, text))
+        if entry_id is not None:
+            self.hits += 1
+            self._entries.move_to_end(entry_id)
+            return self._entries[entry_id]["value"]
+
+        if len(text) >= QUESTION_MIN_FUZZY_LENGTH:
+            shingle_set = shingles(text)
+            candidates = set()
+            for key in self._band_keys(scope, minhash_signature(shingle_set)):
+                candidates |= self._buckets.get(key, set())
+
+            best_id, best_score = None, 0.0
+            for candidate in candidates:
+                score = jaccard(shingle_set, self._entries[candidate]["shingles"])
+                if score > best_score:
+                    best_id, best_score = candidate, score
+
+            if best_id is not None and best_score >= self.threshold:
+                self.hits += 1
+                self.fuzzy_hits += 1
+                self._entries.move_to_end(best_id)
+                print(f"[题目缓存] 近似命中 ({namespace}), 相似度 {best_score:.2f}")
+                return self._entries[best_id]["value"]
+
+        self.misses += 1
+        return None
+
+    def store(self, namespace: str, question: str, value: Any, extra: str = ""):
+        """缓存题目的解答结果"""
+        text = normalize_question(question)
+        if not text or value is None:
+            return
+        scope = self._scope(namespace, question, extra)
+
+        old_id = self._exact.get((scope, text))
+        if old_id is not None:
+            self._remove(old_id)
+
+        shingle_set = shingles(text)
+        band_keys = self._band_keys(scope, minhash_signature(shingle_set)) if len(text) >= QUESTION_MIN_FUZZY_LENGTH else []
+
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = {
+            "exact_key": (scope, text),
+            "shingles": shingle_set,
+            "band_keys": band_keys,
+            "value": value
+        }
+        self._exact[(scope, text)] = entry_id
+        for key in band_keys:
+            self._buckets[key].add(entry_id)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        self._exact.pop(entry["exact_key"], None)
+        for key in entry["band_keys"]:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "fuzzy_hits": self.fuzzy_hits,
+            "misses": self.misses
+        }
+
+
+# 全局题目缓存
+question_cache = NearDuplicateCache()
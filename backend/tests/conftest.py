@@ -0,0 +1,52 @@
+"""
+后端单元测试公共配置
+测试不访问 GLM: 响应缓存关闭, 图片处理使用线程(不启动进程池), 上游调用由 httpx.MockTransport 模拟
+"""
+
+import json
+import os
+import sys
+
+# 各模块在导入时读取配置, 需在导入之前设置
+os.environ.setdefault("GLM_CACHE_ENABLED", "0")
+os.environ.setdefault("GLM_CACHE_DIR", "")
+os.environ.setdefault("IMAGE_POOL_WORKERS", "0")
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTDATA_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "testdata")
+sys.path.insert(0, BACKEND_DIR)
+
+import httpx
+import pytest
+
+
+def read_testdata(name: str) -> bytes:
+    with open(os.path.join(TESTDATA_DIR, name), "rb") as f:
+        return f.read()
+
+
+def glm_response(content: str) -> httpx.Response:
+    """GLM 非流式调用的成功响应"""
+    return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+
+
+@pytest.fixture
+def mock_glm(monkeypatch):
+    """把 glm_client 的连接池换成 MockTransport; 返回 (设置响应函数, 收到的请求体列表)"""
+    import glm_client
+
+    requests = []
+    state = {"handler": lambda payload: glm_response("ok")}
+
+    def transport(request: httpx.Request) -> httpx.Response:
+        payload = json.loads(request.content)
+        requests.append(payload)
+        return state["handler"](payload)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(transport))
+    monkeypatch.setattr(glm_client, "_http_client", client)
+
+    def respond(handler):
+        state["handler"] = handler
+
+    return respond, requests
@@ -0,0 +1,77 @@
+import asyncio
+import io
+import json
+
+from PIL import Image
+
+import image_pipeline
+from conftest import glm_response
+from image_pipeline import COLLAGE_GAP, collage_label_height, pack_collages, prepare_collages
+
+
+def overlaps(a, b) -> bool:
+    _, ax, ay, aw, ah = a
+    _, bx, by, bw, bh = b
+    label = collage_label_height()
+    return ax < bx + bw and bx < ax + aw and ay < by + bh + label and by < ay + ah + label
+
+
+def test_pack_collages_places_every_region_without_overlap():
+    sizes = [(700, 300), (500, 420), (1500, 200), (300, 300), (640, 260), (200, 90), (900, 500)]
+    collages = pack_collages(sizes)
+    placed = sorted(item[0] for layout in collages for item in layout)
+    assert placed == list(range(len(sizes)))
+
+    for layout in collages:
+        assert len(layout) <= image_pipeline.IMAGE_COLLAGE_MAX_CROPS
+        for n, item in enumerate(layout):
+            index, x, y, w, h = item
+            assert (w, h) == sizes[index]
+            assert x >= COLLAGE_GAP and x + w + COLLAGE_GAP <= image_pipeline.IMAGE_COLLAGE_WIDTH
+            assert y + collage_label_height() + h + COLLAGE_GAP <= image_pipeline.IMAGE_COLLAGE_MAX_HEIGHT
+            assert not any(overlaps(item, other) for other in layout[n + 1:])
+
+
+def test_pack_collages_splits_by_count_and_height(monkeypatch):
+    monkeypatch.setattr(image_pipeline, "IMAGE_COLLAGE_MAX_CROPS", 3)
+    assert [len(layout) for layout in pack_collages([(100, 100)] * 7)] == [3, 3, 1]
+
+    monkeypatch.setattr(image_pipeline, "IMAGE_COLLAGE_MAX_CROPS", 10)
+    tall = pack_collages([(1400, 800)] * 3)
+    assert [len(layout) for layout in tall] == [2, 1]
+
+
+def test_prepare_collages_renders_numbered_canvas():
+    image = Image.new("RGB", (1000, 1000), "white")
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    boxes = [{"x": 0, "y": 0, "width": 50, "height": 20}, {"x": 0, "y": 50, "width": 30, "height": 30}]
+    collages = asyncio.run(prepare_collages(buffered.getvalue(), boxes, max_size=800))
+    assert len(collages) == 1
+    collage, indices = collages[0]
+    assert sorted(indices) == [0, 1]
+    assert collage.width <= image_pipeline.IMAGE_COLLAGE_WIDTH
+
+
+def test_collage_answers_are_split_by_label(mock_glm):
+    import main
+
+    answer = {"regions": [
+        {"label": "[2]", "questions": [{"question_no": "5"}]},
+        {"label": "1", "questions": [{"question_no": "3"}]},
+        {"label": "[9]", "questions": [{"question_no": "?"}]},
+        {"questions": [{"question_no": "no label"}]},
+    ]}
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response(json.dumps(answer)))
+
+    image = Image.new("RGB", (1000, 1000), "white")
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    boxes = [{"x": 0, "y": 0, "width": 50, "height": 20}, {"x": 0, "y": 50, "width": 30, "height": 30},
+             {"x": 50, "y": 50, "width": 30, "height": 30}]
+    results = asyncio.run(main.analyze_collages(buffered.getvalue(), boxes, "prompt", "test_collages", max_size=800))
+
+    assert len(requests) == 1
+    # 编号超出本张拼图或缺少编号的回答项丢弃, 没有回答的区域由调用方单独分析
+    assert results == {0: [{"questions": [{"question_no": "3"}]}], 1: [{"questions": [{"question_no": "5"}]}]}
@@ -0,0 +1,68 @@
+import asyncio
+
+import glm_scheduler
+from glm_scheduler import AIMDController, ConcurrencyLane
+
+
+def make_controller(limit: int = 2, max_limit: int = 4, rate: float = 2.0) -> AIMDController:
+    return AIMDController(ConcurrencyLane("test", limit), max_limit, rate=rate, min_rate=0.2, max_rate=10)
+
+
+def test_success_raises_rate_and_limit_additively():
+    controller = make_controller(limit=2, max_limit=3)
+    controller.on_success()
+    assert controller.rate == 2.0 + glm_scheduler.GLM_RATE_STEP
+    assert controller.lane.limit == 2
+
+    # 连续成功一轮(等于当前上限次)后并发上限加 1, 不超过上限
+    controller.on_success()
+    assert controller.lane.limit == 3
+    for _ in range(10):
+        controller.on_success()
+    assert controller.lane.limit == 3
+
+
+def test_throttle_halves_limit_and_rate():
+    controller = make_controller(limit=4, max_limit=8, rate=4.0)
+    controller.on_throttle()
+    assert controller.lane.limit == 2
+    assert controller.rate == 4.0 * glm_scheduler.GLM_DECREASE_FACTOR
+    assert controller.throttles == 1
+
+
+def test_throttles_within_cooldown_decrease_once():
+    controller = make_controller(limit=4, max_limit=8, rate=4.0)
+    controller.on_throttle()
+    controller.on_throttle(timeout=True)
+    assert controller.lane.limit == 2
+    assert (controller.throttles, controller.timeouts) == (1, 1)
+
+
+def test_limit_and_rate_have_floors():
+    controller = make_controller(limit=1, rate=0.3)
+    controller.on_throttle()
+    assert controller.lane.limit == 1
+    assert controller.rate == 0.2
+
+
+def test_backoff_grows_and_respects_retry_after():
+    for attempt in range(4):
+        wait = AIMDController.backoff(attempt)
+        ceiling = min(glm_scheduler.GLM_BACKOFF_MAX, glm_scheduler.GLM_BACKOFF_BASE * 2 ** attempt)
+        assert ceiling / 2 <= wait <= ceiling
+    assert AIMDController.backoff(0, retry_after=5) >= 5
+    assert AIMDController.backoff(0, retry_after=1000) <= glm_scheduler.GLM_BACKOFF_MAX
+
+
+def test_pace_spaces_sends_by_rate():
+    controller = make_controller(rate=20.0)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for _ in range(3):
+            await controller.pace()
+        return loop.time() - started
+
+    # 第一次立即发送, 之后每次间隔 1 / rate 秒
+    assert asyncio.run(scenario()) >= 2 / 20.0 - 0.01
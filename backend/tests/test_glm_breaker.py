@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+
+import pytest
+
+import glm_breaker
+from glm_breaker import (CircuitBreaker, CircuitOpenError, REASON_OUTAGE, REASON_QUOTA,
+                         STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手动推进的 time.monotonic"""
+    now = [1000.0]
+    monkeypatch.setattr(glm_breaker, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def make_breaker() -> CircuitBreaker:
+    return CircuitBreaker(failure_threshold=3, cooldown=30, max_cooldown=100, quota_cooldown=300, probe_timeout=60)
+
+
+def test_trips_after_consecutive_failures(clock):
+    breaker = make_breaker()
+    breaker.on_failure()
+    breaker.on_failure()
+    breaker.on_success()
+    breaker.on_failure()
+    breaker.on_failure()
+    assert breaker.state == STATE_CLOSED
+    assert breaker.before_request() is False
+
+    breaker.on_failure()
+    assert breaker.state == STATE_OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.reason == REASON_OUTAGE
+    assert error.value.retry_in == 30
+    assert breaker.rejected == 1
+
+
+def test_half_open_probe_success_closes(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.on_failure()
+
+    clock[0] += 30
+    assert breaker.before_request() is True
+    assert breaker.state == STATE_HALF_OPEN
+
+    breaker.on_success()
+    assert breaker.state == STATE_CLOSED
+    assert breaker.before_request() is False
+
+
+def test_failed_probe_doubles_cooldown(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.on_failure()
+
+    clock[0] += 30
+    assert breaker.before_request() is True
+    breaker.on_failure()
+    assert breaker.state == STATE_OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.retry_in == 60
+
+    # 冷却翻倍不超过上限
+    clock[0] += 60
+    assert breaker.before_request() is True
+    breaker.on_failure()
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.retry_in == 100
+
+
+def test_only_one_probe_and_retry_in_is_positive(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.on_failure()
+
+    clock[0] += 30
+    assert breaker.before_request() is True
+
+    # 探测进行中: 其他请求按探测最迟超时的时间重试, 不会提示 "0 秒后重试"
+    clock[0] += 10
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.retry_in == 50
+
+    clock[0] += 100
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.retry_in == 1
+
+    # 探测请求被取消后可以重新探测
+    breaker.release_probe()
+    assert breaker.before_request() is True
+
+
+def test_quota_exhausted_uses_quota_cooldown(clock):
+    breaker = make_breaker()
+    breaker.on_quota_exhausted()
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.reason == REASON_QUOTA
+    assert error.value.retry_in == 300
+    assert breaker.stats()["state"] == STATE_OPEN
+
+    clock[0] += 299.5
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.retry_in == 1
+
+    clock[0] += 0.5
+    assert breaker.before_request() is True
+    breaker.on_success()
+    assert breaker.stats()["reason"] is None
@@ -0,0 +1,115 @@
+import asyncio
+import os
+
+import glm_cache
+from glm_cache import ResponseCache
+
+
+def test_memory_hit_and_miss_are_counted():
+    cache = ResponseCache(max_entries=4, ttl=60, disk_dir=None)
+
+    async def scenario():
+        assert await cache.get("a" * 64, "ocr") is None
+        await cache.set("a" * 64, "内容", "ocr")
+        return await cache.get("a" * 64, "ocr")
+
+    assert asyncio.run(scenario()) == "内容"
+    assert cache.counters["ocr"] == {"memory_hits": 1, "disk_hits": 0, "misses": 1, "stores": 1}
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2, ttl=60, disk_dir=None)
+
+    async def scenario():
+        await cache.set("k1", "1", "t")
+        await cache.set("k2", "2", "t")
+        await cache.get("k1", "t")  # k1 最近使用过, 淘汰 k2
+        await cache.set("k3", "3", "t")
+        return [await cache.get(key, "t") for key in ("k1", "k2", "k3")]
+
+    assert asyncio.run(scenario()) == ["1", None, "3"]
+
+
+def test_expired_entries_are_dropped(monkeypatch):
+    cache = ResponseCache(max_entries=4, ttl=10, disk_dir=None)
+    now = [1000.0]
+    monkeypatch.setattr(glm_cache.time, "time", lambda: now[0])
+
+    async def scenario():
+        await cache.set("k", "v", "t")
+        now[0] += 11
+        return await cache.get("k", "t")
+
+    assert asyncio.run(scenario()) is None
+    assert cache.stats()["memory_entries"] == 0
+
+
+def test_disk_tier_is_shared_between_instances(tmp_path):
+    writer = ResponseCache(max_entries=4, ttl=60, disk_dir=str(tmp_path))
+    reader = ResponseCache(max_entries=4, ttl=60, disk_dir=str(tmp_path))
+    key = "ab" + "0" * 62
+
+    async def scenario():
+        await writer.set(key, "磁盘内容", "t")
+        return await reader.get(key, "t")
+
+    assert asyncio.run(scenario()) == "磁盘内容"
+    assert reader.counters["t"]["disk_hits"] == 1
+    assert os.path.exists(tmp_path / "ab" / f"{key}.json")
+
+
+def test_expired_disk_entry_is_removed(tmp_path, monkeypatch):
+    cache = ResponseCache(max_entries=4, ttl=10, disk_dir=str(tmp_path))
+    now = [1000.0]
+    monkeypatch.setattr(glm_cache.time, "time", lambda: now[0])
+    key = "cd" + "0" * 62
+
+    async def scenario():
+        await cache.set(key, "v", "t")
+        cache._memory.clear()
+        now[0] += 11
+        return await cache.get(key, "t")
+
+    assert asyncio.run(scenario()) is None
+    assert not os.path.exists(tmp_path / "cd" / f"{key}.json")
+
+
+def test_prune_keeps_newest_files(tmp_path):
+    cache = ResponseCache(max_entries=4, ttl=3600, disk_dir=str(tmp_path), disk_max_entries=2)
+    for i in range(4):
+        key = f"{i:02d}" + "0" * 62
+        cache._write_disk(key, (10 ** 10, str(i)), prune=False)
+        path = cache._disk_path(key)
+        os.utime(path, (os.path.getmtime(path) + i, os.path.getmtime(path) + i))
+
+    cache._prune_disk()
+    remaining = sorted(name for _, _, names in os.walk(tmp_path) for name in names)
+    assert remaining == ["02" + "0" * 62 + ".json", "03" + "0" * 62 + ".json"]
+
+
+def test_tags_control_whether_caching_applies(monkeypatch):
+    cache = ResponseCache(disk_dir=None)
+    monkeypatch.setattr(glm_cache, "GLM_CACHE_ENABLED", True)
+    monkeypatch.setattr(glm_cache, "GLM_CACHE_DISABLED_TAGS", {"chat"})
+    assert cache.is_enabled("ocr")
+    assert not cache.is_enabled("chat")
+    assert not cache.is_enabled(None)
+
+
+def test_call_with_cache_tag_skips_upstream_on_repeat(mock_glm, monkeypatch):
+    import glm_client
+    from conftest import glm_response
+
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response("缓存的回答"))
+    monkeypatch.setattr(glm_cache, "GLM_CACHE_ENABLED", True)
+    monkeypatch.setattr(glm_client, "response_cache", ResponseCache(disk_dir=None))
+    messages = [{"role": "user", "content": "1+1"}]
+
+    async def scenario():
+        first = await glm_client.call_glm_api(messages, model="glm-4-flash", cache="ocr")
+        second = await glm_client.call_glm_api(messages, model="glm-4-flash", cache="ocr")
+        return first, second
+
+    assert asyncio.run(scenario()) == ("缓存的回答", "缓存的回答")
+    assert len(requests) == 1
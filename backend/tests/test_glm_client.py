@@ -0,0 +1,59 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import glm_client
+from conftest import glm_response
+
+
+def test_call_returns_message_content(mock_glm):
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response("答案是 4"))
+
+    content = asyncio.run(glm_client.call_glm_api([{"role": "user", "content": "2+2"}], model="glm-4-flash", max_tokens=100))
+
+    assert content == "答案是 4"
+    assert requests == [{
+        "model": "glm-4-flash",
+        "messages": [{"role": "user", "content": "2+2"}],
+        "temperature": 0.7,
+        "max_tokens": 100
+    }]
+
+
+def test_client_error_is_not_retried(mock_glm):
+    respond, requests = mock_glm
+    respond(lambda payload: httpx.Response(400, json={"error": {"message": "参数错误"}}))
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(glm_client.call_glm_api([{"role": "user", "content": "hi"}], model="glm-4-flash"))
+
+    assert error.value.status_code == 400
+    assert "参数错误" in error.value.detail
+    assert len(requests) == 1
+
+
+def test_empty_content_is_an_error(mock_glm):
+    respond, _ = mock_glm
+    respond(lambda payload: glm_response("  "))
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(glm_client.call_glm_api([{"role": "user", "content": "hi"}], model="glm-4-flash", max_retries=1))
+    assert error.value.status_code == 500
+
+
+def test_http_client_is_shared_until_closed(monkeypatch):
+    monkeypatch.setattr(glm_client, "_http_client", None)
+
+    async def scenario():
+        first = glm_client.get_http_client()
+        assert glm_client.get_http_client() is first
+        await glm_client.close_http_client()
+        assert first.is_closed
+        second = glm_client.get_http_client()
+        assert second is not first
+        await glm_client.close_http_client()
+
+    asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import glm_client
+from conftest import glm_response
+
+MESSAGES = [{"role": "user", "content": "解方程 x+1=2"}]
+
+
+def test_identical_concurrent_calls_share_one_upstream_request(mock_glm):
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response("x=1"))
+
+    async def scenario():
+        return await asyncio.gather(*(glm_client.call_glm_api(MESSAGES, model="glm-4-flash") for _ in range(3)))
+
+    before = glm_client.client_stats["coalesced"]
+    assert asyncio.run(scenario()) == ["x=1"] * 3
+    assert len(requests) == 1
+    assert glm_client.client_stats["coalesced"] - before == 2
+    assert glm_client.get_client_stats()["inflight"] == 0
+
+
+def test_different_parameters_are_not_coalesced(mock_glm):
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response("x=1"))
+
+    async def scenario():
+        await asyncio.gather(
+            glm_client.call_glm_api(MESSAGES, model="glm-4-flash", max_tokens=100),
+            glm_client.call_glm_api(MESSAGES, model="glm-4-flash", max_tokens=200)
+        )
+
+    asyncio.run(scenario())
+    assert len(requests) == 2
+
+
+def test_shared_failure_reaches_every_caller(mock_glm):
+    respond, requests = mock_glm
+    respond(lambda payload: httpx.Response(400, json={"error": {"message": "参数错误"}}))
+
+    async def scenario():
+        return await asyncio.gather(
+            *(glm_client.call_glm_api(MESSAGES, model="glm-4-flash") for _ in range(2)),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(scenario())
+    assert len(requests) == 1
+    assert all(isinstance(result, HTTPException) and result.status_code == 400 for result in results)
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_request(mock_glm):
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response("x=1"))
+
+    async def scenario():
+        first = asyncio.ensure_future(glm_client.call_glm_api(MESSAGES, model="glm-4-flash"))
+        second = asyncio.ensure_future(glm_client.call_glm_api(MESSAGES, model="glm-4-flash"))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == "x=1"
+    assert len(requests) == 1
+
+
+def test_fingerprint_ignores_key_order():
+    first = glm_client.request_fingerprint({"model": "glm-4v", "messages": MESSAGES, "max_tokens": 10})
+    second = glm_client.request_fingerprint({"max_tokens": 10, "messages": MESSAGES, "model": "glm-4v"})
+    assert first == second
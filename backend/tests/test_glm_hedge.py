@@ -0,0 +1,116 @@
+import asyncio
+
+import glm_client
+import glm_hedge
+from glm_hedge import HedgeBudget, LatencyTracker, hedge_delay
+
+
+def test_percentile_needs_min_samples():
+    tracker = LatencyTracker(window=100, min_samples=5)
+    for seconds in (1, 2, 3, 4):
+        tracker.record("glm-4-flash", seconds)
+    assert tracker.percentile("glm-4-flash") is None
+    assert tracker.percentile("other") is None
+
+    tracker.record("glm-4-flash", 5)
+    assert tracker.percentile("glm-4-flash", 50) == 3
+    assert tracker.percentile("glm-4-flash", 95) == 5
+
+
+def test_percentile_uses_recent_window():
+    tracker = LatencyTracker(window=20, min_samples=1)
+    for _ in range(20):
+        tracker.record("glm-4-flash", 10.0)
+    for _ in range(20):
+        tracker.record("glm-4-flash", 1.0)
+    # 旧样本已滑出窗口
+    assert tracker.percentile("glm-4-flash", 95) == 1.0
+    assert tracker.stats()["glm-4-flash"]["samples"] == 20
+
+
+def test_budget_limits_hedges_to_ratio_of_requests():
+    budget = HedgeBudget(ratio=0.25, burst=3)
+    for _ in range(3):
+        budget.on_request("solve")
+    assert not budget.try_spend("solve")
+
+    budget.on_request("solve")
+    assert budget.try_spend("solve")
+    assert not budget.try_spend("solve")
+
+    counters = budget.counters["solve"]
+    assert counters == {"requests": 4, "hedged": 1, "hedge_wins": 0, "denied": 2}
+
+
+def test_budget_is_per_endpoint_and_capped_by_burst():
+    budget = HedgeBudget(ratio=1, burst=2)
+    for _ in range(10):
+        budget.on_request("chat")
+    assert budget.try_spend("chat")
+    assert budget.try_spend("chat")
+    assert not budget.try_spend("chat")
+    # 其他端点没有积累额度
+    assert not budget.try_spend("solve")
+
+    budget.on_hedge_win("chat")
+    assert budget.stats()["endpoints"]["chat"]["hedge_wins"] == 1
+
+
+def test_hedge_delay_has_floor(monkeypatch):
+    tracker = LatencyTracker(window=10, min_samples=3)
+    assert hedge_delay(tracker, "glm-4-flash") is None
+
+    for _ in range(3):
+        tracker.record("glm-4-flash", 0.2)
+    assert hedge_delay(tracker, "glm-4-flash") == glm_hedge.GLM_HEDGE_MIN_DELAY
+
+    for _ in range(10):
+        tracker.record("glm-4-flash", 8.0)
+    assert hedge_delay(tracker, "glm-4-flash") == 8.0
+
+    monkeypatch.setattr(glm_hedge, "GLM_HEDGE_ENABLED", False)
+    assert hedge_delay(tracker, "glm-4-flash") is None
+
+
+def hedge_setup(monkeypatch, delays: dict, ratio: float = 1.0):
+    """p95 很短的模型; 每次上游调用按次序使用 delays 中的耗时, 返回 (调用记录, 对冲预算)"""
+    tracker = LatencyTracker(window=10, min_samples=1)
+    tracker.record("glm-4-flash", 0.01)
+    budget = HedgeBudget(ratio=ratio, burst=3)
+    monkeypatch.setattr(glm_client, "latency_tracker", tracker)
+    monkeypatch.setattr(glm_client, "hedge_budget", budget)
+    monkeypatch.setattr(glm_hedge, "GLM_HEDGE_MIN_DELAY", 0.05)
+
+    calls = []
+
+    async def fake_request(payload, req_id, max_retries, priority, sent=None):
+        index = len(calls)
+        calls.append(max_retries)
+        if sent is not None:
+            sent.set()
+        await asyncio.sleep(delays[index])
+        return f"call-{index}"
+
+    monkeypatch.setattr(glm_client, "request_glm", fake_request)
+    return calls, budget
+
+
+def test_slow_primary_is_hedged_and_backup_wins(monkeypatch):
+    calls, budget = hedge_setup(monkeypatch, {0: 5.0, 1: 0.01})
+    payload = {"model": "glm-4-flash"}
+
+    result = asyncio.run(glm_client.hedged_request(payload, 1, 3, glm_client.PRIORITY_NORMAL, "solve"))
+    assert result == "call-1"
+    # 对冲请求不重试
+    assert calls == [3, 1]
+    assert budget.counters["solve"]["hedge_wins"] == 1
+
+
+def test_no_hedge_without_budget(monkeypatch):
+    calls, budget = hedge_setup(monkeypatch, {0: 0.2}, ratio=0.1)
+    payload = {"model": "glm-4-flash"}
+
+    result = asyncio.run(glm_client.hedged_request(payload, 1, 3, glm_client.PRIORITY_NORMAL, "solve"))
+    assert result == "call-0"
+    assert calls == [3]
+    assert budget.counters["solve"]["denied"] == 1
@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+
+import glm_scheduler
+from glm_scheduler import ConcurrencyLane, PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_NORMAL
+
+
+def run_queue(entries, monkeypatch):
+    """依次以 (名称, 优先级, 入队时间) 排队, 返回获得名额的顺序"""
+    async def scenario():
+        lane = ConcurrencyLane("test", 1)
+        await lane.acquire()
+        order = []
+
+        async def wait(name, priority):
+            await lane.acquire(priority)
+            order.append(name)
+            lane.release()
+
+        tasks = []
+        for name, priority, enqueued_at in entries:
+            monkeypatch.setattr(glm_scheduler, "time", SimpleNamespace(monotonic=lambda value=enqueued_at: value))
+            tasks.append(asyncio.ensure_future(wait(name, priority)))
+            await asyncio.sleep(0)
+        lane.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    return asyncio.run(scenario())
+
+
+def test_higher_priority_jumps_the_queue(monkeypatch):
+    order = run_queue([
+        ("bulk", PRIORITY_BULK, 100.0),
+        ("normal", PRIORITY_NORMAL, 100.1),
+        ("interactive", PRIORITY_INTERACTIVE, 100.2),
+    ], monkeypatch)
+    assert order == ["interactive", "normal", "bulk"]
+
+
+def test_same_priority_is_first_in_first_out(monkeypatch):
+    order = run_queue([("a", PRIORITY_NORMAL, 100.0), ("b", PRIORITY_NORMAL, 100.0), ("c", PRIORITY_NORMAL, 100.0)],
+                      monkeypatch)
+    assert order == ["a", "b", "c"]
+
+
+def test_aging_lets_long_waiting_bulk_requests_through(monkeypatch):
+    aging = glm_scheduler.GLM_PRIORITY_AGING
+    order = run_queue([
+        # 批量请求已经排队超过两个老化周期, 相当于提升到交互级别之前
+        ("bulk", PRIORITY_BULK, 100.0),
+        ("interactive", PRIORITY_INTERACTIVE, 100.0 + 2 * aging + 1),
+    ], monkeypatch)
+    assert order == ["bulk", "interactive"]
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from glm_scheduler import ConcurrencyLane, GLMScheduler, PRIORITY_INTERACTIVE
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_lane_queues_beyond_limit():
+    async def scenario():
+        lane = ConcurrencyLane("test", 1)
+        await lane.acquire()
+        waiter = asyncio.ensure_future(lane.acquire())
+        await settle()
+        assert not waiter.done()
+        assert (lane.active, lane.queued) == (1, 1)
+
+        lane.release()
+        await waiter
+        assert (lane.active, lane.queued) == (1, 0)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_still_queued_is_removed():
+    async def scenario():
+        lane = ConcurrencyLane("test", 1)
+        await lane.acquire()
+        waiter = asyncio.ensure_future(lane.acquire())
+        await settle()
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert lane.queued == 0
+
+        lane.release()
+        assert lane.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_popped_by_release_raises_cancelled():
+    async def scenario():
+        lane = ConcurrencyLane("test", 1)
+        await lane.acquire()
+        waiter = asyncio.ensure_future(lane.acquire())
+        await settle()
+
+        # 取消后, 在等待者处理取消之前归还名额: _wake_up 会先弹出这个已取消的等待者
+        waiter.cancel()
+        lane.release()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert (lane.active, lane.queued) == (0, 0)
+
+        await lane.acquire()
+        assert lane.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_after_grant_returns_slot():
+    async def scenario():
+        lane = ConcurrencyLane("test", 1)
+        await lane.acquire()
+        waiter = asyncio.ensure_future(lane.acquire())
+        await settle()
+
+        # 名额已分配给等待者, 但它在恢复运行前被取消
+        lane.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert (lane.active, lane.queued) == (0, 0)
+
+    asyncio.run(scenario())
+
+
+def test_models_have_independent_lanes():
+    async def scenario():
+        scheduler = GLMScheduler(["key-aaaaaaaaaaaa"], model_limits={"glm-4v": 1, "glm-4-flash": 1}, key_limit=4)
+        async with scheduler.slot("glm-4v"):
+            # glm-4v 通道已满, 不影响 glm-4-flash
+            assert not scheduler.has_capacity("glm-4v")
+            assert scheduler.has_capacity("glm-4-flash")
+            async with scheduler.slot("glm-4-flash") as (api_key, controller):
+                assert api_key == "key-aaaaaaaaaaaa"
+                assert controller.lane.name.endswith("glm-4-flash")
+
+    asyncio.run(scenario())
+
+
+def test_key_with_lowest_load_is_picked():
+    async def scenario():
+        scheduler = GLMScheduler(["key-aaaaaaaaaaaa", "key-bbbbbbbbbbbb"], model_limits={"glm-4v": 1}, key_limit=4)
+        async with scheduler.slot("glm-4v") as (first, _):
+            async with scheduler.slot("glm-4v") as (second, _):
+                assert {first, second} == {"key-aaaaaaaaaaaa", "key-bbbbbbbbbbbb"}
+
+    asyncio.run(scenario())
+
+
+def test_key_lane_limits_all_models_together():
+    async def scenario():
+        scheduler = GLMScheduler(["key-aaaaaaaaaaaa"], model_limits={"glm-4v": 2, "glm-4-flash": 2}, key_limit=1)
+        async with scheduler.slot("glm-4v"):
+            blocked = asyncio.ensure_future(scheduler.slot("glm-4-flash", PRIORITY_INTERACTIVE).__aenter__())
+            await settle()
+            assert not blocked.done()
+            blocked.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await blocked
+        # 取消后两条通道都没有残留名额
+        assert all(lane.active == 0 for lane in scheduler.model_lanes.values())
+        assert scheduler.key_lanes["key-aaaaaaaaaaaa"].active == 0
+
+    asyncio.run(scenario())
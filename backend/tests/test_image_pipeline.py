@@ -0,0 +1,146 @@
+import asyncio
+import base64
+import io
+
+import numpy as np
+from PIL import Image
+
+import image_pipeline
+from image_pipeline import PreparedImage, RenditionCache, display_size, encode_bytes, encode_to_budget, load_image
+
+
+def jpeg_bytes(size=(4000, 3000), orientation: int = 1) -> bytes:
+    image = Image.new("RGB", size, (250, 250, 250))
+    exif = Image.Exif()
+    if orientation != 1:
+        exif[0x0112] = orientation
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=80, exif=exif.tobytes())
+    return buffered.getvalue()
+
+
+def test_load_image_downscales_to_max_size():
+    image, original_size = load_image(jpeg_bytes(), max_size=1200)
+    assert original_size == (4000, 3000)
+    assert image.size == (1200, 900)
+
+
+def test_load_image_applies_exif_rotation():
+    data = jpeg_bytes(orientation=6)
+    assert display_size(data) == (3000, 4000)
+    image, original_size = load_image(data, max_size=1000)
+    assert original_size == (4000, 3000)
+    assert image.size == (750, 1000)
+
+
+def test_load_image_keeps_small_images():
+    image, _ = load_image(jpeg_bytes(size=(800, 600)), max_size=1200)
+    assert image.size == (800, 600)
+    image, _ = load_image(jpeg_bytes(), max_size=1200, resize_over_pixels=20_000_000)
+    assert image.size == (4000, 3000)
+
+
+def prepared(size: int) -> PreparedImage:
+    return PreparedImage("a" * size, 10, 10, 10, 10)
+
+
+def test_rendition_cache_evicts_least_recently_used():
+    cache = RenditionCache(max_bytes=300)
+    cache.set(("a",), prepared(100))
+    cache.set(("b",), prepared(100))
+    cache.set(("c",), prepared(100))
+    assert cache.get(("a",)) is not None
+
+    cache.set(("d",), prepared(100))
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) is not None
+    assert cache.size == 300
+    assert cache.stats()["entries"] == 3
+
+
+def test_rendition_cache_skips_oversized_and_replaces_entries():
+    cache = RenditionCache(max_bytes=300)
+    cache.set(("big",), prepared(400))
+    assert cache.get(("big",)) is None
+
+    cache.set(("a",), prepared(100))
+    cache.set(("a",), prepared(200))
+    assert cache.size == 200
+    assert cache.get(("a",)).bytes == 150
+
+
+def test_prepare_image_reuses_cached_rendition(monkeypatch):
+    cache = RenditionCache(max_bytes=10 * 1024 * 1024)
+    monkeypatch.setattr(image_pipeline, "rendition_cache", cache)
+    jobs = []
+    original_run = image_pipeline.image_pool.run
+
+    async def counting_run(func, *args):
+        jobs.append(func.__name__)
+        return await original_run(func, *args)
+
+    monkeypatch.setattr(image_pipeline.image_pool, "run", counting_run)
+    data = jpeg_bytes()
+
+    async def scenario():
+        first = await image_pipeline.prepare_image(data, max_size=800, quality=80)
+        again = await image_pipeline.prepare_image(data, max_size=800, quality=80)
+        other = await image_pipeline.prepare_image(data, max_size=600, quality=80)
+        return first, again, other
+
+    first, again, other = asyncio.run(scenario())
+    assert again is first
+    assert (first.width, other.width) == (800, 600)
+    assert jobs == ["render_image", "render_image"]
+    assert cache.hits == 1
+
+
+def textured_image() -> Image.Image:
+    """细节丰富(编码后较大)的 2000x1500 图片"""
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (150, 200, 3), dtype=np.uint8)
+    return Image.fromarray(noise).resize((2000, 1500), Image.BICUBIC)
+
+
+def test_encode_to_budget_keeps_max_quality_when_it_fits():
+    encoded, quality, image = encode_to_budget(textured_image(), 10 * 1024 * 1024, 85)
+    assert quality == 85
+    assert image.size == (2000, 1500)
+
+
+def test_encode_to_budget_lowers_quality_before_size():
+    image = textured_image()
+    budget = len(encode_bytes(image, 60)) + 1000
+    encoded, quality, encoded_image = encode_to_budget(image, budget, 85)
+    assert len(encoded) <= budget
+    assert image_pipeline.IMAGE_MIN_QUALITY <= quality < 85
+    assert encoded_image.size == (2000, 1500)
+
+
+def test_encode_to_budget_shrinks_but_not_below_min_side():
+    encoded, quality, image = encode_to_budget(textured_image(), 200_000, 85)
+    assert len(encoded) <= 200_000
+    assert image_pipeline.IMAGE_MIN_SIDE <= max(image.size) < 2000
+
+    # 预算无法满足时清晰度下限优先
+    encoded, quality, image = encode_to_budget(textured_image(), 5_000, 85)
+    assert max(image.size) == image_pipeline.IMAGE_MIN_SIDE
+    assert quality == image_pipeline.IMAGE_MIN_QUALITY
+
+
+def test_task_profiles_set_size_and_color():
+    data = jpeg_bytes()
+
+    async def scenario():
+        subject = await image_pipeline.prepare_task_image(data, "subject")
+        chat = await image_pipeline.prepare_task_image(data, "chat")
+        page = await image_pipeline.prepare_task_image(data, "page", max_size=1000)
+        return subject, chat, page
+
+    subject, chat, page = asyncio.run(scenario())
+    assert max(subject.width, subject.height) == image_pipeline.IMAGE_SUBJECT_SIZE
+    assert Image.open(io.BytesIO(base64.b64decode(subject.base64))).mode == "L"
+    assert max(chat.width, chat.height) <= 1024
+    assert chat.bytes <= image_pipeline.IMAGE_BUDGET_CHAT
+    # 调用时的参数覆盖规格
+    assert max(page.width, page.height) == 1000
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from image_pipeline import ImageWorkerPool, fit_size
+
+
+def test_process_pool_runs_job():
+    pool = ImageWorkerPool(workers=1, queue_size=2)
+    try:
+        assert asyncio.run(pool.run(fit_size, 4000, 3000, (1200, 1200))) == (1200, 900)
+    finally:
+        pool.shutdown()
+    assert pool.stats()["submitted"] == 1
+    assert pool.stats()["in_flight"] == 0
+
+
+def test_full_queue_waits_then_rejects_with_503():
+    pool = ImageWorkerPool(workers=0, queue_size=0, queue_timeout=0.05)
+
+    async def scenario():
+        busy = asyncio.ensure_future(pool.run(time.sleep, 0.3))
+        await asyncio.sleep(0.01)
+        with pytest.raises(HTTPException) as error:
+            await pool.run(time.sleep, 0)
+        await busy
+        return error.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert pool.rejected == 1
+    assert pool.submitted == 1
+
+
+def test_queued_job_runs_when_slot_frees():
+    pool = ImageWorkerPool(workers=0, queue_size=0, queue_timeout=1)
+
+    async def scenario():
+        return await asyncio.gather(pool.run(time.sleep, 0.05), pool.run(fit_size, 10, 10, (5, 5)))
+
+    assert asyncio.run(scenario()) == [None, (5, 5)]
+    assert pool.rejected == 0
+    assert pool.stats()["waiting"] == 0
+
+
+def test_cancelled_caller_keeps_slot_until_job_finishes():
+    pool = ImageWorkerPool(workers=0, queue_size=0, queue_timeout=0.05)
+
+    async def scenario():
+        caller = asyncio.ensure_future(pool.run(time.sleep, 0.3))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.sleep(0.01)
+        # 任务仍在执行, 名额没有归还
+        assert pool.in_flight == 1
+        with pytest.raises(HTTPException):
+            await pool.run(time.sleep, 0)
+
+        await asyncio.sleep(0.4)
+        assert pool.in_flight == 0
+        return await pool.run(fit_size, 10, 10, (5, 5))
+
+    assert asyncio.run(scenario()) == (5, 5)
+    assert pool.rejected == 1
@@ -0,0 +1,109 @@
+import base64
+import io
+
+from fastapi.testclient import TestClient
+from PIL import Image, ImageEnhance, ImageFilter
+
+from conftest import glm_response, read_testdata
+from image_quality import assess_quality, judge_quality
+
+
+def jpeg_bytes(image: Image.Image) -> bytes:
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=90)
+    return buffered.getvalue()
+
+
+def exam_photo() -> Image.Image:
+    return Image.open(io.BytesIO(read_testdata("数学.jpg")))
+
+
+def test_sharp_photo_passes():
+    report = assess_quality(read_testdata("数学.jpg"))
+    assert report["ok"]
+    assert report["issues"] == [] and report["warnings"] == []
+
+
+def test_blurred_photo_is_rejected():
+    report = assess_quality(jpeg_bytes(exam_photo().filter(ImageFilter.GaussianBlur(4))))
+    assert not report["ok"]
+    assert any("模糊" in issue for issue in report["issues"])
+
+
+def test_dark_photo_is_rejected():
+    report = assess_quality(jpeg_bytes(ImageEnhance.Brightness(exam_photo()).enhance(0.12)))
+    assert any("太暗" in issue for issue in report["issues"])
+
+
+def test_low_resolution_photo_is_rejected():
+    small = exam_photo().resize((150, 200))
+    report = assess_quality(jpeg_bytes(small))
+    assert any("分辨率过低" in issue for issue in report["issues"])
+
+
+def test_glare_warns_and_washed_out_is_rejected():
+    metrics = {"sharpness": 2.0, "median": 190, "highlight": 255, "contrast": 180, "clipped_ratio": 0.1,
+               "ink_ratio": 0.05, "line_height": 40}
+    report = judge_quality(metrics)
+    assert report["ok"] and any("反光" in warning for warning in report["warnings"])
+
+    report = judge_quality({**metrics, "median": 255, "clipped_ratio": 0.9, "ink_ratio": 0.001, "sharpness": 0.01})
+    # 过曝时只报告过曝, 不重复报告模糊
+    assert report["issues"] == ["图片过曝, 文字被冲淡, 请避开强光重新拍摄"]
+
+
+def test_endpoint_rejects_blurred_photo_before_calling_glm(mock_glm):
+    import main
+
+    _, requests = mock_glm
+    blurred = jpeg_bytes(exam_photo().filter(ImageFilter.GaussianBlur(6)))
+    response = TestClient(main.app).post("/api/detect/questions", json={
+        "image_data": base64.b64encode(blurred).decode()
+    })
+    assert response.status_code == 400
+    assert "模糊" in response.json()["detail"]
+    assert requests == []
+
+
+def questions_answer(payload):
+    return glm_response('{"questions": [{"question_no": "1", "question_text": "解方程 x+1=2"}]}')
+
+
+def test_warnings_are_returned_by_json_endpoint(mock_glm):
+    import main
+
+    respond, requests = mock_glm
+    respond(questions_answer)
+    dark = jpeg_bytes(ImageEnhance.Brightness(exam_photo()).enhance(0.3))
+    response = TestClient(main.app).post("/api/detect/questions", json={
+        "image_data": base64.b64encode(dark).decode()
+    })
+    assert response.status_code == 200
+    assert requests
+    assert any("偏暗" in warning for warning in response.json()["quality_warnings"])
+
+
+def test_warn_gate_returns_issues_instead_of_rejecting(mock_glm, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "QUALITY_GATE", "warn")
+    respond, requests = mock_glm
+    respond(questions_answer)
+    blurred = jpeg_bytes(exam_photo().filter(ImageFilter.GaussianBlur(6)))
+    response = TestClient(main.app).post("/api/ocr/exam", json={
+        "image_data": base64.b64encode(blurred).decode()
+    })
+    assert response.status_code == 200
+    assert requests
+    assert any("模糊" in warning for warning in response.json()["quality_warnings"])
+
+
+def test_sharp_photo_has_empty_warnings(mock_glm):
+    import main
+
+    respond, _ = mock_glm
+    respond(questions_answer)
+    response = TestClient(main.app).post("/api/detect/questions", json={
+        "image_data": base64.b64encode(read_testdata("数学.jpg")).decode()
+    })
+    assert response.json()["quality_warnings"] == []
@@ -0,0 +1,47 @@
+import asyncio
+import base64
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from conftest import read_testdata
+from image_pipeline import box_mean, ink_only_image, prepare_image
+
+
+def shaded_page() -> Image.Image:
+    """左暗右亮(阴影)的黄色纸面上, 左边黑字, 右边红笔"""
+    gradient = np.linspace(120, 240, 600)[None, :, None] * np.array([1.0, 0.95, 0.8])
+    page = Image.fromarray(np.broadcast_to(gradient, (400, 600, 3)).astype(np.uint8))
+    draw = ImageDraw.Draw(page)
+    draw.rectangle((50, 100, 250, 110), fill=(40, 40, 40))
+    draw.line((400, 100, 550, 250), fill=(170, 30, 30), width=8)
+    return page
+
+
+def test_box_mean_matches_direct_average():
+    values = np.arange(30, dtype=np.float64).reshape(5, 6)
+    means = box_mean(values, 1)
+    assert means[2, 2] == values[1:4, 1:4].mean()
+    # 边缘按窗口内实际像素数计算
+    assert means[0, 0] == values[0:2, 0:2].mean()
+
+
+def test_ink_only_separates_black_and_red_ink_under_shadow():
+    result = ink_only_image(shaded_page())
+    assert result.mode == "P"
+    indices = np.asarray(result)
+    assert set(np.unique(indices)) == {0, 1, 2}
+    # 阴影中的纸面不被当成笔迹
+    assert indices[300, 20] == 0 and indices[300, 580] == 0
+    assert indices[105, 150] == 1
+    assert indices[175, 475] == 2
+
+
+def test_ink_only_rendition_is_small_png():
+    data = read_testdata("数学.jpg")
+    prepared = asyncio.run(prepare_image(data, ink_only=True))
+    assert prepared.mime == "image/png"
+    image = Image.open(io.BytesIO(base64.b64decode(prepared.base64)))
+    assert image.format == "PNG" and image.mode == "P"
+    assert prepared.bytes < len(data)
@@ -0,0 +1,79 @@
+import base64
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image, ImageDraw
+
+import page_analysis
+from conftest import glm_response, read_testdata
+from mark_detector import MARK_CHECK, MARK_CIRCLE, MARK_CROSS, describe_marks, detect_marks
+
+RED = (210, 30, 30)
+
+
+def png_bytes(image: Image.Image) -> bytes:
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def test_classifies_drawn_marks():
+    image = Image.new("RGB", (1000, 1000), "white")
+    draw = ImageDraw.Draw(image)
+    draw.line((100, 100, 160, 160), fill=RED, width=6)
+    draw.line((160, 100, 100, 160), fill=RED, width=6)
+    draw.line((400, 420, 430, 460), fill=RED, width=6)
+    draw.line((430, 460, 490, 370), fill=RED, width=6)
+    draw.ellipse((700, 700, 790, 790), outline=RED, width=6)
+    draw.text((300, 800), "x+1=2", fill="black")
+
+    result = detect_marks(png_bytes(image))
+    assert result["has_red_ink"]
+    assert [mark["type"] for mark in result["marks"]] == [MARK_CROSS, MARK_CHECK, MARK_CIRCLE]
+    cross = result["marks"][0]
+    assert 8 <= cross["x"] <= 12 and 8 <= cross["y"] <= 12
+
+    # 位置提示只列出 × 和 ○, √ 不是错题
+    hint = describe_marks(result["marks"])
+    assert hint.count("\n") == 1
+    assert "红色×" in hint and "红色圈" in hint
+
+
+def test_black_ink_only_page_has_no_red_ink():
+    image = Image.new("RGB", (800, 600), "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(50, 550, 40):
+        draw.line((50, y, 750, y), fill="black", width=3)
+    assert detect_marks(png_bytes(image)) == {"red_ratio": 0.0, "has_red_ink": False, "marks": []}
+
+
+def test_finds_teacher_marks_on_exam_photo():
+    result = detect_marks(read_testdata("数学.jpg"))
+    assert result["has_red_ink"]
+    assert result["marks"]
+    assert all(0 <= mark["x"] <= 100 and 0 <= mark["y"] <= 100 for mark in result["marks"])
+
+
+def test_processed_scan_without_red_ink_is_skipped():
+    assert not detect_marks(read_testdata("01_processed.jpg"))["has_red_ink"]
+
+
+@pytest.mark.parametrize("path", ["/api/detect/mistakes", "/api/detect/mistakes/stream"])
+def test_failed_local_scan_still_calls_vision_model(mock_glm, monkeypatch, path):
+    import main
+
+    def broken(image):
+        raise ValueError("detector failed")
+
+    monkeypatch.setattr(page_analysis, "detect_image_marks", broken)
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response('{"mistakes": [{"question_no": "2", "reason": "红叉"}], "summary": "共找到1道错题"}'))
+
+    response = TestClient(main.app).post(path, json={"image_data": base64.b64encode(read_testdata("数学.jpg")).decode()})
+    assert response.status_code == 200
+    assert "未发现红笔批改痕迹" not in response.text
+    vision_calls = [request for request in requests if request["model"] == "glm-4v"]
+    assert vision_calls
+    # 没有本地检测结果时不附加位置提示
+    assert "本地图像分析" not in vision_calls[0]["messages"][0]["content"][-1]["text"]
@@ -0,0 +1,75 @@
+import asyncio
+import base64
+import io
+import json
+
+from PIL import Image
+
+from conftest import glm_response
+from image_pipeline import crop_box, prepare_crops
+
+
+def two_color_png() -> bytes:
+    """左半红, 右半蓝的 1000x500 图片"""
+    image = Image.new("RGB", (1000, 500), (0, 0, 255))
+    image.paste((255, 0, 0), (0, 0, 500, 500))
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def decode(prepared) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(prepared.base64))).convert("RGB")
+
+
+def test_crop_box_converts_percent_with_padding():
+    box = {"x": 10, "y": 20, "width": 30, "height": 40}
+    assert crop_box((1000, 500), box) == (100, 100, 400, 300)
+    assert crop_box((1000, 500), box, padding=2) == (80, 90, 420, 310)
+    # 超出图片的框被截断在图片内
+    assert crop_box((1000, 500), {"x": 90, "y": 90, "width": 30, "height": 30}) == (900, 450, 1000, 500)
+
+
+def test_prepare_crops_cuts_each_marked_region():
+    boxes = [{"x": 5, "y": 10, "width": 40, "height": 80}, {"x": 55, "y": 10, "width": 40, "height": 80}]
+    left, right = asyncio.run(prepare_crops(two_color_png(), boxes, max_size=200, quality=90))
+    assert (left.width, left.height) == (200, 200)
+    assert decode(left).getpixel((100, 100))[0] > 200
+    assert decode(right).getpixel((100, 100))[2] > 200
+
+
+def test_has_marked_regions():
+    import main
+
+    assert main.has_marked_regions([{"x": 1, "y": 2, "width": 10, "height": 5}])
+    assert not main.has_marked_regions([{"x": 1, "y": 2}])
+    assert not main.has_marked_regions([{"x": 1, "y": 2, "width": "wide", "height": 5}])
+    assert not main.has_marked_regions([])
+
+
+def test_marked_regions_are_analyzed_separately_in_order(mock_glm, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "COLLAGE_MIN_REGIONS", 0)
+    # 各区域宽度不同(加上边距后约 120, 220, 320), 按裁剪图宽度区分是哪个区域(请求并发发出, 到达顺序不固定)
+    answers = {
+        1: json.dumps({"question_no": "", "error_type": "计算错误"}, ensure_ascii=False),
+        2: "无法识别",
+        3: json.dumps({"mistakes": [{"question_no": "5", "error_type": "概念错误"}]}, ensure_ascii=False),
+    }
+
+    def handler(payload):
+        url = payload["messages"][0]["content"][0]["image_url"]["url"]
+        width = Image.open(io.BytesIO(base64.b64decode(url.split(",")[1]))).width
+        return glm_response(answers[width // 100])
+
+    respond, requests = mock_glm
+    respond(handler)
+
+    marks = [{"x": 0, "y": 0, "width": 10 * n, "height": 30} for n in (1, 2, 3)]
+    mistakes = asyncio.run(main.analyze_marked_regions(two_color_png(), marks, cache="test_marked_regions"))
+
+    assert len(requests) == 3
+    assert all(request["messages"][0]["content"][0]["type"] == "image_url" for request in requests)
+    # 解析失败的区域跳过, 没有题号的区域按框选顺序编号
+    assert [(item["question_no"], item["error_type"]) for item in mistakes] == [("框选题目1", "计算错误"), ("5", "概念错误")]
@@ -0,0 +1,67 @@
+from ocr_tiles import merge_tile_questions, should_tile, stitch, tile_boxes
+
+# 上下两块, 中间有重叠
+TILES = [{"x": 0, "y": 0, "width": 100, "height": 54}, {"x": 0, "y": 46, "width": 100, "height": 54}]
+
+
+def question(number: str, text: str, **fields) -> dict:
+    return {"question_no": number, "question_text": text, **fields}
+
+
+def test_tile_boxes_overlap_and_cover_page():
+    boxes = tile_boxes(2000, 6000)
+    assert len(boxes) >= 2
+    assert boxes[0]["y"] == 0 and round(boxes[-1]["y"] + boxes[-1]["height"]) == 100
+    for upper, lower in zip(boxes, boxes[1:]):
+        assert lower["y"] < upper["y"] + upper["height"]
+    # 横拍双栏试卷分为左右两栏
+    assert {box["x"] for box in tile_boxes(6000, 3000)} == {0, 50 - 4}
+
+
+def test_should_tile_prefers_request():
+    assert should_tile(1000, 1000, True)
+    assert not should_tile(5000, 5000, False)
+
+
+def test_stitch_joins_text_split_at_tile_border():
+    first = "已知二次函数 y=x²+2x-3, 求顶点坐标和对称"
+    second = "求顶点坐标和对称轴方程"
+    assert stitch(first, second) == "已知二次函数 y=x²+2x-3, 求顶点坐标和对称轴方程"
+    assert stitch("计算 1+2+3+...+100 的值", "解方程 2x+5=11 并检验") is None
+    assert stitch("", "解方程 2x+5=11") is None
+
+
+def test_split_question_is_merged_once():
+    results = [
+        [question("1", "已知二次函数 y=x²+2x-3, 求顶点坐标和对称")],
+        [question("", "求顶点坐标和对称轴方程", student_answer="(-1,-4)")]
+    ]
+    merged = merge_tile_questions(TILES, results)
+    assert len(merged) == 1
+    assert merged[0]["question_text"] == "已知二次函数 y=x²+2x-3, 求顶点坐标和对称轴方程"
+    assert merged[0]["student_answer"] == "(-1,-4)"
+
+
+def test_same_number_different_text_is_kept():
+    # 不同大题下的小题题号相同
+    results = [[question("1", "计算 1+2+3+...+100 的值")], [question("1", "解方程 2x+5=11 并检验")]]
+    assert len(merge_tile_questions(TILES, results)) == 2
+
+
+def test_empty_text_without_number_is_not_merged():
+    results = [[question("3", "化简 (a+b)²-(a-b)²")], [question("", "", student_answer="4ab", teacher_mark="√")]]
+    merged = merge_tile_questions(TILES, results)
+    assert len(merged) == 2
+    assert "student_answer" not in merged[0]
+
+
+def test_empty_text_with_same_number_is_merged():
+    results = [[question("3", "化简 (a+b)²-(a-b)²")], [question("3", "", student_answer="4ab")]]
+    merged = merge_tile_questions(TILES, results)
+    assert merged == [question("3", "化简 (a+b)²-(a-b)²", student_answer="4ab")]
+
+
+def test_questions_in_non_adjacent_tiles_are_kept():
+    tiles = [{"x": 0, "y": 0, "width": 100, "height": 30}, {"x": 0, "y": 70, "width": 100, "height": 30}]
+    results = [[question("1", "求顶点坐标和对称轴方程")], [question("1", "求顶点坐标和对称轴方程")]]
+    assert len(merge_tile_questions(tiles, results)) == 2
@@ -0,0 +1,58 @@
+import asyncio
+
+import page_analysis
+from conftest import read_testdata
+from image_quality import assess_quality
+from mark_detector import detect_marks
+from page_analysis import analyze_page
+from page_segmenter import segment_questions
+from paper_index import hamming_distance, perceptual_hash
+
+ALL_PARTS = ("quality", "hash", "segments", "marks")
+
+
+def test_single_decode_matches_separate_analyses():
+    data = read_testdata("数学.jpg")
+    results = analyze_page(data, ALL_PARTS)
+
+    assert results["quality"]["ok"] == assess_quality(data)["ok"]
+    assert hamming_distance(results["hash"], perceptual_hash(data)) <= 10
+    assert results["segments"] == segment_questions(data)
+    assert results["marks"] == detect_marks(data)
+
+
+def test_failed_part_does_not_affect_others(monkeypatch):
+    def broken(image, size):
+        raise ValueError("broken")
+
+    monkeypatch.setitem(page_analysis.ANALYSES, "segments", (1200, broken))
+    results = analyze_page(read_testdata("错题1.png"), ("segments", "marks"))
+    assert isinstance(results["segments"], ValueError)
+    assert results["marks"]["has_red_ink"]
+
+
+def test_request_analysis_runs_one_pool_job(monkeypatch):
+    import main
+
+    jobs = []
+    original_run = main.image_pool.run
+
+    async def counting_run(func, *args):
+        jobs.append((func.__name__, args[1:]))
+        return await original_run(func, *args)
+
+    monkeypatch.setattr(main.image_pool, "run", counting_run)
+    monkeypatch.setattr(main, "QUALITY_GATE", "warn")
+    request = main.DetectMistakesRequest.from_upload(read_testdata("数学.jpg"), user_id="student-1")
+
+    async def scenario():
+        await main.run_page_analysis(request, "quality", "hash", "segments")
+        await main.check_paper_quality(request)
+        paper_hash, reused = await main.find_reused_paper(request, "test_page_analysis")
+        regions = await main.page_analysis(request, "segments")
+        return paper_hash, reused, regions
+
+    paper_hash, reused, regions = asyncio.run(scenario())
+    assert jobs == [("analyze_page", (("quality", "hash", "segments"),))]
+    assert paper_hash is not None and reused is None
+    assert len(regions) >= 2
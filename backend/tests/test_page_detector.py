@@ -0,0 +1,53 @@
+import io
+
+from PIL import Image, ImageDraw
+
+from image_pipeline import load_page
+from page_detector import detect_page, page_size, warp_page
+
+CORNERS = [(150, 120), (650, 160), (620, 880), (130, 850)]
+
+
+def photo_of_paper() -> Image.Image:
+    """深色桌面上略微倾斜的试卷"""
+    photo = Image.new("RGB", (800, 1000), (60, 50, 45))
+    draw = ImageDraw.Draw(photo)
+    draw.polygon(CORNERS, fill=(235, 235, 230))
+    for y in range(250, 800, 60):
+        draw.line((220, y, 540, y + 5), fill=(30, 30, 30), width=3)
+    return photo
+
+
+def test_detects_paper_corners():
+    corners = detect_page(photo_of_paper())
+    assert corners is not None
+    for (x, y), (expected_x, expected_y) in zip(corners, CORNERS):
+        assert abs(x - expected_x) <= 8 and abs(y - expected_y) <= 8
+
+
+def test_no_page_when_paper_fills_frame_or_image_is_flat():
+    assert detect_page(Image.new("RGB", (800, 1000), (235, 235, 230))) is None
+    filled = Image.new("RGB", (800, 1000), (235, 235, 230))
+    ImageDraw.Draw(filled).line((100, 500, 700, 500), fill=(30, 30, 30), width=3)
+    assert detect_page(filled) is None
+
+
+def test_warp_produces_upright_page_within_box():
+    photo = photo_of_paper()
+    corners = detect_page(photo)
+    page = warp_page(photo, corners, (400, 400))
+    width, height = page_size(corners)
+    assert max(page.size) == 400
+    assert abs(page.width / page.height - width / height) < 0.02
+    # 校正后四角都是纸面, 不含桌面
+    for x, y in ((3, 3), (page.width - 4, 3), (3, page.height - 4), (page.width - 4, page.height - 4)):
+        assert min(page.getpixel((x, y))) > 180
+
+
+def test_load_page_crops_to_paper():
+    buffered = io.BytesIO()
+    photo_of_paper().save(buffered, format="JPEG", quality=90)
+    page, original_size = load_page(buffered.getvalue(), max_size=600)
+    assert original_size == (800, 1000)
+    assert max(page.size) == 600
+    assert min(page.getpixel((5, 5))) > 180
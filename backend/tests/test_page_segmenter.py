@@ -0,0 +1,63 @@
+import base64
+import io
+import json
+
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from conftest import glm_response, read_testdata
+from page_segmenter import segment_questions
+
+
+def test_segments_exam_photo_in_reading_order():
+    regions = segment_questions(read_testdata("数学.jpg"))
+    assert len(regions) >= 4
+    for region in regions:
+        assert 0 <= region["x"] and region["x"] + region["width"] <= 100.1
+        assert 0 <= region["y"] and region["y"] + region["height"] <= 100.1
+    # 单栏试卷: 区域从上到下排列
+    tops = [region["y"] for region in regions]
+    assert tops == sorted(tops)
+
+
+def test_blank_page_is_not_segmented():
+    buffered = io.BytesIO()
+    Image.new("RGB", (800, 1000), "white").save(buffered, format="PNG")
+    assert segment_questions(buffered.getvalue()) == []
+
+
+def region_answer(question_no: str) -> str:
+    return json.dumps({"questions": [{
+        "question_no": question_no, "question_content": f"第{question_no}题", "student_answer": "1", "teacher_mark": "×"
+    }]}, ensure_ascii=False)
+
+
+def test_smart_detect_falls_back_to_page_when_a_region_fails(mock_glm, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "COLLAGE_MIN_REGIONS", 0)
+    calls = {"region": 0, "page": 0}
+
+    def handler(payload):
+        if payload["model"] != "glm-4v":
+            return glm_response('{"correct_answer": "2", "is_correct": false, "reasoning": "计算错误"}')
+        prompt = payload["messages"][0]["content"][-1]["text"]
+        if "裁出的一部分" in prompt:
+            calls["region"] += 1
+            # 第一个区域返回无法解析的内容
+            return glm_response("看不清" if calls["region"] == 1 else region_answer(f"r{calls['region']}"))
+        calls["page"] += 1
+        return glm_response(region_answer("page"))
+
+    respond, _ = mock_glm
+    respond(handler)
+    response = TestClient(main.app).post("/api/detect/mistakes/smart", json={
+        "image_data": base64.b64encode(read_testdata("数学.jpg")).decode(),
+        "tiled": False
+    })
+
+    assert response.status_code == 200
+    questions = response.json()["data"]["all_questions"]
+    assert calls["region"] >= 4 and calls["page"] == 1
+    # 不采用缺少区域的分割结果
+    assert [question["question_no"] for question in questions] == ["page"]
@@ -0,0 +1,97 @@
+import base64
+import io
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import page_analysis
+import paper_index as paper_index_module
+from conftest import glm_response, read_testdata
+from paper_index import PAPER_DEDUP_DISTANCE, PaperIndex, hamming_distance, perceptual_hash
+
+
+def jpeg_bytes(image: Image.Image, quality: int = 60) -> bytes:
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def paper_distance(data: bytes, other: bytes) -> int:
+    return hamming_distance(perceptual_hash(data), perceptual_hash(other))
+
+
+def test_reencoded_paper_is_same():
+    data = read_testdata("数学.jpg")
+    image = Image.open(io.BytesIO(data))
+    assert paper_distance(data, jpeg_bytes(image, quality=30)) <= 20
+    assert paper_distance(data, jpeg_bytes(image.resize((image.width // 2, image.height // 2)))) <= 20
+
+
+def test_tilted_retake_is_same():
+    for name in ("数学.jpg", "错题1.png", "错题2.png"):
+        data = read_testdata(name)
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+        for angle in (3, -3):
+            tilted = jpeg_bytes(image.rotate(angle, fillcolor="white"))
+            assert paper_distance(data, tilted) <= PAPER_DEDUP_DISTANCE, (name, angle)
+
+
+def test_different_papers_are_not_same():
+    names = ("数学.jpg", "错题1.png", "错题2.png", "01_processed.jpg")
+    for i, name in enumerate(names):
+        for other in names[i + 1:]:
+            assert paper_distance(read_testdata(name), read_testdata(other)) > PAPER_DEDUP_DISTANCE + 20, (name, other)
+
+
+def test_index_reuses_results_per_user_and_namespace():
+    index = PaperIndex(max_distance=10, ttl=3600, max_per_user=2, max_users=10)
+    paper = bytes(32)
+    near = bytes([1]) + bytes(31)
+    far = bytes([255] * 32)
+
+    index.store("u1", paper, "ocr_exam", {"questions": [1]})
+    assert index.lookup("u1", near, "ocr_exam") == {"questions": [1]}
+    assert index.lookup("u1", near, "smart_detect") is None
+    assert index.lookup("u1", far, "ocr_exam") is None
+    assert index.lookup("u2", paper, "ocr_exam") is None
+    assert (index.hits, index.misses) == (1, 3)
+
+
+def test_index_expires_and_limits_papers(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(paper_index_module, "time", SimpleNamespace(time=lambda: now[0]))
+    index = PaperIndex(max_distance=4, ttl=60, max_per_user=2, max_users=1)
+
+    papers = [bytes([value]) * 32 for value in (0, 15, 255)]
+    for n, paper in enumerate(papers):
+        index.store("u1", paper, "ocr_exam", n)
+    # 每个用户只保留最近的 2 张
+    assert index.lookup("u1", papers[0], "ocr_exam") is None
+    assert index.lookup("u1", papers[2], "ocr_exam") == 2
+
+    index.store("u2", papers[0], "ocr_exam", "u2")
+    assert index.stats()["users"] == 1
+    assert index.lookup("u1", papers[2], "ocr_exam") is None
+
+    now[0] += 61
+    assert index.lookup("u2", papers[0], "ocr_exam") is None
+
+
+def test_failed_hash_skips_reuse_instead_of_failing(mock_glm, monkeypatch):
+    import main
+
+    def broken(image):
+        raise ValueError("hash failed")
+
+    monkeypatch.setattr(page_analysis, "image_hash", broken)
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response('{"questions": [{"question_no": "1", "question_text": "解方程 x+1=2"}]}'))
+
+    response = TestClient(main.app).post("/api/detect/questions", json={
+        "image_data": base64.b64encode(read_testdata("数学.jpg")).decode(),
+        "user_id": "student-hash-failure"
+    })
+    assert response.status_code == 200
+    assert requests
+    assert "student-hash-failure" not in main.paper_index._users
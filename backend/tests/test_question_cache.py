@@ -0,0 +1,66 @@
+import numpy as np
+
+from question_cache import NearDuplicateCache, jaccard, math_tokens, minhash_signature, normalize_question, shingles
+
+QUESTION = "已知二次函数y=x²+2x-3,求该函数图像的顶点坐标和对称轴"
+
+
+def test_normalize_drops_whitespace_punctuation_and_width():
+    assert normalize_question("  ＡＢ，c d。 1+1＝2 ") == "abcd1+1=2"
+
+
+def test_math_tokens_keep_numbers_and_operators():
+    assert math_tokens(QUESTION) == "= 2 + 2 - 3"
+    assert math_tokens("计算 3.5 × 4 ÷ 2") == "3.5 × 4 ÷ 2"
+
+
+def test_minhash_estimates_jaccard():
+    a = shingles(normalize_question(QUESTION))
+    b = shingles(normalize_question(QUESTION.replace("顶点", "项点")))
+    estimate = float(np.mean(minhash_signature(a) == minhash_signature(b)))
+    assert abs(estimate - jaccard(a, b)) < 0.2
+
+
+def test_exact_and_fuzzy_hits():
+    cache = NearDuplicateCache(threshold=0.7)
+    cache.store("solve", QUESTION, {"answer": "(-1, -4)"})
+
+    assert cache.lookup("solve", QUESTION) == {"answer": "(-1, -4)"}
+    # 空白, 标点和个别识别错字不同仍视为同一道题
+    assert cache.lookup("solve", QUESTION.replace(",", "， ").replace("顶点", "项点")) == {"answer": "(-1, -4)"}
+    assert cache.stats()["fuzzy_hits"] == 1
+
+
+def test_changed_constant_is_a_different_question():
+    cache = NearDuplicateCache()
+    cache.store("solve", QUESTION, {"answer": "(-1, -4)"})
+
+    assert cache.lookup("solve", QUESTION.replace("-3", "-8")) is None
+    assert cache.lookup("solve", QUESTION.replace("+2x", "-2x")) is None
+
+
+def test_namespace_and_extra_must_match():
+    cache = NearDuplicateCache()
+    cache.store("diagnose", QUESTION, "诊断A", extra="(-1,-4)")
+
+    assert cache.lookup("diagnose", QUESTION, extra="(1,4)") is None
+    assert cache.lookup("solve", QUESTION, extra="(-1,-4)") is None
+    assert cache.lookup("diagnose", QUESTION, extra="(-1, -4)") == "诊断A"
+
+
+def test_short_questions_only_match_exactly():
+    cache = NearDuplicateCache(threshold=0.1)
+    cache.store("chat", "什么是质数", "回答")
+
+    assert cache.lookup("chat", "什么是质数?") == "回答"
+    assert cache.lookup("chat", "什么是合数") is None
+
+
+def test_oldest_entries_are_evicted():
+    cache = NearDuplicateCache(max_entries=2)
+    for i, text in enumerate(["第一道题目的内容比较长一些", "第二道题目的内容比较长一些", "第三道题目的内容比较长一些"]):
+        cache.store("solve", text, i)
+
+    assert cache.lookup("solve", "第一道题目的内容比较长一些") is None
+    assert cache.lookup("solve", "第三道题目的内容比较长一些") == 2
+    assert cache.stats()["entries"] == 2
@@ -0,0 +1,69 @@
+import asyncio
+import base64
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import glm_client
+from conftest import glm_response, read_testdata
+
+
+def sse_response(deltas) -> httpx.Response:
+    lines = [f"data: {json.dumps({'choices': [{'delta': {'content': delta}}]}, ensure_ascii=False)}" for delta in deltas]
+    return httpx.Response(200, text="\n\n".join(lines + ["data: [DONE]"]) + "\n\n",
+                          headers={"Content-Type": "text/event-stream"})
+
+
+def sse_events(text: str) -> list:
+    return [json.loads(line[len("data: "):]) for line in text.splitlines() if line.startswith("data: ")]
+
+
+def test_stream_yields_upstream_deltas(mock_glm):
+    respond, requests = mock_glm
+    respond(lambda payload: sse_response(["第一段", "第二段", "第三段"]))
+
+    async def collect():
+        return [delta async for delta in glm_client.stream_glm_api([{"role": "user", "content": "hi"}])]
+
+    assert asyncio.run(collect()) == ["第一段", "第二段", "第三段"]
+    assert requests[0]["stream"] is True
+
+
+def test_stream_rejects_empty_content(mock_glm):
+    respond, _ = mock_glm
+    respond(lambda payload: sse_response([]))
+
+    async def collect():
+        return [delta async for delta in glm_client.stream_glm_api([{"role": "user", "content": "hi"}], max_retries=1)]
+
+    with pytest.raises(Exception):
+        asyncio.run(collect())
+
+
+def test_guide_fallback_text_is_sent_as_one_event(mock_glm):
+    import main
+
+    guide_text = "我们先回忆一下二次函数的顶点公式, 你记得吗?"
+
+    def handler(payload):
+        if payload["model"] == "glm-4-flash":
+            return glm_response(guide_text)
+        prompt = payload["messages"][0]["content"][-1]["text"]
+        if "学科" in prompt:
+            return glm_response("数学")
+        return glm_response('{"mistakes": [{"question_no": "3", "reason": "红叉标记"}]}')
+
+    respond, _ = mock_glm
+    respond(handler)
+    client = TestClient(main.app)
+    response = client.post("/api/analyze/smart/stream", json={
+        "image_data": base64.b64encode(read_testdata("数学.jpg")).decode(),
+        "analysis_type": "mistakes"
+    })
+
+    events = sse_events(response.text)
+    contents = [event["content"] for event in events if "content" in event]
+    assert contents == [guide_text]
+    assert events[-1]["done"] is True
@@ -0,0 +1,52 @@
+from fastapi.testclient import TestClient
+
+import image_pipeline
+from conftest import glm_response, read_testdata
+
+
+def upload_client() -> TestClient:
+    import main
+    return TestClient(main.app)
+
+
+def test_chat_upload_sends_image_to_glm(mock_glm):
+    respond, requests = mock_glm
+    respond(lambda payload: glm_response("这是一道二次函数题"))
+
+    response = upload_client().post(
+        "/api/chat/upload",
+        data={"message": "这道题考什么"},
+        files={"file": ("paper.png", read_testdata("错题1.png"), "image/png")}
+    )
+    assert response.status_code == 200
+    assert response.json()["success"] is True
+    content = requests[0]["messages"][-1]["content"]
+    assert content[0]["image_url"]["url"].startswith("data:image/")
+
+
+def test_upload_rejects_unrecognized_image():
+    response = upload_client().post(
+        "/api/detect/questions/upload",
+        files={"file": ("paper.jpg", b"not an image", "image/jpeg")}
+    )
+    assert response.status_code == 400
+    assert "无法识别" in response.json()["detail"]
+
+
+def test_upload_rejects_oversized_file(monkeypatch):
+    monkeypatch.setattr(image_pipeline, "IMAGE_MAX_BYTES", 1024)
+    response = upload_client().post(
+        "/api/detect/questions/upload",
+        files={"file": ("paper.png", read_testdata("错题1.png"), "image/png")}
+    )
+    assert response.status_code == 413
+
+
+def test_upload_rejects_invalid_json_field():
+    response = upload_client().post(
+        "/api/detect/mistakes/upload",
+        data={"user_marks": "[{"},
+        files={"file": ("paper.png", read_testdata("错题1.png"), "image/png")}
+    )
+    assert response.status_code == 400
+    assert "user_marks" in response.json()["detail"]
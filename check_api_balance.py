@@ -8,10 +8,10 @@ import json
 import os
 import sys
 
-# 从 backend/main.py 读取 API Key
+# 从 backend/glm_client.py 读取 API Key
 def get_api_key():
     try:
-        with open("backend/main.py", "r") as f:
+        with open("backend/glm_client.py", "r") as f:
             content = f.read()
             # 提取默认的 API Key
             import re
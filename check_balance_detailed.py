@@ -2,7 +2,7 @@ import requests
 import re
 
 # 读取 API Key
-with open("backend/main.py", "r") as f:
+with open("backend/glm_client.py", "r") as f:
     content = f.read()
     match = re.search(r'GLM_API_KEY = os\.getenv\("GLM_API_KEY", "([^"]+)"\)', content)
     api_key = match.group(1) if match else "Not found"
@@ -20,8 +20,8 @@ def update_env_file(new_api_key):
     return True
 
 def update_backend_file(new_api_key):
-    """直接修改 backend/main.py"""
-    file_path = "backend/main.py"
+    """直接修改 backend/glm_client.py"""
+    file_path = "backend/glm_client.py"
 
     with open(file_path, "r", encoding="utf-8") as f:
         content = f.read()
@@ -67,7 +67,7 @@ def main():
     print()
     print("选择保存方式:")
     print("  1. 保存到 .env 文件 (推荐)")
-    print("  2. 直接修改 backend/main.py")
+    print("  2. 直接修改 backend/glm_client.py")
 
     choice = input("请选择 (1 或 2): ").strip()
 